@@ -23,11 +23,19 @@ from pickle import dump, load
 from eolie.settings import Settings, SettingsDialog
 from eolie.window import Window
 from eolie.art import Art
+from eolie.http_session import HttpSession
+from eolie.favicon_resolver import FaviconResolver
+from eolie.snapshot_scheduler import SnapshotScheduler
+from eolie.populars import PopularsPage
 from eolie.database_history import DatabaseHistory
 from eolie.database_bookmarks import DatabaseBookmarks
 from eolie.database_adblock import DatabaseAdblock
+from eolie.database_https import DatabaseHttps
 from eolie.sqlcursor import SqlCursor
 from eolie.search import Search
+from eolie.host_trie import HostTrie
+from eolie.dns_prefetcher import DnsPrefetcher
+from eolie.tab_discarder import TabDiscarder
 from eolie.download_manager import DownloadManager
 from eolie.menu_pages import PagesMenu
 
@@ -107,6 +115,7 @@ class Application(Gtk.Application):
         styleContext.add_provider_for_screen(screen, cssProvider,
                                              Gtk.STYLE_PROVIDER_PRIORITY_USER)
         self.settings = Settings.new()
+        self.http = HttpSession()
         self.history = DatabaseHistory()
         self.bookmarks = DatabaseBookmarks()
         # We store cursors for main thread
@@ -116,15 +125,21 @@ class Application(Gtk.Application):
             from eolie.mozilla_sync import SyncWorker
             self.sync_worker = SyncWorker()
             self.sync_worker.sync()
-            GLib.timeout_add_seconds(3600,
-                                     self.sync_worker.sync)
         except Exception as e:
             print("Application::init():", e)
             self.sync_worker = None
         self.adblock = DatabaseAdblock()
         self.adblock.update()
+        self.https = DatabaseHttps()
+        self.https.update()
         self.art = Art()
+        self.favicons = FaviconResolver()
+        self.snapshots = SnapshotScheduler()
+        self.populars = PopularsPage()
         self.search = Search()
+        self.prefetcher = DnsPrefetcher()
+        self.hosts = HostTrie()
+        self.discarder = TabDiscarder()
         self.download_manager = DownloadManager()
 
         shortcut_action = Gio.SimpleAction.new('shortcut',
@@ -192,9 +207,9 @@ class Application(Gtk.Application):
             session_states = []
             for window in self.__windows:
                 for view in window.container.views:
-                    uri = view.webview.get_uri()
-                    private = view.webview.private
-                    state = view.webview.get_session_state().serialize()
+                    uri = view.uri
+                    private = view.private
+                    state = view.session_state.serialize()
                     session_states.append((uri, private, state.get_data()))
             dump(session_states,
                  open(self.LOCAL_PATH + "/session_states.bin", "wb"))
@@ -213,7 +228,8 @@ class Application(Gtk.Application):
         """
         for window in self.__windows:
             for view in window.container.views:
-                view.webview.set_setting(key, value)
+                if not view.discarded:
+                    view.webview.set_setting(key, value)
 
     @property
     def pages_menu(self):
@@ -12,43 +12,79 @@
 
 from gi.repository import Gdk, GdkPixbuf, Gio, GLib
 
+import os
 from hashlib import sha256
 from time import time
+from threading import Thread, Lock
+from queue import Queue
 
-from eolie.utils import strip_uri
+from eolie.define import El, ArtSize
+from eolie.utils import strip_uri, resize_favicon
+from eolie.art_cache import ArtCache
+from eolie.surface_cache import SurfaceCache
 
 
 class Art:
     """
         Base art manager
+        One master thumbnail is stored per uri, other sizes are derived
     """
     if GLib.getenv("XDG_CACHE_HOME") is None:
         __CACHE_PATH = GLib.get_home_dir() + "/.cache/eolie"
     else:
         __CACHE_PATH = GLib.getenv("XDG_CACHE_HOME") + "/eolie"
+    # Threads encoding and writing artworks
+    __WORKERS = 2
+    # Decoded surfaces kept in memory
+    __SURFACES_SIZE = 32 * 1024 * 1024
+    # Derived variants are written to disk after this many derivations
+    __PERSIST_COUNT = 3
+    __MAX_DERIVATIONS = 10000
 
     def __init__(self):
         """
             Init base art
         """
         self.__create_cache()
+        max_size = El().settings.get_value("cache-size").get_int32()
+        self.__cache = ArtCache(self.__CACHE_PATH, max_size * 1024 * 1024,
+                                self.__migrate)
+        El().settings.connect("changed::cache-size",
+                              self.__on_cache_size_changed)
+        self.__surfaces = SurfaceCache(self.__SURFACES_SIZE)
+        # Bumped when a thumbnail is written or removed
+        self.__version = 0
+        # Variant suffixes asked by widgets, derivations per variant
+        self.__suffixes = set()
+        self.__derivations = {}
+        self.__lock = Lock()
+        # Last pixbuf to write per file, scheduled files
+        self.__pending = {}
+        self.__scheduled = set()
+        self.__queue = Queue()
+        for i in range(0, self.__WORKERS):
+            thread = Thread(target=self.__save_worker)
+            thread.daemon = True
+            thread.start()
 
-    def save_artwork(self, uri, surface, suffix):
+    def save_artwork(self, uri, surface):
         """
-            Save artwork for uri with suffix
+            Save master thumbnail for uri
+            Only pixels are copied here, encoding is done in a worker
+            A pending save for same uri is replaced
             @param uri as str
             @param surface as cairo.surface
-            @param suffix as str
         """
-        filepath = self.get_path(uri, suffix)
+        self.uncache(uri)
         pixbuf = Gdk.pixbuf_get_from_surface(surface, 0, 0,
                                              surface.get_width(),
                                              surface.get_height())
-        pixbuf.savev(filepath, "png", [None], [None])
-        del pixbuf
+        self.__schedule(self.get_path(uri, "master"), pixbuf)
 
     def get_artwork(self, uri, suffix, scale_factor, width, heigth):
         """
+            Get artwork variant, derived from master thumbnail
+            Decoded surfaces are kept in memory
             @param uri as str
             @param suffix as str
             @param scale factor as int
@@ -56,36 +92,109 @@ class Art:
             @param height as int
             @return cairo.surface
         """
-        filepath = self.get_path(uri, suffix)
-        f = Gio.File.new_for_path(filepath)
-        if f.query_exists():
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filepath,
-                                                             width,
-                                                             heigth,
-                                                             True)
-            surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf,
-                                                           scale_factor, None)
-            del pixbuf
+        encoded = self.__get_encoded(uri)
+        key = (encoded, suffix, width, heigth, scale_factor)
+        surface = self.__surfaces.get(key)
+        if surface is not None:
             return surface
-        return None
+        self.__suffixes.add(suffix)
+        master_path = self.__cache.get_path(encoded, "master")
+        if not self.__cache.access(master_path):
+            return None
+        variant = "%s_%sx%s" % (suffix, width, heigth)
+        variant_path = self.__cache.get_path(encoded, variant)
+        try:
+            if self.__is_newer(variant_path, master_path):
+                self.__cache.access(variant_path)
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(variant_path)
+            else:
+                master = GdkPixbuf.Pixbuf.new_from_file(master_path)
+                pixbuf = self.__derive(master, width, heigth)
+                del master
+                if len(self.__derivations) > self.__MAX_DERIVATIONS:
+                    self.__derivations = {}
+                count = self.__derivations.get(variant_path, 0) + 1
+                self.__derivations[variant_path] = count
+                if count >= self.__PERSIST_COUNT:
+                    self.__schedule(variant_path, pixbuf)
+        except Exception as e:
+            print("Art::get_artwork():", e)
+            return None
+        surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf,
+                                                       scale_factor, None)
+        del pixbuf
+        self.__surfaces.add(key, surface)
+        return surface
+
+    def get_favicon(self, uri):
+        """
+            Get favicon for uri from memory
+            @param uri as str
+            @return cairo.surface/None
+        """
+        return self.__surfaces.get((self.__get_encoded(uri), "favicon",
+                                    ArtSize.FAVICON, ArtSize.FAVICON, 1))
+
+    def add_favicon(self, uri, favicon):
+        """
+            Resize favicon and keep it in memory
+            @param uri as str
+            @param favicon as cairo.surface
+            @return resized favicon as cairo.surface
+        """
+        surface = resize_favicon(favicon)
+        self.__surfaces.add((self.__get_encoded(uri), "favicon",
+                             ArtSize.FAVICON, ArtSize.FAVICON, 1), surface)
+        return surface
+
+    def uncache(self, uri, suffix=None):
+        """
+            Forget decoded surfaces for uri
+            @param uri as str
+            @param suffix as str/None: all thumbnail variants if None
+        """
+        encoded = self.__get_encoded(uri)
+        if suffix is None:
+            for suffix in self.__suffixes:
+                self.__surfaces.remove(encoded, suffix)
+        else:
+            self.__surfaces.remove(encoded, suffix)
 
     def get_path(self, uri, suffix):
         """
             Return cache image path
             @return str
         """
-        strip = strip_uri(uri, False, True)
-        strip = strip.replace("www.", "")
-        encoded = sha256(strip.encode("utf-8")).hexdigest()
-        filepath = "%s/%s_%s.png" % (self.__CACHE_PATH, encoded, suffix)
-        return filepath
+        return self.__cache.get_path(self.__get_encoded(uri), suffix)
+
+    def remove(self, uri):
+        """
+            Remove master thumbnail from cache
+            Persisted variants are then outdated
+            @param uri as str
+        """
+        self.uncache(uri)
+        self.__cache.remove(self.get_path(uri, "master"))
+        self.__version += 1
+
+    def access(self, uri, suffix):
+        """
+            True if artwork is in cache, mark it as used
+            @param uri as str
+            @param suffix as str
+            @return bool
+        """
+        return self.__cache.access(self.get_path(uri, suffix))
 
     def exists(self, uri, suffix):
         """
             True if exists in cache and not older than one day
             @return bool
         """
-        f = Gio.File.new_for_path(self.get_path(uri, suffix))
+        filepath = self.get_path(uri, suffix)
+        if filepath in self.__pending:
+            return True
+        f = Gio.File.new_for_path(filepath)
         exists = f.query_exists()
         if exists:
             info = f.query_info('time::modified',
@@ -96,6 +205,30 @@ class Art:
                 exists = False
         return exists
 
+    @property
+    def stats(self):
+        """
+            Get cache statistics
+            @return {"size": int, "entries": int, "hit_rate": float}
+        """
+        return self.__cache.stats
+
+    @property
+    def version(self):
+        """
+            Get thumbnails version, changes when a thumbnail changes
+            @return int
+        """
+        return self.__version
+
+    @property
+    def surfaces_stats(self):
+        """
+            Get decoded surfaces statistics
+            @return {"bytes": int, "entries": int, "hit_rate": float}
+        """
+        return self.__surfaces.stats
+
     @property
     def base_uri(self):
         """
@@ -111,6 +244,119 @@ class Art:
 #######################
 # PRIVATE             #
 #######################
+    def __get_encoded(self, uri):
+        """
+            Get uri hash used as cache key
+            @param uri as str
+            @return str
+        """
+        strip = strip_uri(uri, False, True)
+        strip = strip.replace("www.", "")
+        return sha256(strip.encode("utf-8")).hexdigest()
+
+    def __migrate(self, encoded, suffix, filepath):
+        """
+            Map thumbnails from previous releases to master and variants
+            @param encoded as str
+            @param suffix as str
+            @param filepath as str
+            @return suffix as str/None
+            @thread safe
+        """
+        if suffix == "start":
+            # Start page thumbnails have master size
+            return "master"
+        elif suffix == "preview":
+            # Sidebar previews match a derived variant of their size
+            (info, width, height) = GdkPixbuf.Pixbuf.get_file_info(filepath)
+            if info is None:
+                return None
+            return "preview_%sx%s" % (width, height)
+        return suffix
+
+    def __derive(self, master, width, height):
+        """
+            Crop top of master to requested ratio and scale it
+            @param master as GdkPixbuf.Pixbuf
+            @param width as int
+            @param height as int
+            @return GdkPixbuf.Pixbuf
+        """
+        crop_height = min(master.get_height(),
+                          int(master.get_width() * height / width))
+        crop = master.new_subpixbuf(0, 0, master.get_width(), crop_height)
+        return crop.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+
+    def __is_newer(self, filepath, reference):
+        """
+            True if file exists and is newer than reference
+            @param filepath as str
+            @param reference as str
+            @return bool
+        """
+        try:
+            return os.stat(filepath).st_mtime >= os.stat(reference).st_mtime
+        except:
+            return False
+
+    def __schedule(self, filepath, pixbuf):
+        """
+            Schedule pixbuf write, replacing any pending one
+            @param filepath as str
+            @param pixbuf as GdkPixbuf.Pixbuf
+        """
+        with self.__lock:
+            self.__pending[filepath] = pixbuf
+            if filepath in self.__scheduled:
+                return
+            self.__scheduled.add(filepath)
+        self.__queue.put(filepath)
+
+    def __on_cache_size_changed(self, settings, key):
+        """
+            Update cache max size
+            @param settings as Gio.Settings
+            @param key as str
+        """
+        max_size = settings.get_value(key).get_int32()
+        self.__cache.set_max_size(max_size * 1024 * 1024)
+
+    def __save_worker(self):
+        """
+            Write scheduled artworks until pending saves are done
+            @thread safe
+        """
+        while True:
+            filepath = self.__queue.get()
+            while True:
+                with self.__lock:
+                    pixbuf = self.__pending.pop(filepath, None)
+                    if pixbuf is None:
+                        self.__scheduled.remove(filepath)
+                        break
+                self.__write(filepath, pixbuf)
+                del pixbuf
+
+    def __write(self, filepath, pixbuf):
+        """
+            Write pixbuf as PNG, readers never see a partial file
+            @param filepath as str
+            @param pixbuf as GdkPixbuf.Pixbuf
+            @thread safe
+        """
+        tmp_path = "%s.tmp" % filepath
+        try:
+            GLib.mkdir_with_parents(GLib.path_get_dirname(filepath), 0o755)
+            pixbuf.savev(tmp_path, "png", [None], [None])
+            tmp = Gio.File.new_for_path(tmp_path)
+            tmp.move(Gio.File.new_for_path(filepath),
+                     Gio.FileCopyFlags.OVERWRITE, None, None, None)
+            self.__cache.add(filepath)
+            if filepath.endswith("_master.png"):
+                self.__version += 1
+        except Exception as e:
+            print("Art::__write():", e)
+
     def __create_cache(self):
         """
             Create cache dir
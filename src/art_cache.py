@@ -0,0 +1,231 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+import os
+from time import time
+from threading import Thread, Lock
+
+from eolie.utils import debug
+
+
+class ArtCache:
+    """
+        Size capped artwork cache
+        Files are stored in subdirectories named after hash first chars
+        Least recently used files are evicted in background
+    """
+    # Evict down to this ratio of max size
+    __LOW_WATERMARK = 0.9
+
+    def __init__(self, path, max_size, migrate=None):
+        """
+            Init cache, index is built in background
+            @param path as str
+            @param max_size as int (bytes)
+            @param migrate as function(encoded, suffix, filepath): called
+                   for each file while indexing, returns new suffix or None
+                   to remove file
+        """
+        self.__path = path
+        self.__migrate = migrate
+        self.__max_size = max_size
+        self.__lock = Lock()
+        # Indexed files: filepath: (atime, size)
+        self.__entries = {}
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evicting = False
+        thread = Thread(target=self.__scan)
+        thread.daemon = True
+        thread.start()
+
+    def get_path(self, encoded, suffix):
+        """
+            Get path for encoded uri
+            @param encoded as str (hexdigest)
+            @param suffix as str
+            @return str
+        """
+        return "%s/%s/%s_%s.png" % (self.__path, encoded[:2],
+                                    encoded, suffix)
+
+    def access(self, filepath):
+        """
+            Mark file as used, count a hit or a miss
+            @param filepath as str
+            @return bool: True if file exists
+            @thread safe
+        """
+        try:
+            size = os.stat(filepath).st_size
+        except:
+            with self.__lock:
+                self.__misses += 1
+            return False
+        with self.__lock:
+            self.__hits += 1
+            self.__index(filepath, time(), size)
+        return True
+
+    def add(self, filepath):
+        """
+            Index a new file, evict old files if cache is full
+            @param filepath as str
+            @thread safe
+        """
+        try:
+            size = os.stat(filepath).st_size
+        except:
+            return
+        with self.__lock:
+            self.__index(filepath, time(), size)
+            if self.__size <= self.__max_size or self.__evicting:
+                return
+            self.__evicting = True
+        thread = Thread(target=self.__evict)
+        thread.daemon = True
+        thread.start()
+
+    def remove(self, filepath):
+        """
+            Remove file from cache
+            @param filepath as str
+            @thread safe
+        """
+        try:
+            os.remove(filepath)
+        except:
+            pass
+        with self.__lock:
+            self.__unindex(filepath)
+
+    def set_max_size(self, max_size):
+        """
+            Set cache max size, applied on next add
+            @param max_size as int (bytes)
+        """
+        self.__max_size = max_size
+
+    @property
+    def stats(self):
+        """
+            Get cache statistics
+            @return {"size": int, "entries": int, "hit_rate": float}
+        """
+        with self.__lock:
+            requests = self.__hits + self.__misses
+            return {"size": self.__size,
+                    "entries": len(self.__entries),
+                    "hit_rate": self.__hits / requests if requests else 0.0}
+
+#######################
+# PRIVATE             #
+#######################
+    def __index(self, filepath, atime, size):
+        """
+            Add or update file in index, lock must be held
+            @param filepath as str
+            @param atime as float
+            @param size as int
+        """
+        self.__unindex(filepath)
+        self.__entries[filepath] = (atime, size)
+        self.__size += size
+
+    def __unindex(self, filepath):
+        """
+            Remove file from index, lock must be held
+            @param filepath as str
+        """
+        entry = self.__entries.pop(filepath, None)
+        if entry is not None:
+            self.__size -= entry[1]
+
+    def __scan(self):
+        """
+            Index cache content, move files from old layouts
+            @thread safe
+        """
+        try:
+            for entry in os.scandir(self.__path):
+                if entry.is_dir():
+                    for sub in os.scandir(entry.path):
+                        if sub.name.endswith(".tmp"):
+                            continue
+                        if not self.__move(sub.path, sub.name):
+                            continue
+                        stat = sub.stat()
+                        with self.__lock:
+                            if sub.path not in self.__entries:
+                                self.__index(sub.path,
+                                             max(stat.st_atime,
+                                                 stat.st_mtime),
+                                             stat.st_size)
+                elif entry.name.endswith(".png") and "_" in entry.name:
+                    self.__move(entry.path, entry.name)
+            debug("Art cache: %s" % self.stats)
+        except Exception as e:
+            print("ArtCache::__scan():", e)
+
+    def __move(self, filepath, name):
+        """
+            Move file to its migrated path
+            @param filepath as str
+            @param name as str
+            @return bool: True if file is still at filepath
+            @thread safe
+        """
+        if not name.endswith(".png") or "_" not in name:
+            return True
+        (encoded, suffix) = name[:-4].split("_", 1)
+        if self.__migrate is not None:
+            suffix = self.__migrate(encoded, suffix, filepath)
+        if suffix is None:
+            os.remove(filepath)
+            return False
+        new_path = self.get_path(encoded, suffix)
+        if new_path == filepath:
+            return True
+        GLib.mkdir_with_parents(os.path.dirname(new_path), 0o755)
+        os.replace(filepath, new_path)
+        self.add(new_path)
+        return False
+
+    def __evict(self):
+        """
+            Remove least recently used files until under low watermark
+            @thread safe
+        """
+        with self.__lock:
+            entries = sorted(self.__entries.items(),
+                             key=lambda item: item[1][0])
+            target = self.__max_size * self.__LOW_WATERMARK
+        removed = 0
+        for (filepath, (atime, size)) in entries:
+            if self.__size <= target:
+                break
+            with self.__lock:
+                # Used since we took the snapshot
+                if self.__entries.get(filepath, (0, 0))[0] != atime:
+                    continue
+                self.__unindex(filepath)
+            try:
+                os.remove(filepath)
+            except:
+                pass
+            removed += 1
+        with self.__lock:
+            self.__evicting = False
+        debug("Art cache: %s files evicted, %s" % (removed, self.stats))
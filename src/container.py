@@ -92,9 +92,14 @@ class Container(Gtk.Paned):
 
     def set_visible_view(self, view):
         """
-            Set visible view
+            Set visible view, restore it if discarded
             @param view as WebView
         """
+        if view.discarded:
+            view.restore()
+            self.__connect_webview(view.webview)
+            self.__stack_sidebar.connect_view(view)
+        view.set_accessed()
         # Remove from offscreen window if needed
         # Will kill running get_snapshot :-/
         parent = view.get_parent()
@@ -147,25 +152,32 @@ class Container(Gtk.Paned):
             @return View
         """
         view = View(private, parent, webview)
-        view.webview.connect("map", self.__on_view_map)
-        view.webview.connect("notify::estimated-load-progress",
-                             self.__on_estimated_load_progress)
-        view.webview.connect("load-changed", self.__on_load_changed)
-        view.webview.connect("button-press-event", self.__on_button_press)
-        view.webview.connect("notify::uri", self.__on_uri_changed)
-        view.webview.connect("title-changed", self.__on_title_changed)
-        view.webview.connect("enter-fullscreen", self.__on_enter_fullscreen)
-        view.webview.connect("leave-fullscreen", self.__on_leave_fullscreen)
-        view.webview.connect("readable", self.__on_readable)
-        view.webview.connect("new-page", self.__on_new_page)
-        view.webview.connect("create", self.__on_create)
-        view.webview.connect("close", self.__on_close)
-        view.webview.connect("save-password", self.__on_save_password)
-        view.webview.connect("insecure-content-detected",
-                             self.__on_insecure_content_detected)
+        self.__connect_webview(view.webview)
         view.show()
         return view
 
+    def __connect_webview(self, webview):
+        """
+            Connect webview signals
+            @param webview as WebView
+        """
+        webview.connect("map", self.__on_view_map)
+        webview.connect("notify::estimated-load-progress",
+                        self.__on_estimated_load_progress)
+        webview.connect("load-changed", self.__on_load_changed)
+        webview.connect("button-press-event", self.__on_button_press)
+        webview.connect("notify::uri", self.__on_uri_changed)
+        webview.connect("title-changed", self.__on_title_changed)
+        webview.connect("enter-fullscreen", self.__on_enter_fullscreen)
+        webview.connect("leave-fullscreen", self.__on_leave_fullscreen)
+        webview.connect("readable", self.__on_readable)
+        webview.connect("new-page", self.__on_new_page)
+        webview.connect("create", self.__on_create)
+        webview.connect("close", self.__on_close)
+        webview.connect("save-password", self.__on_save_password)
+        webview.connect("insecure-content-detected",
+                        self.__on_insecure_content_detected)
+
     def __get_view_for_webview(self, webview):
         """
             @param webview as WebView
@@ -305,6 +317,7 @@ class Container(Gtk.Paned):
         if parsed.scheme in ["http", "https"] and\
                 not webview.private:
             El().history.add(title, uri)
+            El().hosts.add(uri)
             history_id = El().history.get_id(title, uri)
             if El().sync_worker is not None:
                 El().sync_worker.push_history(history_id)
@@ -10,13 +10,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Soup, Gio, GLib
+from gi.repository import Gio, GLib
 
 from urllib.parse import urlparse
 import sqlite3
 from time import time
 from threading import Thread
 
+from eolie.define import El
 from eolie.sqlcursor import SqlCursor
 
 
@@ -222,15 +223,7 @@ class DatabaseAdblock:
         result = ""
         try:
             for uri in self.__URIS:
-                session = Soup.Session.new()
-                request = session.request(uri)
-                stream = request.send(self.__cancellable)
-                bytes = bytearray(0)
-                buf = stream.read_bytes(1024, self.__cancellable).get_data()
-                while buf:
-                    bytes += buf
-                    buf = stream.read_bytes(
-                                           1024, self.__cancellable).get_data()
+                bytes = El().http.read(uri, self.__cancellable)
                 result = bytes.decode('utf-8')
                 count = 0
                 for line in result.split('\n'):
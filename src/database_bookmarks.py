@@ -15,7 +15,7 @@ from gi.repository import GLib, Gio
 import sqlite3
 import itertools
 
-from eolie.utils import noaccents, get_random_string
+from eolie.utils import noaccents, get_random_string, is_changes_tracking
 from eolie.localized import LocalizedCollation
 from eolie.sqlcursor import SqlCursor
 
@@ -58,11 +58,82 @@ class DatabaseBookmarks:
                                         bookmark_id INT NOT NULL,
                                         parent_guid TEXT NOT NULL,
                                         parent_name TEXT NOT NULL)'''
+    __create_guid_idx = '''CREATE INDEX IF NOT EXISTS idx_guid
+                                        ON bookmarks(guid)'''
+    # Change log for sync, one row per dirty bookmark
+    # Filled by triggers, counter orders changes
+    __create_changes = '''CREATE TABLE IF NOT EXISTS changes (
+                                        id INTEGER PRIMARY KEY,
+                                        item_id INT NOT NULL UNIQUE,
+                                        guid TEXT NOT NULL,
+                                        op TEXT NOT NULL,
+                                        counter INT NOT NULL)'''
+    __create_changes_idx = '''CREATE INDEX IF NOT EXISTS idx_changes
+                                        ON changes(counter)'''
+    __NEXT_COUNTER = "(SELECT IFNULL(MAX(counter), 0) + 1 FROM changes)"
+    __create_triggers = [
+        '''CREATE TRIGGER IF NOT EXISTS changes_insert
+           AFTER INSERT ON bookmarks WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               VALUES (NEW.id, NEW.guid, 'insert', %s);
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_update
+           AFTER UPDATE OF title, uri, guid, mtime, position, del
+           ON bookmarks WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               VALUES (NEW.id, NEW.guid, 'update', %s);
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_delete
+           AFTER DELETE ON bookmarks WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               VALUES (OLD.id, OLD.guid, 'delete', %s);
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_tag_insert
+           AFTER INSERT ON bookmarks_tags WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               SELECT id, guid, 'update', %s
+               FROM bookmarks WHERE id=NEW.bookmark_id;
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_tag_delete
+           AFTER DELETE ON bookmarks_tags WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               SELECT id, guid, 'update', %s
+               FROM bookmarks WHERE id=OLD.bookmark_id;
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_tag_rename
+           AFTER UPDATE OF title ON tags WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               SELECT bookmarks.id, bookmarks.guid, 'update', %s
+               FROM bookmarks, bookmarks_tags
+               WHERE bookmarks_tags.tag_id=NEW.id
+               AND bookmarks.id=bookmarks_tags.bookmark_id;
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_parent_insert
+           AFTER INSERT ON parents WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               SELECT id, guid, 'update', %s
+               FROM bookmarks WHERE id=NEW.bookmark_id;
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_parent_update
+           AFTER UPDATE ON parents WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               SELECT id, guid, 'update', %s
+               FROM bookmarks WHERE id=NEW.bookmark_id;
+           END''' % __NEXT_COUNTER]
 
     def __init__(self):
         """
             Create database tables or manage update if needed
         """
+        self.__version = 0
         f = Gio.File.new_for_path(self.DB_PATH)
         if not f.query_exists():
             try:
@@ -79,6 +150,26 @@ class DatabaseBookmarks:
                 self.import_firefox()
             except Exception as e:
                 print("DatabaseBookmarks::__init__(): %s" % e)
+        # Sync looks up bookmarks by guid and reads change log
+        try:
+            with SqlCursor(self) as sql:
+                sql.execute(self.__create_guid_idx)
+                result = sql.execute("SELECT name FROM sqlite_master\
+                                      WHERE type='table' AND name='changes'")
+                upgrade = result.fetchone() is None
+                sql.execute(self.__create_changes)
+                sql.execute(self.__create_changes_idx)
+                for trigger in self.__create_triggers:
+                    sql.execute(trigger)
+                # Keep pending deletions from previous versions
+                if upgrade:
+                    sql.execute("INSERT INTO changes\
+                                 (item_id, guid, op, counter)\
+                                 SELECT id, guid, 'update', 1\
+                                 FROM bookmarks WHERE del=1")
+                sql.commit()
+        except Exception as e:
+            print("DatabaseBookmarks::__init__(): %s" % e)
 
     def add(self, title, uri, guid, tags, atime=0, commit=True):
         """
@@ -92,6 +183,7 @@ class DatabaseBookmarks:
             @param commit as bool
             @return bookmark id as int
         """
+        self.__version += 1
         # Find an uniq guid
         while guid is None:
             guid = get_random_string(12)
@@ -123,6 +215,7 @@ class DatabaseBookmarks:
             @param bookmark id as int
             @param delete as bool
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("UPDATE bookmarks\
                          SET del=?\
@@ -134,6 +227,7 @@ class DatabaseBookmarks:
             @param bookmark id as int
             @param commit as bool
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("DELETE FROM bookmarks\
                          WHERE rowid=?", (bookmark_id,))
@@ -250,20 +344,6 @@ class DatabaseBookmarks:
                 return v[0]
             return None
 
-    def get_ids_for_mtime(self, mtime):
-        """
-            Get ids that need to be synced related to mtime
-            @param mtime as int
-            @return [int]
-        """
-        with SqlCursor(self) as sql:
-            result = sql.execute("SELECT rowid\
-                                  FROM bookmarks\
-                                  WHERE mtime > ?\
-                                  AND uri != guid\
-                                  AND del=0", (mtime,))
-            return list(itertools.chain(*result))
-
     def get_deleted_ids(self):
         """
             Get ids that need to be synced related to mtime
@@ -373,6 +453,58 @@ class DatabaseBookmarks:
                                   ORDER BY position ASC", (guid,))
             return list(itertools.chain(*result))
 
+    def get_tree(self):
+        """
+            Get bookmarks tree, children are ordered by position
+            @return [(guid, parent guid, title, parent name)]
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT bookmarks.guid,\
+                                         parents.parent_guid,\
+                                         bookmarks.title,\
+                                         parents.parent_name\
+                                  FROM bookmarks LEFT JOIN parents\
+                                  ON parents.bookmark_id=bookmarks.rowid\
+                                  ORDER BY bookmarks.position ASC")
+            return list(result)
+
+    def get_changes(self):
+        """
+            Get bookmarks changed since last acknowledgment
+            Deleted bookmarks have no uri and no del flag
+            @return [(bookmark id as int, guid as str, op as str,
+                      counter as int, uri as str, del as bool)]
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT changes.item_id, changes.guid,\
+                                         changes.op, changes.counter,\
+                                         bookmarks.uri, bookmarks.del\
+                                  FROM changes LEFT JOIN bookmarks\
+                                  ON bookmarks.id=changes.item_id\
+                                  ORDER BY changes.counter")
+            return list(result)
+
+    def has_changes(self):
+        """
+            True if change log is not empty
+            @return bool
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT 1 FROM changes LIMIT 1")
+            return result.fetchone() is not None
+
+    def ack_changes(self, counter, commit=True):
+        """
+            Forget changes up to counter
+            Items changed again since have a greater counter
+            @param counter as int
+            @param commit as bool
+        """
+        with SqlCursor(self) as sql:
+            sql.execute("DELETE FROM changes WHERE counter<=?", (counter,))
+            if commit:
+                sql.commit()
+
     def get_mtime(self, bookmark_id):
         """
             Get bookmark mtime
@@ -482,6 +614,19 @@ class DatabaseBookmarks:
                             LIMIT ?", (limit,))
             return list(result)
 
+    def get_visits(self):
+        """
+            Get bookmarks uris with popularity and access time
+            @return [(str, int, int)]
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("\
+                            SELECT uri, popularity, atime\
+                            FROM bookmarks\
+                            WHERE del=0\
+                            AND guid != uri")
+            return list(result)
+
     def get_unclassified(self):
         """
             Get bookmarks without tag
@@ -524,6 +669,7 @@ class DatabaseBookmarks:
             @param title as str
             @param commit as bool
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("UPDATE bookmarks\
                          SET title=?\
@@ -538,6 +684,7 @@ class DatabaseBookmarks:
             @param uri as str
             @param commit as bool
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("UPDATE bookmarks\
                          SET uri=?\
@@ -606,6 +753,20 @@ class DatabaseBookmarks:
             if commit:
                 sql.commit()
 
+    def set_positions(self, positions, commit=True):
+        """
+            Set bookmarks positions in one statement
+            @param positions as [(guid, position)]
+            @param commit as bool
+        """
+        with SqlCursor(self) as sql:
+            sql.executemany("UPDATE bookmarks\
+                             SET position=? WHERE guid=?",
+                            [(position, guid) for (guid, position)
+                             in positions])
+            if commit:
+                sql.commit()
+
     def set_tag_title(self, tag_id, title):
         """
             Set tag id title
@@ -621,6 +782,7 @@ class DatabaseBookmarks:
             Increment bookmark popularity
             @param uri as str
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             uri = uri.rstrip('/')
             result = sql.execute("SELECT popularity FROM bookmarks\
@@ -764,6 +926,17 @@ class DatabaseBookmarks:
                                  (filter, filter, limit))
             return list(result)
 
+    @property
+    def version(self):
+        """
+            Get db version, changes on writes changing titles or ranking
+            data_version catches commits from other connections (sync)
+            @return (int, int)
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("PRAGMA data_version")
+            return (self.__version, result.fetchone()[0])
+
     def get_cursor(self):
         """
             Return a new sqlite cursor
@@ -772,6 +945,7 @@ class DatabaseBookmarks:
             c = sqlite3.connect(self.DB_PATH, 600.0)
             c.create_collation('LOCALIZED', LocalizedCollation())
             c.create_function("noaccents", 1, noaccents)
+            c.create_function("tracking", 0, is_changes_tracking)
             return c
         except:
             exit(-1)
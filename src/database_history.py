@@ -12,11 +12,14 @@
 
 from gi.repository import GLib, Gio
 
+import re
 import sqlite3
 import itertools
 from time import time
+from threading import Thread
+from urllib.parse import urlparse
 
-from eolie.utils import noaccents, get_random_string
+from eolie.utils import noaccents, get_random_string, is_changes_tracking
 from eolie.localized import LocalizedCollation
 from eolie.sqlcursor import SqlCursor
 
@@ -45,11 +48,78 @@ class DatabaseHistory:
                                                mtime INT NOT NULL,
                                                popularity INT NOT NULL
                                                )'''
+    __create_guid_idx = '''CREATE INDEX IF NOT EXISTS idx_guid
+                                        ON history(guid)'''
+    # Change log for sync, one row per dirty history item
+    # Removals are not logged: clearing local history is not a sync action
+    __create_changes = '''CREATE TABLE IF NOT EXISTS changes (
+                                        id INTEGER PRIMARY KEY,
+                                        item_id INT NOT NULL UNIQUE,
+                                        guid TEXT NOT NULL,
+                                        op TEXT NOT NULL,
+                                        counter INT NOT NULL)'''
+    __create_changes_idx = '''CREATE INDEX IF NOT EXISTS idx_changes
+                                        ON changes(counter)'''
+    # Words searched from URL bar
+    __create_searches = '''CREATE TABLE IF NOT EXISTS searches (
+                                        words TEXT PRIMARY KEY,
+                                        count INT NOT NULL,
+                                        atime INT NOT NULL)'''
+    # Vocabulary of titles and hosts, indexed by trigrams for fuzzy search
+    __create_words = '''CREATE TABLE IF NOT EXISTS words (
+                                        id INTEGER PRIMARY KEY,
+                                        word TEXT NOT NULL UNIQUE,
+                                        trigrams INT NOT NULL)'''
+    __create_words_trigrams = '''CREATE TABLE IF NOT EXISTS words_trigrams (
+                                        trigram TEXT NOT NULL,
+                                        word_id INT NOT NULL,
+                                        PRIMARY KEY (trigram, word_id))
+                                        WITHOUT ROWID'''
+    # History items using a word, words without items are removed
+    __create_history_words = '''CREATE TABLE IF NOT EXISTS history_words (
+                                        word_id INT NOT NULL,
+                                        history_id INT NOT NULL,
+                                        PRIMARY KEY (word_id, history_id))
+                                        WITHOUT ROWID'''
+    __create_history_words_idx = '''CREATE INDEX IF NOT EXISTS
+                                        idx_history_words
+                                        ON history_words(history_id)'''
+    # Last history rowid added to vocabulary by backfill
+    __create_words_progress = '''CREATE TABLE IF NOT EXISTS words_progress (
+                                        last INT NOT NULL)'''
+    # Fuzzy search stops scoring after this delay (seconds)
+    __FUZZY_BUDGET = 0.05
+    # Minimal trigram similarity for a word to match a search word
+    __FUZZY_SIMILARITY = 0.3
+    # Known words matched per search word
+    __FUZZY_WORDS = 50
+    # Best scored items ranked by popularity
+    __FUZZY_CANDIDATES = 500
+    __NEXT_COUNTER = "(SELECT IFNULL(MAX(counter), 0) + 1 FROM changes)"
+    __create_triggers = [
+        '''CREATE TRIGGER IF NOT EXISTS changes_insert
+           AFTER INSERT ON history WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               VALUES (NEW.id, NEW.guid, 'insert', %s);
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_update
+           AFTER UPDATE OF title, uri, guid, atime ON history WHEN tracking()
+           BEGIN
+               INSERT OR REPLACE INTO changes (item_id, guid, op, counter)
+               VALUES (NEW.id, NEW.guid, 'update', %s);
+           END''' % __NEXT_COUNTER,
+        '''CREATE TRIGGER IF NOT EXISTS changes_delete
+           AFTER DELETE ON history
+           BEGIN
+               DELETE FROM changes WHERE item_id=OLD.id;
+           END''']
 
     def __init__(self):
         """
             Create database tables or manage update if needed
         """
+        self.__version = 0
         f = Gio.File.new_for_path(self.DB_PATH)
         if not f.query_exists():
             try:
@@ -62,6 +132,27 @@ class DatabaseHistory:
                     sql.commit()
             except Exception as e:
                 print("DatabaseHistory::__init__(): %s" % e)
+        # Sync looks up history by guid and reads change log
+        try:
+            with SqlCursor(self) as sql:
+                sql.execute(self.__create_guid_idx)
+                sql.execute(self.__create_changes)
+                sql.execute(self.__create_changes_idx)
+                for trigger in self.__create_triggers:
+                    sql.execute(trigger)
+                sql.execute(self.__create_searches)
+                sql.execute(self.__create_words)
+                sql.execute(self.__create_words_trigrams)
+                sql.execute(self.__create_history_words)
+                sql.execute(self.__create_history_words_idx)
+                sql.execute(self.__create_words_progress)
+                sql.commit()
+            # Fill vocabulary for existing history, resume if interrupted
+            thread = Thread(target=self.__index_history)
+            thread.daemon = True
+            thread.start()
+        except Exception as e:
+            print("DatabaseHistory::__init__(): %s" % e)
 
     def add(self, title, uri, guid=None, atime=None, mtime=None, commit=True):
         """
@@ -72,6 +163,7 @@ class DatabaseHistory:
             @param mtime as int
             @param commit as bool
         """
+        self.__version += 1
         if not uri:
             return
         uri = uri.rstrip('/')
@@ -87,22 +179,26 @@ class DatabaseHistory:
             if self.exists_guid(guid):
                 guid = None
         with SqlCursor(self) as sql:
-            result = sql.execute("SELECT popularity, atime FROM history\
+            result = sql.execute("SELECT rowid, popularity, atime\
+                                  FROM history\
                                   WHERE uri=?", (uri,))
             v = result.fetchone()
             if v is not None:
                 # Never update history item with an older entry
-                if v[1] > atime:
+                if v[2] > atime:
                     return
                 sql.execute("UPDATE history set atime=?, mtime=?, title=?,\
                                  popularity=?, guid=?\
                              WHERE uri=?", (atime, mtime, title,
-                                            v[0]+1, guid, uri))
+                                            v[1]+1, guid, uri))
+                history_id = v[0]
             else:
-                sql.execute("INSERT INTO history\
+                result = sql.execute("INSERT INTO history\
                                   (title, uri, atime, mtime, popularity, guid)\
                                   VALUES (?, ?, ?, ?, ?, ?)",
-                            (title, uri, atime, mtime, 0, guid))
+                                     (title, uri, atime, mtime, 0, guid))
+                history_id = result.lastrowid
+            self.__index_words(sql, history_id, title, uri)
             if commit:
                 sql.commit()
 
@@ -111,19 +207,50 @@ class DatabaseHistory:
             Remove item from history
             @param history id as int
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("DELETE from history\
                          WHERE rowid=?", (history_id,))
+            # Forget words only this item used
+            self.__index_words(sql, history_id, "", "")
             sql.commit()
 
     def clear(self):
         """
             Clear history
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("DELETE from history")
+            sql.execute("DELETE from searches")
+            sql.execute("DELETE from words")
+            sql.execute("DELETE from words_trigrams")
+            sql.execute("DELETE from history_words")
+            sql.execute("DELETE from words_progress")
             sql.commit()
 
+    def add_search(self, words, atime):
+        """
+            Add searched words, if exists, update it
+            @param words as str
+            @param atime as int
+        """
+        with SqlCursor(self) as sql:
+            sql.execute("INSERT OR IGNORE INTO searches (words, count, atime)\
+                         VALUES (?, 0, ?)", (words, atime))
+            sql.execute("UPDATE searches SET count=count+1, atime=?\
+                         WHERE words=?", (atime, words))
+            sql.commit()
+
+    def get_searches(self):
+        """
+            Get searched words
+            @return [(str, int, int)] as [(words, count, atime)]
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT words, count, atime FROM searches")
+            return list(result)
+
     def get(self, atime):
         """
             Get history
@@ -258,6 +385,48 @@ class DatabaseHistory:
                                   WHERE mtime > ?", (mtime,))
             return list(itertools.chain(*result))
 
+    def get_changes(self):
+        """
+            Get history items changed since last acknowledgment
+            @return [(history id as int, guid as str, counter as int)]
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT item_id, guid, counter\
+                                  FROM changes ORDER BY counter")
+            return list(result)
+
+    def clear_changes(self):
+        """
+            Forget all changes, used when sync is not configured
+        """
+        with SqlCursor(self) as sql:
+            sql.execute("DELETE FROM changes")
+            sql.commit()
+
+    def ack_changes(self, counter, guids=None, commit=True):
+        """
+            Forget changes up to counter
+            Items changed again since have a greater counter
+            @param counter as int
+            @param guids as [str]/None: only forget these items
+            @param commit as bool
+        """
+        with SqlCursor(self) as sql:
+            if guids is None:
+                sql.execute("DELETE FROM changes WHERE counter<=?",
+                            (counter,))
+            else:
+                guids = list(guids)
+                # Stay below SQLite variables limit
+                for i in range(0, len(guids), 500):
+                    chunk = guids[i:i + 500]
+                    sql.execute("DELETE FROM changes\
+                                 WHERE counter<=? AND guid IN (%s)" %
+                                ",".join("?" * len(chunk)),
+                                [counter] + chunk)
+            if commit:
+                sql.commit()
+
     def set_title(self, history_id, title, commit=True):
         """
             Set history title
@@ -265,10 +434,16 @@ class DatabaseHistory:
             @param title as str
             @param commit as bool
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("UPDATE history\
                          SET title=?\
                          WHERE rowid=?", (title, history_id,))
+            result = sql.execute("SELECT uri FROM history\
+                                  WHERE rowid=?", (history_id,))
+            v = result.fetchone()
+            if v is not None:
+                self.__index_words(sql, history_id, title, v[0])
             if commit:
                 sql.commit()
 
@@ -279,6 +454,7 @@ class DatabaseHistory:
             @param atime as int
             @param commit as bool
         """
+        self.__version += 1
         with SqlCursor(self) as sql:
             sql.execute("UPDATE history\
                          SET atime=? where rowid=?", (atime, history_id))
@@ -316,6 +492,76 @@ class DatabaseHistory:
                                  (filter, filter, limit))
             return list(result)
 
+    def search_fuzzy(self, search, limit):
+        """
+            Search string in db (uri and title), tolerating typos
+            Items are ranked by trigram similarity of their words with
+            search words, then by popularity
+            Give up and return [] after __FUZZY_BUDGET seconds of scoring
+            @param search as str
+            @param limit as int
+            @return [(str, str)]
+            @raise sqlite3.OperationalError if interrupted
+        """
+        with SqlCursor(self) as sql:
+            # {word_id: similarity} per search word
+            matches = [self.__get_closest_words(sql, word)
+                       for word in self.__get_words(search)
+                       if len(word) >= 3]
+            if not matches or not all(matches):
+                return []
+            deadline = time() + self.__FUZZY_BUDGET
+            sql.set_progress_handler(lambda: time() > deadline, 1000)
+            try:
+                # Items must match all search words
+                scores = None
+                for closest in matches:
+                    word_scores = {}
+                    result = sql.execute("SELECT history_id, word_id\
+                                          FROM history_words\
+                                          WHERE word_id IN (%s)" %
+                                         ",".join("?" * len(closest)),
+                                         list(closest.keys()))
+                    for (history_id, word_id) in result:
+                        word_scores[history_id] = max(
+                                              word_scores.get(history_id, 0),
+                                              closest[word_id])
+                    if scores is None:
+                        scores = word_scores
+                    else:
+                        scores = {history_id: score + word_scores[history_id]
+                                  for (history_id, score) in scores.items()
+                                  if history_id in word_scores}
+                    if not scores:
+                        return []
+                best = sorted(scores.keys(), key=lambda history_id:
+                              scores[history_id],
+                              reverse=True)[:self.__FUZZY_CANDIDATES]
+                result = sql.execute("SELECT rowid, title, uri,\
+                                      popularity, atime\
+                                      FROM history\
+                                      WHERE rowid IN (%s)" %
+                                     ",".join("?" * len(best)), best)
+                items = sorted(result, key=lambda v: (scores[v[0]],
+                                                      v[3], v[4]),
+                               reverse=True)
+                return [(v[1], v[2]) for v in items[:limit]]
+            except sqlite3.OperationalError:
+                if time() > deadline:
+                    return []
+                raise
+            finally:
+                sql.set_progress_handler(None, 0)
+
+    def get_visits(self):
+        """
+            Get history uris with popularity and access time
+            @return [(str, int, int)]
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT uri, popularity, atime FROM history")
+            return list(result)
+
     def exists_guid(self, guid):
         """
             Check if guid exists in db
@@ -327,6 +573,17 @@ class DatabaseHistory:
             v = result.fetchone()
             return v is not None
 
+    @property
+    def version(self):
+        """
+            Get db version, changes on writes changing titles or ranking
+            data_version catches commits from other connections (sync)
+            @return (int, int)
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("PRAGMA data_version")
+            return (self.__version, result.fetchone()[0])
+
     def get_cursor(self):
         """
             Return a new sqlite cursor
@@ -335,6 +592,7 @@ class DatabaseHistory:
             c = sqlite3.connect(self.DB_PATH, 600.0)
             c.create_collation('LOCALIZED', LocalizedCollation())
             c.create_function("noaccents", 1, noaccents)
+            c.create_function("tracking", 0, is_changes_tracking)
             return c
         except:
             exit(-1)
@@ -352,3 +610,157 @@ class DatabaseHistory:
 #######################
 # PRIVATE             #
 #######################
+    def __normalize(self, string):
+        """
+            Get string in lower case without accents
+            @param string as str
+            @return str
+        """
+        if not string:
+            return ""
+        return noaccents(string.lower())
+
+    def __get_words(self, string):
+        """
+            Split string in lower case words without accents
+            @param string as str
+            @return [str]
+        """
+        return re.findall(r"[^\W_]+", self.__normalize(string))
+
+    def __get_index_words(self, title, uri):
+        """
+            Get vocabulary words for title and uri host labels
+            @param title as str
+            @param uri as str
+            @return set(str)
+        """
+        words = self.__get_words(title)
+        host = urlparse(uri).hostname
+        if host:
+            words += [label for label in self.__get_words(host)
+                      if label != "www"]
+        return set(word for word in words if 3 <= len(word) <= 30)
+
+    def __get_trigrams(self, word):
+        """
+            Get word trigrams, padded so first and last chars weigh more
+            @param word as str
+            @return set(str)
+        """
+        padded = " %s " % word
+        return set(padded[i:i + 3] for i in range(0, len(padded) - 2))
+
+    def __index_words(self, sql, history_id, title, uri):
+        """
+            Link history item to its title words and uri host labels
+            Words no longer used by any item are removed
+            @param sql as sqlite cursor
+            @param history_id as int
+            @param title as str
+            @param uri as str
+        """
+        result = sql.execute("SELECT word_id FROM history_words\
+                              WHERE history_id=?", (history_id,))
+        old = set(v[0] for v in result)
+        new = set()
+        for word in self.__get_index_words(title, uri):
+            trigrams = self.__get_trigrams(word)
+            result = sql.execute("INSERT OR IGNORE INTO words\
+                                  (word, trigrams) VALUES (?, ?)",
+                                 (word, len(trigrams)))
+            if result.rowcount == 1:
+                word_id = result.lastrowid
+                sql.executemany("INSERT OR IGNORE INTO words_trigrams\
+                                 (trigram, word_id) VALUES (?, ?)",
+                                [(trigram, word_id) for trigram in trigrams])
+            else:
+                result = sql.execute("SELECT id FROM words WHERE word=?",
+                                     (word,))
+                word_id = result.fetchone()[0]
+            new.add(word_id)
+        sql.executemany("INSERT OR IGNORE INTO history_words\
+                         (word_id, history_id) VALUES (?, ?)",
+                        [(word_id, history_id) for word_id in new - old])
+        sql.executemany("DELETE FROM history_words\
+                         WHERE word_id=? AND history_id=?",
+                        [(word_id, history_id) for word_id in old - new])
+        self.__prune_words(sql, old - new)
+
+    def __index_history(self):
+        """
+            Add history to vocabulary, from last indexed item
+            Items added meanwhile are indexed by add()
+            @thread safe
+        """
+        try:
+            with SqlCursor(self) as sql:
+                result = sql.execute("SELECT last FROM words_progress")
+                v = result.fetchone()
+                if v is None:
+                    last = 0
+                    sql.execute("INSERT INTO words_progress (last)\
+                                 VALUES (0)")
+                else:
+                    last = v[0]
+                while True:
+                    result = sql.execute("SELECT rowid, title, uri\
+                                          FROM history WHERE rowid>?\
+                                          ORDER BY rowid LIMIT 1000",
+                                         (last,))
+                    items = list(result)
+                    if not items:
+                        break
+                    for (rowid, title, uri) in items:
+                        self.__index_words(sql, rowid, title, uri)
+                    last = items[-1][0]
+                    sql.execute("UPDATE words_progress SET last=?", (last,))
+                    sql.commit()
+                sql.commit()
+        except Exception as e:
+            print("DatabaseHistory::__index_history():", e)
+
+    def __prune_words(self, sql, word_ids):
+        """
+            Remove words not used by history anymore from vocabulary
+            @param sql as sqlite cursor
+            @param word_ids as set(int)
+        """
+        for word_id in word_ids:
+            result = sql.execute("SELECT EXISTS(SELECT 1 FROM history_words\
+                                                WHERE word_id=?),\
+                                         word\
+                                  FROM words WHERE id=?",
+                                 (word_id, word_id))
+            v = result.fetchone()
+            if v is None or v[0]:
+                continue
+            sql.executemany("DELETE FROM words_trigrams\
+                             WHERE trigram=? AND word_id=?",
+                            [(trigram, word_id)
+                             for trigram in self.__get_trigrams(v[1])])
+            sql.execute("DELETE FROM words WHERE id=?", (word_id,))
+
+    def __get_closest_words(self, sql, word):
+        """
+            Get known words close to word
+            @param sql as sqlite cursor
+            @param word as str
+            @return {int: float} as {word_id: similarity}
+        """
+        trigrams = list(self.__get_trigrams(word))
+        result = sql.execute("SELECT words.id, words.trigrams, COUNT(*)\
+                              FROM words_trigrams, words\
+                              WHERE words_trigrams.trigram IN (%s)\
+                              AND words.id=words_trigrams.word_id\
+                              GROUP BY words_trigrams.word_id\
+                              ORDER BY COUNT(*) DESC LIMIT ?" %
+                             ",".join("?" * len(trigrams)),
+                             trigrams + [self.__FUZZY_WORDS])
+        closest = {}
+        for (word_id, count, shared) in result:
+            # Dice coefficient
+            similarity = 2 * shared / (count + len(trigrams))
+            if similarity >= self.__FUZZY_SIMILARITY:
+                closest[word_id] = similarity
+        return closest
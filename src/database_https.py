@@ -0,0 +1,277 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib
+
+import os
+import sqlite3
+from time import time
+from zlib import crc32
+from urllib.parse import urlparse
+from threading import Thread
+
+from eolie.sqlcursor import SqlCursor
+
+
+class DatabaseHttps:
+    """
+        Hosts known to serve https, http requests to them are upgraded
+        Filled from shipped list, local list and observed redirects
+        Shared with web extension, each process keeps hosts in memory and
+        reloads them when db file changes
+    """
+    if GLib.getenv("XDG_DATA_HOME") is None:
+        __LOCAL_PATH = GLib.get_home_dir() + "/.local/share/eolie"
+    else:
+        __LOCAL_PATH = GLib.getenv("XDG_DATA_HOME") + "/eolie"
+    DB_PATH = "%s/https.db" % __LOCAL_PATH
+    # Same format as shipped list, lets user update list offline
+    LOCAL_LIST_PATH = "%s/https-upgrade.txt" % __LOCAL_PATH
+    __SHIPPED_LIST_URI = "resource:///org/gnome/Eolie/https-upgrade.txt"
+
+    # Hosts sources
+    __SHIPPED = 0
+    __LOCAL = 1
+    __LEARNED = 2
+    # Learned hosts not seen redirecting again are forgotten (seconds)
+    __LEARNED_TTL = 2592000
+
+    # One row per source so a list update never drops another list hosts
+    # mtime: last time a learned host was seen redirecting
+    __create_hosts = '''CREATE TABLE hosts (
+                                        host TEXT NOT NULL,
+                                        subdomains INT NOT NULL,
+                                        source INT NOT NULL,
+                                        mtime INT NOT NULL DEFAULT 0,
+                                        PRIMARY KEY (host, source))
+                                        WITHOUT ROWID'''
+    # Checksum of last imported list per source
+    __create_lists = '''CREATE TABLE lists (
+                                        source INT PRIMARY KEY,
+                                        checksum INT NOT NULL)'''
+
+    def __init__(self):
+        """
+            Create database tables or manage update if needed
+        """
+        # Hosts, hosts including subdomains
+        self.__hosts = frozenset()
+        self.__parents = frozenset()
+        # Db file mtime when loaded, next learned host expiry
+        self.__mtime = None
+        self.__expire_at = 0
+        f = Gio.File.new_for_path(self.DB_PATH)
+        if not f.query_exists():
+            try:
+                d = Gio.File.new_for_path(self.__LOCAL_PATH)
+                if not d.query_exists():
+                    d.make_directory_with_parents()
+                # Create db schema
+                with SqlCursor(self) as sql:
+                    sql.execute(self.__create_hosts)
+                    sql.execute(self.__create_lists)
+                    sql.commit()
+            except Exception as e:
+                print("DatabaseHttps::__init__(): %s" % e)
+
+    def update(self):
+        """
+            Import shipped and local lists if changed
+        """
+        thread = Thread(target=self.__update)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, host):
+        """
+            Add host seen redirecting to https, if not in lists
+            @param host as str
+        """
+        try:
+            with SqlCursor(self) as sql:
+                sql.execute("INSERT OR IGNORE INTO hosts\
+                             (host, subdomains, source)\
+                             SELECT ?, 0, ? WHERE NOT EXISTS\
+                             (SELECT 1 FROM hosts\
+                              WHERE host=? AND source!=?)",
+                            (host, self.__LEARNED, host, self.__LEARNED))
+                sql.execute("UPDATE hosts SET mtime=?\
+                             WHERE host=? AND source=?",
+                            (int(time()), host, self.__LEARNED))
+                sql.commit()
+        except Exception as e:
+            print("DatabaseHttps::add():", e)
+
+    def remove_learned(self, host):
+        """
+            Forget host if learned, lists hosts are kept
+            @param host as str
+            @return True if host was learned
+        """
+        try:
+            with SqlCursor(self) as sql:
+                result = sql.execute("DELETE FROM hosts\
+                                      WHERE host=? AND source=?",
+                                     (host, self.__LEARNED))
+                sql.commit()
+                return result.rowcount > 0
+        except Exception as e:
+            print("DatabaseHttps::remove_learned():", e)
+            return False
+
+    def clear_learned(self):
+        """
+            Forget learned hosts, they come from browsing history
+        """
+        try:
+            with SqlCursor(self) as sql:
+                sql.execute("DELETE FROM hosts WHERE source=?",
+                            (self.__LEARNED,))
+                sql.commit()
+        except Exception as e:
+            print("DatabaseHttps::clear_learned():", e)
+
+    def is_upgradable(self, host):
+        """
+            True if host or a parent including subdomains is known
+            @param host as str
+            @return bool
+        """
+        self.__load()
+        if host in self.__hosts:
+            return True
+        labels = host.split(".")
+        for i in range(1, len(labels) - 1):
+            if ".".join(labels[i:]) in self.__parents:
+                return True
+        return False
+
+    def upgrade(self, uri):
+        """
+            Get https uri for uri if host is upgradable
+            @param uri as str
+            @return str
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme != "http" or not parsed.hostname or\
+                parsed.port not in [None, 80] or\
+                not self.is_upgradable(parsed.hostname):
+            return uri
+        netloc = parsed.netloc
+        if parsed.port == 80:
+            netloc = netloc[:-3]
+        return parsed._replace(scheme="https", netloc=netloc).geturl()
+
+    def get_cursor(self):
+        """
+            Return a new sqlite cursor
+        """
+        try:
+            c = sqlite3.connect(self.DB_PATH, 600.0)
+            return c
+        except Exception as e:
+            print(e)
+            exit(-1)
+
+#######################
+# PRIVATE             #
+#######################
+    def __load(self):
+        """
+            Load hosts in memory if db changed or a learned host expired
+        """
+        try:
+            mtime = os.stat(self.DB_PATH).st_mtime_ns
+        except:
+            return
+        now = time()
+        if mtime == self.__mtime and now < self.__expire_at:
+            return
+        self.__mtime = mtime
+        self.__expire_at = float("inf")
+        hosts = set()
+        parents = set()
+        try:
+            with SqlCursor(self) as sql:
+                result = sql.execute("SELECT host, subdomains, source, mtime\
+                                      FROM hosts")
+                for (host, subdomains, source, host_mtime) in result:
+                    if source == self.__LEARNED:
+                        expire_at = host_mtime + self.__LEARNED_TTL
+                        if expire_at < now:
+                            continue
+                        self.__expire_at = min(self.__expire_at, expire_at)
+                    hosts.add(host)
+                    if subdomains:
+                        parents.add(host)
+        except Exception as e:
+            print("DatabaseHttps::__load():", e)
+        self.__hosts = frozenset(hosts)
+        self.__parents = frozenset(parents)
+
+    def __update(self):
+        """
+            Import lists, forget expired learned hosts
+            @thread safe
+        """
+        try:
+            with SqlCursor(self) as sql:
+                sql.execute("DELETE FROM hosts WHERE source=? AND mtime<?",
+                            (self.__LEARNED, time() - self.__LEARNED_TTL))
+                sql.commit()
+        except Exception as e:
+            print("DatabaseHttps::__update():", e)
+        for (source, uri) in [(self.__SHIPPED, self.__SHIPPED_LIST_URI),
+                              (self.__LOCAL,
+                               GLib.filename_to_uri(self.LOCAL_LIST_PATH))]:
+            try:
+                f = Gio.File.new_for_uri(uri)
+                if not f.query_exists():
+                    continue
+                (status, content, tag) = f.load_contents(None)
+                self.__import(source, content)
+            except Exception as e:
+                print("DatabaseHttps::__update():", e)
+
+    def __import(self, source, content):
+        """
+            Replace hosts from source with list content if changed
+            Lines: "host" or "*.host" to include subdomains, "#" comments
+            @param source as int
+            @param content as bytes
+        """
+        checksum = crc32(content)
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT checksum FROM lists\
+                                  WHERE source=?", (source,))
+            v = result.fetchone()
+            if v is not None and v[0] == checksum:
+                return
+            hosts = []
+            for line in content.decode("utf-8").split("\n"):
+                line = line.split("#")[0].strip().lower()
+                if not line:
+                    continue
+                if line.startswith("*."):
+                    hosts.append((line[2:], 1, source))
+                else:
+                    hosts.append((line, 0, source))
+            sql.execute("DELETE FROM hosts WHERE source=?", (source,))
+            sql.executemany("INSERT OR REPLACE INTO hosts\
+                             (host, subdomains, source) VALUES (?, ?, ?)",
+                            hosts)
+            # Lists win over learned hosts
+            sql.executemany("DELETE FROM hosts WHERE host=? AND source=?",
+                            [(host[0], self.__LEARNED) for host in hosts])
+            sql.execute("INSERT OR REPLACE INTO lists (source, checksum)\
+                         VALUES (?, ?)", (source, checksum))
+            sql.commit()
@@ -0,0 +1,166 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib, Gio
+
+import sqlite3
+import itertools
+
+from eolie.sqlcursor import SqlCursor
+
+
+class DatabaseMirror:
+    """
+        Last known sync server state
+        One row per remote record: guid, modified time and payload hash
+    """
+    if GLib.getenv("XDG_DATA_HOME") is None:
+        __LOCAL_PATH = GLib.get_home_dir() + "/.local/share/eolie"
+    else:
+        __LOCAL_PATH = GLib.getenv("XDG_DATA_HOME") + "/eolie"
+    DB_PATH = "%s/mirror.db" % __LOCAL_PATH
+
+    # SQLite limits host parameters per query
+    __CHUNK_SIZE = 500
+
+    __create_mirror = '''CREATE TABLE mirror (
+                                        id INTEGER PRIMARY KEY,
+                                        collection TEXT NOT NULL,
+                                        guid TEXT NOT NULL,
+                                        modified REAL NOT NULL,
+                                        hash TEXT NOT NULL)'''
+    __create_mirror_idx = '''CREATE UNIQUE INDEX idx_mirror ON mirror(
+                                        collection, guid)'''
+    __create_collections = '''CREATE TABLE collections (
+                                        id INTEGER PRIMARY KEY,
+                                        name TEXT NOT NULL UNIQUE,
+                                        modified REAL NOT NULL)'''
+
+    def __init__(self):
+        """
+            Create database tables or manage update if needed
+        """
+        f = Gio.File.new_for_path(self.DB_PATH)
+        if not f.query_exists():
+            try:
+                d = Gio.File.new_for_path(self.__LOCAL_PATH)
+                if not d.query_exists():
+                    d.make_directory_with_parents()
+                # Create db schema
+                with SqlCursor(self) as sql:
+                    sql.execute(self.__create_mirror)
+                    sql.execute(self.__create_mirror_idx)
+                    sql.execute(self.__create_collections)
+                    sql.commit()
+            except Exception as e:
+                print("DatabaseMirror::__init__(): %s" % e)
+
+    def get_mtimes(self):
+        """
+            Get collections last sync time
+            @return {str: float}
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT name, modified FROM collections")
+            return dict(result)
+
+    def set_mtimes(self, mtimes, commit=True):
+        """
+            Set collections last sync time
+            @param mtimes as {str: float}
+            @param commit as bool
+        """
+        with SqlCursor(self) as sql:
+            sql.executemany("INSERT OR REPLACE INTO collections\
+                             (name, modified) VALUES (?, ?)",
+                            mtimes.items())
+            if commit:
+                sql.commit()
+
+    def get_guids(self, collection):
+        """
+            Get all known guids for collection
+            @param collection as str
+            @return set(str)
+        """
+        with SqlCursor(self) as sql:
+            result = sql.execute("SELECT guid FROM mirror\
+                                  WHERE collection=?", (collection,))
+            return set(itertools.chain(*result))
+
+    def get_hashes(self, collection, guids):
+        """
+            Get payload hashes for guids
+            @param collection as str
+            @param guids as [str]
+            @return {str: str}
+        """
+        hashes = {}
+        with SqlCursor(self) as sql:
+            for i in range(0, len(guids), self.__CHUNK_SIZE):
+                chunk = guids[i:i + self.__CHUNK_SIZE]
+                result = sql.execute("SELECT guid, hash FROM mirror\
+                                      WHERE collection=?\
+                                      AND guid IN (%s)" %
+                                     ",".join("?" * len(chunk)),
+                                     [collection] + chunk)
+                hashes.update(result)
+        return hashes
+
+    def update(self, collection, records, commit=True):
+        """
+            Add or update records
+            @param collection as str
+            @param records as [(guid, modified, hash)]
+            @param commit as bool
+        """
+        with SqlCursor(self) as sql:
+            sql.executemany("INSERT OR REPLACE INTO mirror\
+                             (collection, guid, modified, hash)\
+                             VALUES (?, ?, ?, ?)",
+                            [(collection,) + record for record in records])
+            if commit:
+                sql.commit()
+
+    def remove(self, collection, guids, commit=True):
+        """
+            Remove records
+            @param collection as str
+            @param guids as [str]
+            @param commit as bool
+        """
+        with SqlCursor(self) as sql:
+            sql.executemany("DELETE FROM mirror\
+                             WHERE collection=? AND guid=?",
+                            [(collection, guid) for guid in guids])
+            if commit:
+                sql.commit()
+
+    def clear(self):
+        """
+            Forget server state
+        """
+        with SqlCursor(self) as sql:
+            sql.execute("DELETE FROM mirror")
+            sql.execute("DELETE FROM collections")
+            sql.commit()
+
+    def get_cursor(self):
+        """
+            Return a new sqlite cursor
+        """
+        try:
+            c = sqlite3.connect(self.DB_PATH, 600.0)
+            return c
+        except Exception as e:
+            print(e)
+            exit(-1)
@@ -10,7 +10,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gio
+from gi.repository import Gio, GLib
 
 El = Gio.Application.get_default
 
@@ -37,3 +37,5 @@ class Type:
 
 LOGINS = ["login", "username", "user", "mail", "email"]
 PASSWORDS = ["password", "passwd", "pass"]
+# Web extension writes its pid in this directory, one file per page id
+PAGES_PATH = "%s/eolie/pages" % GLib.get_user_runtime_dir()
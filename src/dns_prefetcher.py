@@ -0,0 +1,91 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import WebKit2
+
+from time import time
+from urllib.parse import urlparse
+
+from eolie.utils import debug
+
+
+class DnsPrefetcher:
+    """
+        Resolve hosts user is likely to load before navigation starts
+        Counts navigations to prefetched hosts for the session
+    """
+    # A prefetched host is considered resolved this long (seconds)
+    __TTL = 60
+
+    def __init__(self):
+        """
+            Init prefetcher
+        """
+        # host: prefetch time
+        self.__hosts = {}
+        self.__prefetched = 0
+        self.__navigations = 0
+        self.__hits = 0
+
+    def prefetch(self, uri):
+        """
+            Prefetch uri host
+            @param uri as str
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme in ["http", "https"]:
+            self.prefetch_host(parsed.hostname)
+
+    def prefetch_host(self, host):
+        """
+            Prefetch host if not done recently
+            @param host as str
+        """
+        if not host:
+            return
+        now = time()
+        if now - self.__hosts.get(host, 0) < self.__TTL:
+            return
+        # Forget expired hosts
+        if len(self.__hosts) > 1000:
+            self.__hosts = {key: value for (key, value) in self.__hosts.items()
+                            if now - value < self.__TTL}
+        self.__hosts[host] = now
+        self.__prefetched += 1
+        context = WebKit2.WebContext.get_default()
+        context.prefetch_dns(host)
+
+    def add_navigation(self, uri):
+        """
+            Count a navigation, hit if host was prefetched
+            @param uri as str
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme not in ["http", "https"]:
+            return
+        self.__navigations += 1
+        if time() - self.__hosts.get(parsed.hostname, 0) < self.__TTL:
+            self.__hits += 1
+        debug("DnsPrefetcher: %s" % self.stats)
+
+    @property
+    def stats(self):
+        """
+            Get session statistics
+            @return {"prefetched": int, "navigations": int,
+                     "hits": int, "hit_rate": float}
+        """
+        return {"prefetched": self.__prefetched,
+                "navigations": self.__navigations,
+                "hits": self.__hits,
+                "hit_rate": self.__hits / self.__navigations
+                if self.__navigations else 0.0}
@@ -0,0 +1,134 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+import sqlite3
+from urllib.parse import urlparse
+from threading import Thread
+
+from eolie.define import El
+from eolie.utils import debug
+
+
+class FaviconResolver:
+    """
+        Find a page uri known by WebKit favicon database for an uri
+        Page uris are loaded once from WebpageIcons.db then kept in memory
+    """
+    # Max uris kept in negative cache
+    __NEGATIVE_SIZE = 1000
+
+    def __init__(self):
+        """
+            Init resolver, database is read in background
+        """
+        # netloc + path: page uri, netloc: page uri
+        self.__pages = {}
+        self.__hosts = {}
+        # Uris without favicon, netloc: set(uri)
+        self.__negative = {}
+        self.__negative_count = 0
+        self.__loaded = False
+        thread = Thread(target=self.__load)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, uri):
+        """
+            Get best page uri to query favicon database with
+            Same page first, then any page on same host
+            @param uri as str
+            @return str/None
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme not in ["http", "https"]:
+            return None
+        if uri in self.__negative.get(parsed.netloc, ()):
+            return None
+        favicon_uri = self.__pages.get(parsed.netloc + parsed.path.rstrip("/"))
+        if favicon_uri is None:
+            favicon_uri = self.__hosts.get(parsed.netloc)
+        # Only trust misses once database is loaded
+        if favicon_uri is None and self.__loaded:
+            self.__add_negative(parsed.netloc, uri)
+        return favicon_uri
+
+    def add(self, uri):
+        """
+            Page uri now has a favicon in database
+            @param uri as str
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme not in ["http", "https"]:
+            return
+        self.__pages[parsed.netloc + parsed.path.rstrip("/")] = uri
+        self.__hosts.setdefault(parsed.netloc, uri)
+        # Other uris on this host may now resolve
+        uris = self.__negative.pop(parsed.netloc, None)
+        if uris is not None:
+            self.__negative_count -= len(uris)
+
+#######################
+# PRIVATE             #
+#######################
+    def __add_negative(self, netloc, uri):
+        """
+            Remember uri has no favicon, forget oldest hosts if full
+            @param netloc as str
+            @param uri as str
+        """
+        uris = self.__negative.setdefault(netloc, set())
+        if uri in uris:
+            return
+        uris.add(uri)
+        self.__negative_count += 1
+        while self.__negative_count > self.__NEGATIVE_SIZE:
+            oldest = next(iter(self.__negative))
+            self.__negative_count -= len(self.__negative.pop(oldest))
+
+    def __load(self):
+        """
+            Read page uris from favicon database
+            @thread safe
+        """
+        pages = {}
+        hosts = {}
+        try:
+            sql = sqlite3.connect(El().favicons_path, 600.0)
+            for (uri,) in sql.execute("SELECT url FROM PageURL"):
+                parsed = urlparse(uri)
+                if parsed.scheme not in ["http", "https"]:
+                    continue
+                pages[parsed.netloc + parsed.path.rstrip("/")] = uri
+                hosts.setdefault(parsed.netloc, uri)
+            sql.close()
+        except Exception as e:
+            print("FaviconResolver::__load():", e)
+        GLib.idle_add(self.__set_loaded, pages, hosts)
+
+    def __set_loaded(self, pages, hosts):
+        """
+            Merge loaded uris, uris added meanwhile win
+            @param pages as {str: str}
+            @param hosts as {str: str}
+        """
+        pages.update(self.__pages)
+        for (host, uri) in self.__hosts.items():
+            hosts.setdefault(host, uri)
+        self.__pages = pages
+        self.__hosts = hosts
+        self.__negative = {}
+        self.__negative_count = 0
+        self.__loaded = True
+        debug("FaviconResolver: %s pages, %s hosts" % (len(pages),
+                                                       len(hosts)))
@@ -0,0 +1,178 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+from time import time
+from heapq import nlargest
+from urllib.parse import urlparse
+from threading import Thread
+
+from eolie.define import El
+from eolie.utils import debug
+
+
+class HostTrie:
+    """
+        Prefix trie of visited hosts for URL bar inline completion
+        Each node keeps its best host so lookups only walk the prefix
+        Hosts are weighted by frecency: visits decayed by age
+    """
+    # Visits weight is halved every 30 days
+    __HALF_LIFE = 2592000
+    # Hosts resolved at startup
+    __WARM_COUNT = 10
+    # Node: [children, best weight, best host]
+    __CHILDREN = 0
+    __WEIGHT = 1
+    __HOST = 2
+
+    def __init__(self):
+        """
+            Init trie, history and bookmarks are read in background
+        """
+        self.__root = [{}, 0, None]
+        # host: weight
+        self.__weights = {}
+        # Loads started before a clear are ignored
+        self.__generation = 0
+        self.__start_load()
+
+    def clear(self):
+        """
+            Forget hosts, reload from bookmarks and remaining history
+        """
+        self.__root = [{}, 0, None]
+        self.__weights = {}
+        self.__generation += 1
+        self.__start_load()
+
+    def add(self, uri):
+        """
+            Count a visit to uri host
+            @param uri as str
+        """
+        for host in self.__get_hosts(uri):
+            weight = self.__weights.get(host, 0) + 1
+            self.__weights[host] = weight
+            self.__insert(self.__root, host, weight)
+
+    def get(self, prefix):
+        """
+            Get best host starting with prefix
+            @param prefix as str
+            @return str/None
+        """
+        node = self.__root
+        for char in prefix.lower():
+            node = node[self.__CHILDREN].get(char)
+            if node is None:
+                return None
+        host = node[self.__HOST]
+        if host is None or len(host) == len(prefix):
+            return None
+        return host
+
+    def get_top(self, limit):
+        """
+            Get best hosts
+            @param limit as int
+            @return [str]
+        """
+        # Drop keys without www. when host has it
+        hosts = [host for host in self.__weights.keys()
+                 if "www." + host not in self.__weights]
+        return nlargest(limit, hosts, key=lambda host: self.__weights[host])
+
+#######################
+# PRIVATE             #
+#######################
+    def __start_load(self):
+        """
+            Load trie in background
+        """
+        thread = Thread(target=self.__load, args=(self.__generation,))
+        thread.daemon = True
+        thread.start()
+
+    def __get_hosts(self, uri):
+        """
+            Get trie keys for uri: host with and without www.
+            @param uri as str
+            @return [str]
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme not in ["http", "https"] or not parsed.hostname:
+            return []
+        host = parsed.hostname
+        if host.startswith("www."):
+            return [host[4:], host]
+        return [host]
+
+    def __insert(self, root, host, weight):
+        """
+            Insert host, update best host on its path
+            @param root as node
+            @param host as str
+            @param weight as float
+        """
+        node = root
+        for char in host:
+            children = node[self.__CHILDREN]
+            child = children.get(char)
+            if child is None:
+                child = [{}, 0, None]
+                children[char] = child
+            node = child
+            if weight > node[self.__WEIGHT] or node[self.__HOST] == host:
+                node[self.__WEIGHT] = weight
+                node[self.__HOST] = host
+
+    def __load(self, generation):
+        """
+            Build trie from history and bookmarks
+            @param generation as int
+            @thread safe
+        """
+        try:
+            now = time()
+            weights = {}
+            for (uri, popularity, atime) in El().history.get_visits() +\
+                    El().bookmarks.get_visits():
+                decay = 0.5 ** (max(0, now - atime) / self.__HALF_LIFE)
+                for host in self.__get_hosts(uri):
+                    weights[host] = weights.get(host, 0) +\
+                        (popularity + 1) * decay
+            root = [{}, 0, None]
+            for (host, weight) in weights.items():
+                self.__insert(root, host, weight)
+            GLib.idle_add(self.__set_loaded, root, weights, generation)
+        except Exception as e:
+            print("HostTrie::__load():", e)
+
+    def __set_loaded(self, root, weights, generation):
+        """
+            Use loaded trie, add visits done meanwhile
+            @param root as node
+            @param weights as {str: float}
+            @param generation as int
+        """
+        if generation != self.__generation:
+            return
+        for (host, weight) in self.__weights.items():
+            weights[host] = weights.get(host, 0) + weight
+            self.__insert(root, host, weights[host])
+        self.__root = root
+        self.__weights = weights
+        debug("HostTrie: %s hosts" % len(weights))
+        for host in self.get_top(self.__WARM_COUNT):
+            El().prefetcher.prefetch_host(host)
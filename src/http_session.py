@@ -0,0 +1,134 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Soup
+
+from weakref import WeakSet
+from threading import Lock, local
+
+
+class HttpSession:
+    """
+        Shared HTTP sessions: connections are kept alive and pooled per host
+        Soup session is used by GNOME code, requests session by sync code
+        requests sessions are not thread safe, one is created per thread
+    """
+    __MAX_CONNS = 20
+    __MAX_CONNS_PER_HOST = 4
+    __MAX_POOLS = 10
+
+    def __init__(self):
+        """
+            Init sessions
+        """
+        self.__lock = Lock()
+        self.__local = local()
+        # Alive threads requests sessions, for stats
+        self.__requests = WeakSet()
+        self.__soup_created = 0
+        self.__soup_queued = 0
+        self.__soup = Soup.Session.new()
+        self.__soup.set_property("accept-language-auto", True)
+        self.__soup.set_property("max-conns", self.__MAX_CONNS)
+        self.__soup.set_property("max-conns-per-host",
+                                 self.__MAX_CONNS_PER_HOST)
+        self.__soup.connect("connection-created",
+                            self.__on_soup_connection_created)
+        self.__soup.connect("request-queued", self.__on_soup_request_queued)
+
+    def read(self, uri, cancellable):
+        """
+            Read uri content with shared soup session
+            @param uri as str
+            @param cancellable as Gio.Cancellable
+            @return bytes
+            @raise GLib.Error
+            @thread safe
+        """
+        request = self.__soup.request(uri)
+        stream = request.send(cancellable)
+        bytes = bytearray(0)
+        buf = stream.read_bytes(65536, cancellable).get_data()
+        while buf:
+            bytes += buf
+            buf = stream.read_bytes(65536, cancellable).get_data()
+        stream.close(None)
+        return bytes
+
+    @property
+    def soup(self):
+        """
+            Get shared soup session
+            @return Soup.Session
+        """
+        return self.__soup
+
+    @property
+    def requests(self):
+        """
+            Get current thread requests session, created on first use
+            @return requests.Session
+            @thread safe
+        """
+        session = getattr(self.__local, "requests", None)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.__MAX_POOLS,
+                                  pool_maxsize=self.__MAX_CONNS_PER_HOST)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.__local.requests = session
+            with self.__lock:
+                self.__requests.add(session)
+        return session
+
+    @property
+    def stats(self):
+        """
+            Get connections opened vs reused
+            @return {"opened": int, "reused": int}
+        """
+        opened = self.__soup_created
+        requests = self.__soup_queued
+        with self.__lock:
+            sessions = list(self.__requests)
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    opened += pool.num_connections
+                    requests += pool.num_requests
+        return {"opened": opened, "reused": max(0, requests - opened)}
+
+#######################
+# PRIVATE             #
+#######################
+    def __on_soup_connection_created(self, session, connection):
+        """
+            Count new connection
+            @param session as Soup.Session
+            @param connection as GObject.Object
+        """
+        self.__soup_created += 1
+
+    def __on_soup_request_queued(self, session, message):
+        """
+            Count new request
+            @param session as Soup.Session
+            @param message as Soup.Message
+        """
+        self.__soup_queued += 1
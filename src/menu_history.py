@@ -49,6 +49,10 @@ class HistoryMenu(Gio.Menu):
             item = Gio.MenuItem.new(title, "app.%s" % encoded)
             item.set_attribute_value("uri", GLib.Variant("s", uri))
             # Try to set icon
+            surface = self.__app.art.get_favicon(uri)
+            if surface is not None:
+                self.__set_icon(item, uri, surface)
+                continue
             context = WebKit2.WebContext.get_default()
             favicon_db = context.get_favicon_database()
             favicon_db.get_favicon(uri, None,
@@ -80,6 +84,17 @@ class HistoryMenu(Gio.Menu):
             surface = db.get_favicon_finish(result)
         except:
             surface = None
+        if surface is not None:
+            surface = self.__app.art.add_favicon(uri, surface)
+        self.__set_icon(item, uri, surface)
+
+    def __set_icon(self, item, uri, surface):
+        """
+            Set item icon and append it
+            @param item as Gio.MenuItem
+            @param uri as str
+            @param surface as cairo.surface/None
+        """
         if surface is not None:
             pixbuf = Gdk.pixbuf_get_from_surface(surface,
                                                  0,
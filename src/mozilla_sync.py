@@ -11,9 +11,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gio, Secret
+from gi.repository import Gio, GLib, Secret
 
-from pickle import dump, load
 from hashlib import sha256
 from binascii import hexlify
 import json
@@ -21,28 +20,42 @@ import six
 import hmac
 import base64
 import math
-import requests
-from time import time
+from time import time, process_time
 from Crypto.Cipher import AES
 from Crypto import Random
 from requests_hawk import HawkAuth
 from fxa.core import Client as FxAClient, Session as FxASession
 from fxa.crypto import quick_stretch_password
-from threading import Thread
+from threading import Thread, Lock, Condition
+from collections import OrderedDict
 
 from eolie.define import El
-from eolie.utils import debug
+from eolie.utils import debug, set_changes_tracking
 from eolie.sqlcursor import SqlCursor
+from eolie.database_mirror import DatabaseMirror
 
 
 TOKENSERVER_URL = "https://token.services.mozilla.com/"
 FXA_SERVER_URL = "https://api.accounts.firefox.com"
+# Refresh tokens a bit before server expiry
+TOKEN_EXPIRY_MARGIN = 60
+# Max records per POST allowed by sync server
+MAX_POST_RECORDS = 100
 
 
 class SyncWorker:
     """
        Manage sync with mozilla server, will start syncing on init
     """
+    # History queue is flushed after this delay or when this size is reached
+    __FLUSH_DELAY = 10
+    __FLUSH_SIZE = 50
+    # Failed or impossible flush is retried after this delay
+    __RETRY_DELAY = 60
+    # Sync often if there was local activity recently, else rarely
+    __SHORT_INTERVAL = 300
+    __LONG_INTERVAL = 3600
+    __ACTIVITY_DELAY = 900
 
     def __init__(self):
         """
@@ -52,17 +65,39 @@ class SyncWorker:
         self.__mtimes = {"bookmarks": 0.1, "history": 0.1}
         self.__status = False
         self.__client = MozillaSync()
+        self.__mirror = DatabaseMirror()
         self.__session = None
+        self.__lock = Lock()
+        # Queue and sync threads both flush history
+        self.__flush_lock = Lock()
+        # Username/password are read by queue and sync threads
+        self.__secrets_lock = Lock()
+        self.__username = ""
+        self.__password = ""
+        self.__credentials = None
+        self.__bulk_keys = None
+        self.__token_loaded = False
+        self.__queue = OrderedDict()
+        self.__queue_condition = Condition()
+        self.__queue_thread = None
+        self.__apply_time = 0
+        self.__last_activity = 0
+        self.__backoff_until = 0
+        self.__timeout_id = None
 
     def sync(self, first_sync=False):
         """
             Start syncing, you need to check sync_status property
+            Next sync is scheduled when done
             @param first_sync as bool
         """
         if self.syncing:
             return True
-        self.__username = ""
-        self.__password = ""
+        if time() < self.__backoff_until:
+            debug("Server asked to back off, not syncing")
+            self.__schedule_sync()
+            return True
+        self.__set_secrets("", "")
         self.__stop = False
         Secret.Service.get(Secret.ServiceFlags.NONE, None,
                            self.__on_get_secret, first_sync, False)
@@ -71,31 +106,41 @@ class SyncWorker:
     def push_history(self, history_id):
         """
             Add history id to remote history
+            Pushes are queued and uploaded in batch
             A first call to sync() is needed to populate secrets
             @param history_id as int
         """
-        if Gio.NetworkMonitor.get_default().get_network_available():
-            thread = Thread(target=self.__push_history, args=(history_id,))
-            thread.daemon = True
-            thread.start()
+        self.__last_activity = time()
+        # No sync account, nothing to push
+        if not self.__has_secrets():
+            return
+        guid = El().history.get_guid(history_id)
+        if guid:
+            self.__queue_history(guid, history_id)
 
     def remove_from_history(self, guid):
         """
             Remove history id from remote history
+            Removals are queued and uploaded in batch
             A first call to sync() is needed to populate secrets
             @param guid as str
         """
-        if Gio.NetworkMonitor.get_default().get_network_available():
-            thread = Thread(target=self.__remove_from_history, args=(guid,))
-            thread.daemon = True
-            thread.start()
+        self.__last_activity = time()
+        if not self.__has_secrets():
+            return
+        self.__queue_history(guid, None)
 
     def delete_secret(self):
         """
             Delete sync secret
         """
-        self.__username = ""
-        self.__password = ""
+        self.__set_secrets("", "")
+        self.__session = None
+        self.__invalidate_credentials()
+        self.__mirror.clear()
+        Secret.password_clear(self.__get_token_schema(),
+                              {"sync": "mozilla_token"},
+                              None, None, None)
         Secret.Service.get(Secret.ServiceFlags.NONE, None,
                            self.__on_get_secret, False, True)
 
@@ -104,6 +149,9 @@ class SyncWorker:
             Stop update
         """
         self.__stop = True
+        if self.__timeout_id is not None:
+            GLib.source_remove(self.__timeout_id)
+            self.__timeout_id = None
 
     @property
     def mtimes(self):
@@ -129,6 +177,30 @@ class SyncWorker:
         """
         return self.__status
 
+    @property
+    def apply_time(self):
+        """
+            CPU time spent applying pulled records to local db
+            @return float
+        """
+        return self.__apply_time
+
+    @property
+    def decrypt_time(self):
+        """
+            CPU time spent decrypting pulled records
+            @return float
+        """
+        return self.__client.decrypt_time
+
+    @property
+    def queue_depth(self):
+        """
+            Count of history items waiting to be pushed
+            @return int
+        """
+        return len(self.__queue)
+
     @property
     def username(self):
         """
@@ -143,14 +215,39 @@ class SyncWorker:
     def __get_session_bulk_keys(self):
         """
             Get a session decrypt keys
+            Cached until tokenserver credentials expire
+            @return keys as (b"", b"")
+        """
+        with self.__lock:
+            if not self.__token_loaded:
+                self.__token_loaded = True
+                self.__load_credentials()
+            if self.__bulk_keys is not None and\
+                    self.__credentials is not None and\
+                    self.__credentials["expires"] > time():
+                if self.__client.credentials is None:
+                    self.__client.restore(self.__credentials)
+                self.__status = True
+                return self.__bulk_keys
+            bulk_keys = self.__get_new_session_bulk_keys()
+            self.__credentials = self.__client.credentials
+            self.__bulk_keys = bulk_keys
+            self.__save_credentials()
+            return bulk_keys
+
+    def __get_new_session_bulk_keys(self):
+        """
+            Get a session decrypt keys from tokenserver
             @return keys as (b"", b"")
         """
         if self.__session is None:
-            self.__session = FxASession(self.__client.client,
-                                        self.__username,
-                                        quick_stretch_password(
-                                                        self.__username,
-                                                        self.__password),
+            with self.__secrets_lock:
+                username = self.__username
+                password = self.__password
+            self.__session = FxASession(FxAClient(),
+                                        username,
+                                        quick_stretch_password(username,
+                                                               password),
                                         self.__uid,
                                         self.__token)
             self.__session.keys = [b"", self.__keyB]
@@ -165,60 +262,262 @@ class SyncWorker:
             raise e
         return bulk_keys
 
-    def __push_history(self, history_id):
+    def __get_token_schema(self):
         """
-            Push history
-            @param history_id as int
+            Get secret schema for cached tokenserver credentials
+            @return Secret.Schema
+        """
+        SecretSchema = {
+            "sync": Secret.SchemaAttributeType.STRING,
+            "login": Secret.SchemaAttributeType.STRING
+        }
+        return Secret.Schema.new("org.gnome.Eolie",
+                                 Secret.SchemaFlags.NONE,
+                                 SecretSchema)
+
+    def __load_credentials(self):
+        """
+            Load cached credentials and bulk keys from secret service
+            @thread safe
         """
-        if not self.__username or not self.__password:
-            self.__stop = True
-            return
         try:
-            bulk_keys = self.__get_session_bulk_keys()
-            record = {}
-            record["histUri"] = El().history.get_uri(history_id)
-            record["id"] = El().history.get_guid(history_id)
-            record["title"] = El().history.get_title(history_id)
-            atime = 1000000 * El().history.get_atime(history_id)
-            record["visits"] = [{"date": atime, "type": 1}]
-            debug("pushing %s" % record)
-            self.__client.add_history(record, bulk_keys)
+            secret = Secret.password_lookup_sync(self.__get_token_schema(),
+                                                 {"sync": "mozilla_token",
+                                                  "login": self.__username},
+                                                 None)
+            if secret is None:
+                return
+            cache = json.loads(secret)
+            self.__credentials = cache["credentials"]
+            self.__bulk_keys = KeyBundle(base64.b64decode(cache["keys"][0]),
+                                         base64.b64decode(cache["keys"][1]))
         except Exception as e:
-            print("SyncWorker::__push_history():", e)
-        self.__stop = True
+            print("SyncWorker::__load_credentials():", e)
 
-    def __remove_from_history(self, guid):
+    def __save_credentials(self):
+        """
+            Save credentials and bulk keys to secret service
+            @thread safe
+        """
+        try:
+            keys = [base64.b64encode(self.__bulk_keys.encryption_key),
+                    base64.b64encode(self.__bulk_keys.hmac_key)]
+            cache = {"credentials": self.__credentials,
+                     "keys": [key.decode("utf-8") for key in keys]}
+            Secret.password_store_sync(self.__get_token_schema(),
+                                       {"sync": "mozilla_token",
+                                        "login": self.__username},
+                                       Secret.COLLECTION_DEFAULT,
+                                       "org.gnome.Eolie.sync.token",
+                                       json.dumps(cache),
+                                       None)
+        except Exception as e:
+            print("SyncWorker::__save_credentials():", e)
+
+    def __invalidate_credentials(self):
+        """
+            Forget cached credentials, next call will ask tokenserver
+        """
+        self.__credentials = None
+        self.__bulk_keys = None
+        self.__token_loaded = True
+        self.__client.reset()
+
+    def __has_secrets(self):
+        """
+            True if we can talk to sync server: password loaded or
+            cached credentials available
+            @return bool
+        """
+        with self.__secrets_lock:
+            return bool(self.__username) and\
+                (bool(self.__password) or self.__bulk_keys is not None)
+
+    def __set_secrets(self, username, password):
+        """
+            Set username and password
+            @param username as str
+            @param password as str
+            @thread safe
         """
-            Remove from history
+        with self.__secrets_lock:
+            self.__username = username
+            self.__password = password
+
+    def __is_unauthorized(self, exception):
+        """
+            True if exception is an HTTP 401
+            @param exception as Exception
+            @return bool
+        """
+        response = getattr(exception, "response", None)
+        return response is not None and response.status_code == 401
+
+    def __queue_history(self, guid, history_id):
+        """
+            Queue history item, replacing any pending change for guid
             @param guid as str
+            @param history_id as int/None (None means removal)
+        """
+        with self.__queue_condition:
+            self.__queue.pop(guid, None)
+            self.__queue[guid] = history_id
+            if self.__queue_thread is None:
+                self.__queue_thread = Thread(target=self.__queue_worker)
+                self.__queue_thread.daemon = True
+                self.__queue_thread.start()
+            self.__queue_condition.notify()
+
+    def __queue_worker(self):
+        """
+            Flush history queue on timer or when big enough
+            Never before retry delay or server backoff
+            @thread safe
+        """
+        retry_at = 0
+        while True:
+            with self.__queue_condition:
+                while not self.__queue:
+                    self.__queue_condition.wait()
+                deadline = time() + self.__FLUSH_DELAY
+                while True:
+                    not_before = max(retry_at, self.__backoff_until)
+                    if len(self.__queue) < self.__FLUSH_SIZE:
+                        wake = max(deadline, not_before)
+                    else:
+                        wake = not_before
+                    remaining = wake - time()
+                    if remaining <= 0:
+                        break
+                    self.__queue_condition.wait(remaining)
+                items = self.__queue
+                self.__queue = OrderedDict()
+            network = Gio.NetworkMonitor.get_default()
+            available = network.get_network_available()
+            if available and self.__flush_history(items):
+                retry_at = 0
+            else:
+                if not available:
+                    self.__requeue_history(items)
+                retry_at = time() + self.__RETRY_DELAY
+            self.__update_backoff()
+
+    def __requeue_history(self, items):
         """
-        if not self.__username or not self.__password:
-            self.__stop = True
-            return
+            Put back items in queue, newer changes win
+            @param items as OrderedDict
+        """
+        with self.__queue_condition:
+            for guid, history_id in items.items():
+                if guid not in self.__queue:
+                    self.__queue[guid] = history_id
+                    self.__queue.move_to_end(guid, False)
+
+    def __flush_history(self, items):
+        """
+            Push queued history items and logged changes in batch
+            Items that could not be pushed are kept for next flush
+            @param items as OrderedDict
+            @return True if flushed
+            @thread safe
+        """
+        with self.__flush_lock:
+            return self.__push_history(items)
+
+    def __push_history(self, items):
+        """
+            Push history items and logged changes
+            @param items as OrderedDict
+            @return True if pushed
+        """
+        if not self.__has_secrets():
+            # Removals are not logged, keep them for next flush
+            self.__requeue_history(items)
+            return False
         try:
-            debug("deleting %s" % guid)
-            self.__client.client.delete_record("history", guid)
+            # Changes not pushed yet, may come from a previous session
+            changes = El().history.get_changes()
+            for (history_id, guid, counter) in changes:
+                if guid not in items:
+                    items[guid] = history_id
+            if not items:
+                return True
+            bulk_keys = self.__get_session_bulk_keys()
+            records = []
+            deleted = []
+            for guid, history_id in items.items():
+                if history_id is None:
+                    deleted.append(guid)
+                    continue
+                record = {}
+                record["histUri"] = El().history.get_uri(history_id)
+                if not record["histUri"]:
+                    continue
+                record["id"] = guid
+                record["title"] = El().history.get_title(history_id)
+                atime = 1000000 * El().history.get_atime(history_id)
+                record["visits"] = [{"date": atime, "type": 1}]
+                records.append(record)
+            debug("pushing %s history items, deleting %s" % (
+                                                           len(records),
+                                                           len(deleted)))
+            try:
+                pushed = self.__client.add_histories(records, bulk_keys)
+            except Exception as e:
+                if not self.__is_unauthorized(e):
+                    raise e
+                self.__invalidate_credentials()
+                bulk_keys = self.__get_session_bulk_keys()
+                pushed = self.__client.add_histories(records, bulk_keys)
+            for i in range(0, len(deleted), MAX_POST_RECORDS):
+                self.__client.client.delete_records(
+                                        "history",
+                                        deleted[i:i + MAX_POST_RECORDS])
+            # Same cursor so update is committed by remove
+            SqlCursor.add(self.__mirror)
+            try:
+                self.__mirror.update("history", pushed, False)
+                self.__mirror.remove("history", deleted)  # Will commit
+            finally:
+                SqlCursor.remove(self.__mirror)
+            if changes:
+                # Items failed on server stay in change log for next flush
+                acked = [guid for (guid, modified, h) in pushed] + deleted
+                El().history.ack_changes(changes[-1][2], acked)
+            return True
         except Exception as e:
-            print("SyncWorker::__remove_from_history():", e)
-        self.__stop = True
+            print("SyncWorker::__push_history():", e)
+            # Removals are not logged, keep them for next flush
+            self.__requeue_history(OrderedDict(
+                            (guid, history_id)
+                            for (guid, history_id) in items.items()
+                            if history_id is None))
+            return False
 
-    def __sync(self, first_sync):
+    def __sync(self, first_sync, retry=True):
         """
             Sync Eolie objects (bookmarks, history, ...) with Mozilla Sync
             @param first_sync as bool
+            @param retry as bool: retry with new credentials on 401
         """
         debug("Start syncing")
-        if not self.__username or not self.__password:
+        if not self.__has_secrets():
             self.__stop = True
             return
-        try:
-            self.__mtimes = load(open(El().LOCAL_PATH + "/mozilla_sync.bin",
-                                 "rb"))
-        except:
-            self.__mtimes = {"bookmarks": 0.1, "history": 0.1}
+        self.__mtimes = {"bookmarks": 0.1, "history": 0.1}
+        self.__mtimes.update(self.__mirror.get_mtimes())
         try:
             bulk_keys = self.__get_session_bulk_keys()
-            new_mtimes = self.__client.client.info_collections()
+            # None if nothing changed on server since last sync
+            if first_sync:
+                new_mtimes = self.__client.client.info_collections()
+            else:
+                since = max(self.__mtimes.values())
+                new_mtimes = self.__client.client.info_collections(
+                                                  if_modified_since=since)
+            if new_mtimes is None:
+                debug("Nothing new on server")
+                new_mtimes = self.__mtimes
 
             ######################
             # History Management #
@@ -229,6 +528,8 @@ class SyncWorker:
             # Only pull if something new available
             if self.__mtimes["history"] != new_mtimes["history"]:
                 self.__pull_history(bulk_keys)
+            # Push history changes not flushed by queue
+            self.__flush_history(OrderedDict())
             ########################
             # Bookmarks Management #
             ########################
@@ -236,18 +537,58 @@ class SyncWorker:
                                                  self.__mtimes["bookmarks"],
                                                  new_mtimes["bookmarks"]))
             # Push new bookmarks
-            self.__push_bookmarks(bulk_keys)
+            pushed = self.__push_bookmarks(bulk_keys)
             # Only pull if something new available
             if self.__mtimes["bookmarks"] != new_mtimes["bookmarks"]:
                 self.__pull_bookmarks(bulk_keys, first_sync)
             # Update last sync mtime
-            self.__mtimes = self.__client.client.info_collections()
-            dump(self.__mtimes,
-                 open(El().LOCAL_PATH + "/mozilla_sync.bin", "wb"))
-            debug("Stop syncing")
+            if pushed:
+                self.__mtimes = self.__client.client.info_collections()
+            else:
+                self.__mtimes = new_mtimes
+            self.__mirror.set_mtimes(self.__mtimes)
+            debug("Stop syncing, connections: %s" % El().http.stats)
         except Exception as e:
+            if retry and self.__is_unauthorized(e):
+                self.__invalidate_credentials()
+                return self.__sync(first_sync, False)
             print("SyncWorker::__sync():", e)
+        set_changes_tracking(True)
+        self.__update_backoff()
         self.__stop = True
+        GLib.idle_add(self.__schedule_sync)
+
+    def __update_backoff(self):
+        """
+            Honor server backoff requests
+        """
+        backoff = self.__client.pop_backoff()
+        if backoff:
+            debug("Server asked to back off for %s seconds" % backoff)
+            self.__backoff_until = max(self.__backoff_until,
+                                       time() + backoff)
+
+    def __schedule_sync(self):
+        """
+            Schedule next sync, sooner if there was local activity
+        """
+        if self.__timeout_id is not None:
+            GLib.source_remove(self.__timeout_id)
+        if time() - self.__last_activity < self.__ACTIVITY_DELAY:
+            interval = self.__SHORT_INTERVAL
+        else:
+            interval = self.__LONG_INTERVAL
+        interval = max(interval, self.__backoff_until - time())
+        self.__timeout_id = GLib.timeout_add_seconds(int(interval),
+                                                     self.__on_sync_timeout)
+
+    def __on_sync_timeout(self):
+        """
+            Run scheduled sync
+        """
+        self.__timeout_id = None
+        self.sync()
+        return False
 
     def __push_bookmarks(self, bulk_keys):
         """
@@ -257,16 +598,35 @@ class SyncWorker:
             @raise StopIteration
         """
         debug("push bookmarks")
-        parents = []
-        for bookmark_id in El().bookmarks.get_ids_for_mtime(
-                                                   self.__mtimes["bookmarks"]):
+        parents = set()
+        pushed = []
+        deleted = []
+        changes = El().bookmarks.get_changes()
+        # Nothing changed locally
+        if not changes:
+            return False
+        for (bookmark_id, guid, op, counter, uri, delete) in changes:
+            # Removed from db or marked as deleted
+            if uri is None or delete:
+                deleted.append(guid)
+                if uri is None:
+                    continue
+                parent_guid = El().bookmarks.get_parent_guid(bookmark_id)
+                parents.add(parent_guid or "unfiled")
+                # Do not log our own removal
+                set_changes_tracking(False)
+                El().bookmarks.remove(bookmark_id)
+                set_changes_tracking(True)
+                continue
+            # Folder, pushed with its children below
+            if uri == guid:
+                parents.add(guid)
+                continue
             parent_guid = El().bookmarks.get_parent_guid(bookmark_id)
             # No parent, move it to unfiled
             if parent_guid is None:
                 parent_guid = "unfiled"
-            parent_id = El().bookmarks.get_id_by_guid(parent_guid)
-            if parent_id not in parents:
-                parents.append(parent_id)
+            parents.add(parent_guid)
             record = {}
             record["bmkUri"] = El().bookmarks.get_uri(bookmark_id)
             record["id"] = El().bookmarks.get_guid(bookmark_id)
@@ -275,49 +635,60 @@ class SyncWorker:
             record["parentid"] = El().bookmarks.get_parent_guid(bookmark_id)
             record["type"] = "bookmark"
             debug("pushing %s" % record)
-            self.__client.add_bookmark(record, bulk_keys)
+            pushed.append(self.__client.add_bookmark(record, bulk_keys))
         # Del old bookmarks
-        for bookmark_id in El().bookmarks.get_deleted_ids():
-            parent_guid = El().bookmarks.get_parent_guid(bookmark_id)
-            # No parent, move it to unfiled
-            if parent_guid is None:
-                parent_guid = "unfiled"
-            parent_id = El().bookmarks.get_id_by_guid(parent_guid)
-            if parent_id not in parents:
-                parents.append(parent_id)
-            guid = El().bookmarks.get_guid(bookmark_id)
-            debug("deleting %s" % guid)
-            self.__client.client.delete_record("bookmarks", guid)
-            El().bookmarks.remove(bookmark_id)
+        debug("deleting %s" % deleted)
+        for i in range(0, len(deleted), MAX_POST_RECORDS):
+            self.__client.client.delete_records(
+                                        "bookmarks",
+                                        deleted[i:i + MAX_POST_RECORDS])
+        # Build folders tree once
+        nodes = {}
+        children = {}
+        for (guid, parent_guid, title, parent_name) in\
+                El().bookmarks.get_tree():
+            nodes[guid] = (parent_guid, title, parent_name)
+            children.setdefault(parent_guid, []).append(guid)
         # Push parents in this order, parents near root are handle later
         # As otherwise, order will be broken by new children updates
-        while parents:
-            parent_id = parents.pop(0)
-            parent_guid = El().bookmarks.get_guid(parent_id)
-            parent_name = El().bookmarks.get_title(parent_id)
-            children = El().bookmarks.get_children(parent_guid)
-            # So search if children in parents
-            found = False
-            for child_guid in children:
-                child_id = El().bookmarks.get_id_by_guid(child_guid)
-                if child_id in parents:
-                    found = True
-                    break
-            # Handle children first
-            if found:
-                parents.append(parent_id)
-                debug("later: %s" % parent_name)
-                continue
+        for parent_guid in sorted(parents & nodes.keys(),
+                                  key=lambda guid: self.__get_depth(guid,
+                                                                    nodes),
+                                  reverse=True):
+            (grand_parent_guid, title, parent_name) = nodes[parent_guid]
             record = {}
             record["id"] = parent_guid
             record["type"] = "folder"
-            record["parentid"] = El().bookmarks.get_parent_guid(parent_id)
-            record["parentName"] = El().bookmarks.get_parent_name(parent_id)
-            record["title"] = parent_name
-            record["children"] = children
+            record["parentid"] = grand_parent_guid or "unfiled"
+            record["parentName"] = parent_name or ""
+            record["title"] = title
+            record["children"] = children.get(parent_guid, [])
             debug("pushing parent %s" % record)
-            self.__client.add_bookmark(record, bulk_keys)
+            pushed.append(self.__client.add_bookmark(record, bulk_keys))
+        # Same cursor so update is committed by remove
+        SqlCursor.add(self.__mirror)
+        try:
+            self.__mirror.update("bookmarks", pushed, False)
+            self.__mirror.remove("bookmarks", deleted)  # Will commit
+        finally:
+            SqlCursor.remove(self.__mirror)
+        # Changes done while pushing have a greater counter, kept for later
+        El().bookmarks.ack_changes(changes[-1][3])
         El().bookmarks.clean_tags()
+        return True
+
+    def __get_depth(self, guid, nodes):
+        """
+            Get folder depth in tree
+            @param guid as str
+            @param nodes as {guid: (parent guid, title, parent name)}
+            @return int
+        """
+        depth = 0
+        while guid in nodes and depth < len(nodes):
+            guid = nodes[guid][0]
+            depth += 1
+        return depth
 
     def __pull_bookmarks(self, bulk_keys, first_sync):
         """
@@ -328,27 +699,52 @@ class SyncWorker:
         """
         debug("pull bookmarks")
         SqlCursor.add(El().bookmarks)
-        records = self.__client.get_bookmarks(bulk_keys)
-        # We get all guids here and remove them while sync
-        # At the end, we have deleted records
-        # On fist sync, keep all
-        if first_sync:
-            to_delete = []
+        SqlCursor.add(self.__mirror)
+        # Remote changes must not be pushed back
+        set_changes_tracking(False)
+        try:
+            self.__apply_bookmarks(bulk_keys, first_sync)
+        finally:
+            set_changes_tracking(True)
+            SqlCursor.remove(self.__mirror)
+            SqlCursor.remove(El().bookmarks)
+
+    def __apply_bookmarks(self, bulk_keys, first_sync):
+        """
+            Apply remote bookmarks, mirror is updated once applied
+            @param bulk_keys as KeyBundle
+            @param first_sync as bool
+        """
+        # Records known by mirror but not on server anymore were deleted
+        # On first sync, keep all
+        known = self.__mirror.get_guids("bookmarks")
+        if first_sync or not known:
+            to_delete = set()
+            newer = None
         else:
-            to_delete = El().bookmarks.get_guids()
+            to_delete = known - set(self.__client.get_ids("bookmarks"))
+            newer = self.__mtimes["bookmarks"]
+        # Records unchanged since last sync are not decrypted
+        records = self.__client.get_bookmarks(bulk_keys, newer, self.__mirror)
+        start = process_time()
+        positions = []
         for record in records:
             bookmark = record["payload"]
+            if bookmark.get("deleted", False):
+                to_delete.add(record["id"])
+                continue
             if "type" not in bookmark.keys() or\
                     bookmark["type"] not in ["folder", "bookmark"]:
                 continue
             bookmark_id = El().bookmarks.get_id_by_guid(bookmark["id"])
-            # This bookmark exists, remove from to delete
-            if bookmark["id"] in to_delete:
-                to_delete.remove(bookmark["id"])
             # Nothing to apply, continue
             if El().bookmarks.get_mtime(bookmark_id) >= record["modified"]:
                 continue
             debug("pulling %s" % record)
+            # Children may not exist yet, positions are set at the end
+            if "children" in bookmark.keys():
+                positions += [(child, position) for (position, child)
+                              in enumerate(bookmark["children"])]
             if bookmark_id is None:
                 if "bmkUri" in bookmark.keys():
                     # Use parent name if no bookmarks tags
@@ -379,14 +775,6 @@ class SyncWorker:
                     El().bookmarks.set_uri(bookmark_id,
                                            bookmark["bmkUri"],
                                            False)
-                elif "children" in bookmark.keys():
-                    position = 0
-                    for child in bookmark["children"]:
-                        bid = El().bookmarks.get_id_by_guid(child)
-                        El().bookmarks.set_position(bid,
-                                                    position,
-                                                    False)
-                        position += 1
                 # Remove previous tags
                 current_tags = El().bookmarks.get_tags(bookmark_id)
                 for tag in El().bookmarks.get_tags(bookmark_id):
@@ -419,8 +807,15 @@ class SyncWorker:
             bookmark_id = El().bookmarks.get_id_by_guid(guid)
             if bookmark_id is not None:
                 El().bookmarks.remove(bookmark_id, False)
+        El().bookmarks.set_positions(positions, False)
         El().bookmarks.clean_tags()  # Will commit
-        SqlCursor.remove(El().bookmarks)
+        # Failed records are pulled again on next sync
+        self.__mirror.update("bookmarks",
+                             [(record["id"], record["modified"],
+                               record["hash"]) for record in records],
+                             False)
+        self.__mirror.remove("bookmarks", to_delete)  # Will commit
+        self.__apply_time += process_time() - start
 
     def __pull_history(self, bulk_keys):
         """
@@ -430,7 +825,28 @@ class SyncWorker:
         """
         debug("pull history")
         SqlCursor.add(El().history)
-        records = self.__client.get_history(bulk_keys)
+        SqlCursor.add(self.__mirror)
+        # Remote changes must not be pushed back
+        set_changes_tracking(False)
+        try:
+            self.__apply_history(bulk_keys)
+        finally:
+            set_changes_tracking(True)
+            SqlCursor.remove(self.__mirror)
+            SqlCursor.remove(El().history)
+
+    def __apply_history(self, bulk_keys):
+        """
+            Apply remote history, mirror is updated once applied
+            @param bulk_keys as KeyBundle
+        """
+        # Records unchanged since last sync are not decrypted
+        if self.__mtimes["history"] == 0.1:
+            newer = None
+        else:
+            newer = self.__mtimes["history"]
+        records = self.__client.get_history(bulk_keys, newer, self.__mirror)
+        start = process_time()
         for record in records:
             history = record["payload"]
             if "histUri" not in history.keys():
@@ -471,7 +887,11 @@ class SyncWorker:
                                        False)
         with SqlCursor(El().history) as sql:
             sql.commit()
-        SqlCursor.remove(El().history)
+        # Failed records are pulled again on next sync
+        self.__mirror.update("history",
+                             [(record["id"], record["modified"],
+                               record["hash"]) for record in records])
+        self.__apply_time += process_time() - start
 
     def __on_get_secret(self, source, result, first_sync, delete):
         """
@@ -508,8 +928,8 @@ class SyncWorker:
             secret = source.get_secret()
             attributes = source.get_attributes()
             if secret is not None:
-                self.__username = attributes["login"]
-                self.__password = secret.get().decode('utf-8')
+                self.__set_secrets(attributes["login"],
+                                   secret.get().decode('utf-8'))
                 self.__token = attributes["token"]
                 self.__uid = attributes["uid"]
                 self.__keyB = base64.b64decode(attributes["keyB"])
@@ -518,8 +938,11 @@ class SyncWorker:
                                     args=(first_sync,))
                     thread.daemon = True
                     thread.start()
+                    return
         except Exception as e:
             print("SyncWorker::__on_load_secret()", e)
+        self.__stop = True
+        self.__schedule_sync()
 
     def __on_secret_search(self, source, result, first_sync, delete):
         """
@@ -533,9 +956,13 @@ class SyncWorker:
             if result is not None:
                 items = source.search_finish(result)
                 if not items:
+                    # No sync account, history changes will never be pushed
+                    El().history.clear_changes()
+                    self.__stop = True
                     return
                 if delete:
                     items[0].delete(None, None)
+                    El().history.clear_changes()
                 else:
                     items[0].load_secret(None,
                                          self.__on_load_secret,
@@ -557,6 +984,7 @@ class MozillaSync(object):
             Init client
         """
         self.__client = FxAClient()
+        self.__decrypt_time = 0
 
     def login(self, login, password):
         """
@@ -569,16 +997,32 @@ class MozillaSync(object):
         fxaSession.fetch_keys()
         return fxaSession
 
-    def connect(self, bid_assertion, key):
+    def restore(self, credentials):
+        """
+            Connect to sync using cached tokenserver credentials
+            @param credentials as {}
+        """
+        self.__client = SyncClient(credentials=credentials)
+
+    def reset(self):
+        """
+            Drop current sync client
+        """
+        self.__client = FxAClient()
+
+    def connect(self, bid_assertion, key, tokenserver_url=TOKENSERVER_URL):
         """
             Connect to sync using FxA browserid assertion
             @param session as fxaSession
+            @param key as bytes
+            @param tokenserver_url as str
             @return bundle keys as KeyBundle
         """
         state = None
         if key is not None:
             state = hexlify(sha256(key).digest()[0:16])
-        self.__client = SyncClient(bid_assertion, state)
+        self.__client = SyncClient(bid_assertion, state,
+                                   tokenserver_url=tokenserver_url)
         sync_keys = KeyBundle.fromMasterKey(
                                         key,
                                         "identity.mozilla.com/picl/v1/oldsync")
@@ -603,45 +1047,64 @@ class MozillaSync(object):
                               base64.b64decode(keys["default"][1]))
         return bulk_keys
 
-    def get_bookmarks(self, bulk_keys):
+    def get_bookmarks(self, bulk_keys, newer=None, mirror=None):
         """
             Return bookmarks payload
             @param bulk keys as KeyBundle
+            @param newer as float
+            @param mirror as DatabaseMirror
             @return [{}]
         """
-        bookmarks = []
-        for record in self.__client.get_records('bookmarks'):
-            record["payload"] = self.__decrypt_payload(record, bulk_keys)
-            bookmarks.append(record)
-        return bookmarks
+        return self.__get_records("bookmarks", bulk_keys, newer, mirror)
 
-    def get_history(self, bulk_keys):
+    def get_history(self, bulk_keys, newer=None, mirror=None):
         """
             Return history payload
             @param bulk keys as KeyBundle
+            @param newer as float
+            @param mirror as DatabaseMirror
             @return [{}]
         """
-        history = []
-        for record in self.__client.get_records('history'):
-            record["payload"] = self.__decrypt_payload(record, bulk_keys)
-            history.append(record)
-        return history
+        return self.__get_records("history", bulk_keys, newer, mirror)
+
+    def get_ids(self, collection):
+        """
+            Return ids of records in collection, payloads are not fetched
+            @param collection as str
+            @return [str]
+        """
+        return self.__client.get_records(collection, full=False)
 
     def add_bookmark(self, bookmark, bulk_keys):
-        payload = self.__encrypt_payload(bookmark, bulk_keys)
-        record = {}
-        record["modified"] = round(time(), 2)
-        record["payload"] = payload
-        record["id"] = bookmark["id"]
-        self.__client.put_record("bookmarks", record)
+        """
+            Push bookmark
+            @param bookmark as {}
+            @param bulk keys as KeyBundle
+            @return (guid, modified, hash) as (str, float, str)
+        """
+        record = self.__get_record(bookmark, bulk_keys)
+        modified = self.__client.put_record("bookmarks", record)
+        return (record["id"], modified, self.__get_hash(record))
 
-    def add_history(self, history, bulk_keys):
-        payload = self.__encrypt_payload(history, bulk_keys)
-        record = {}
-        record["modified"] = round(time(), 2)
-        record["payload"] = payload
-        record["id"] = history["id"]
-        self.__client.put_record("history", record)
+    def add_histories(self, histories, bulk_keys):
+        """
+            Push history items in batch
+            @param histories as [{}]
+            @param bulk keys as KeyBundle
+            @return [(guid, modified, hash)] for pushed items
+        """
+        records = [self.__get_record(history, bulk_keys)
+                   for history in histories]
+        pushed = []
+        for i in range(0, len(records), MAX_POST_RECORDS):
+            chunk = records[i:i + MAX_POST_RECORDS]
+            result = self.__client.post_records("history", chunk)
+            success = set(result.get("success", []))
+            for record in chunk:
+                if record["id"] in success:
+                    pushed.append((record["id"], result["modified"],
+                                   self.__get_hash(record)))
+        return pushed
 
     def get_browserid_assertion(self, session,
                                 tokenserver_url=TOKENSERVER_URL):
@@ -660,9 +1123,85 @@ class MozillaSync(object):
         """
         return self.__client
 
+    def pop_backoff(self):
+        """
+            Get backoff asked by server since last call
+            @return seconds as int
+        """
+        if isinstance(self.__client, SyncClient):
+            return self.__client.pop_backoff()
+        return 0
+
+    @property
+    def decrypt_time(self):
+        """
+            CPU time spent decrypting records
+            @return float
+        """
+        return self.__decrypt_time
+
+    @property
+    def credentials(self):
+        """
+            Get current tokenserver credentials
+            @return {} or None
+        """
+        if isinstance(self.__client, SyncClient):
+            return self.__client.credentials
+        return None
+
 #######################
 # PRIVATE             #
 #######################
+    def __get_records(self, collection, bulk_keys, newer, mirror):
+        """
+            Return decrypted records for collection
+            Records with same payload hash in mirror are skipped
+            @param collection as str
+            @param bulk keys as KeyBundle
+            @param newer as float
+            @param mirror as DatabaseMirror
+            @return [{}]
+        """
+        records = self.__client.get_records(collection, newer=newer)
+        for record in records:
+            record["hash"] = self.__get_hash(record)
+        if mirror is None:
+            known = {}
+        else:
+            known = mirror.get_hashes(collection,
+                                      [record["id"] for record in records])
+        decrypted = []
+        start = process_time()
+        for record in records:
+            if known.get(record["id"], None) == record["hash"]:
+                continue
+            record["payload"] = self.__decrypt_payload(record, bulk_keys)
+            decrypted.append(record)
+        self.__decrypt_time += process_time() - start
+        return decrypted
+
+    def __get_hash(self, record):
+        """
+            Get record encrypted payload hash
+            @param record as {}
+            @return str
+        """
+        return sha256(record["payload"].encode("utf-8")).hexdigest()
+
+    def __get_record(self, item, bulk_keys):
+        """
+            Get encrypted BSO for item
+            @param item as {}
+            @param bulk keys as KeyBundle
+            @return {}
+        """
+        record = {}
+        record["modified"] = round(time(), 2)
+        record["payload"] = self.__encrypt_payload(item, bulk_keys)
+        record["id"] = item["id"]
+        return record
+
     def __encrypt_payload(self, record, key_bundle):
         """
             Encrypt payload
@@ -794,8 +1333,8 @@ class TokenserverClient(object):
             params['duration'] = int(duration)
 
         url = self.__server_url.rstrip('/') + '/1.0/sync/1.5'
-        raw_resp = requests.get(url, headers=headers, params=params,
-                                verify=True)
+        raw_resp = El().http.requests.get(url, headers=headers,
+                                          params=params, verify=True)
         raw_resp.raise_for_status()
         return raw_resp.json()
 
@@ -805,18 +1344,24 @@ class SyncClient(object):
         Client for the Firefox Sync server.
     """
     def __init__(self, bid_assertion=None, client_state=None,
-                 credentials={}, tokenserver_url=TOKENSERVER_URL):
+                 credentials=None, tokenserver_url=TOKENSERVER_URL):
         """
             Init client
             @param bid assertion as str
             @param client_state as ???
-            @param credentials as {}
+            @param credentials as {}/None
             @param server_url as str
         """
+        if credentials is None:
+            credentials = {}
         if bid_assertion is not None and client_state is not None:
             ts_client = TokenserverClient(bid_assertion, client_state,
                                           tokenserver_url)
             credentials = ts_client.get_hawk_credentials()
+            credentials["expires"] = time() - TOKEN_EXPIRY_MARGIN +\
+                credentials.get("duration", 0)
+        self.__credentials = credentials
+        self.__backoff = 0
         self.__user_id = credentials['uid']
         self.__api_endpoint = credentials['api_endpoint']
         self.__auth = HawkAuth(algorithm=credentials['hashalg'],
@@ -830,21 +1375,41 @@ class SyncClient(object):
             @param method as str
             @param url as str
             @param kwargs as requests.request named args
+            @return JSON or None if not modified
         """
         url = self.__api_endpoint.rstrip('/') + '/' + url.lstrip('/')
-        raw_resp = requests.request(method, url, auth=self.__auth, **kwargs)
+        raw_resp = El().http.requests.request(method, url, auth=self.__auth,
+                                              **kwargs)
+        for header in ['X-Weave-Backoff', 'Retry-After']:
+            try:
+                backoff = int(raw_resp.headers.get(header, 0))
+                self.__backoff = max(self.__backoff, backoff)
+            except ValueError:
+                pass
         raw_resp.raise_for_status()
 
         if raw_resp.status_code == 304:
-            http_error_msg = '%s Client Error: %s for url: %s' % (
-                raw_resp.status_code,
-                raw_resp.reason,
-                raw_resp.url)
-            raise requests.exceptions.HTTPError(http_error_msg,
-                                                response=raw_resp)
+            return None
         return raw_resp.json()
 
-    def info_collections(self, **kwargs):
+    def pop_backoff(self):
+        """
+            Get backoff asked by server since last call
+            @return seconds as int
+        """
+        backoff = self.__backoff
+        self.__backoff = 0
+        return backoff
+
+    @property
+    def credentials(self):
+        """
+            Get tokenserver credentials
+            @return {}
+        """
+        return self.__credentials
+
+    def info_collections(self, if_modified_since=None, **kwargs):
         """
             Returns an object mapping collection names associated with the
             account to the last-modified time for each collection.
@@ -852,7 +1417,15 @@ class SyncClient(object):
             The server may allow requests to this endpoint to be authenticated
             with an expired token, so that clients can check for server-side
             changes before fetching an updated token from the Token Server.
+
+            :param if_modified_since:
+                a timestamp. None is returned if no collection was modified
+                since.
         """
+        if if_modified_since is not None:
+            headers = kwargs.pop('headers', {})
+            headers['X-If-Modified-Since'] = str(if_modified_since)
+            kwargs['headers'] = headers
         return self._request('get', '/info/collections', **kwargs)
 
     def info_quota(self, **kwargs):
@@ -959,6 +1532,32 @@ class SyncClient(object):
         except Exception as e:
             print("SyncClient::delete_record()", e)
 
+    def delete_records(self, collection, ids, **kwargs):
+        """
+            Deletes BSOs with given ids. A maximum of 100 ids may be provided.
+        """
+        params = kwargs.pop('params', {})
+        params['ids'] = ','.join(map(str, ids))
+        return self._request('delete', '/storage/%s' % collection.lower(),
+                             params=params, **kwargs)
+
+    def post_records(self, collection, records, **kwargs):
+        """
+            Creates or updates a batch of BSOs within a collection.
+            The passed records must be a list of python objects.
+
+            Successful responses will return the new last-modified time for
+            the collection and the lists of succeeded and failed ids.
+        """
+        headers = {}
+        if 'headers' in kwargs:
+            headers = kwargs.pop('headers')
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+
+        return self._request('post', '/storage/%s' % collection.lower(),
+                             data=json.dumps(records), headers=headers,
+                             **kwargs)
+
     def put_record(self, collection, record, **kwargs):
         """
             Creates or updates a specific BSO within a collection.
@@ -18,7 +18,8 @@ from datetime import datetime
 from locale import strcoll
 
 from eolie.define import El, Type
-from eolie.utils import resize_favicon, get_favicon_best_uri
+from eolie.utils import debug
+from eolie.query_engine import QueryEngine
 
 
 class Item(GObject.GObject):
@@ -43,8 +44,9 @@ class Item(GObject.GObject):
 
 class Row(Gtk.ListBoxRow):
     """
-        A row
+        A row, content is built on demand
     """
+    HEIGHT = 30
     __gsignals__ = {
         'edited': (GObject.SignalFlags.RUN_FIRST, None, ()),
         'moved': (GObject.SignalFlags.RUN_FIRST, None, (GLib.Variant,))
@@ -59,13 +61,47 @@ class Row(Gtk.ListBoxRow):
         self.__item = item
         self.__window = window
         self.__search = ""
-        eventbox = None
-        favicon = None
+        self.__title = None
+        self.__grid = None
         Gtk.ListBoxRow.__init__(self)
         self.get_style_context().add_class("row")
+        item_type = item.get_property("type")
+        # Content is built by populate(), keep same height when empty
+        self.__eventbox = Gtk.EventBox()
+        self.__eventbox.set_size_request(-1, self.HEIGHT)
+        self.__eventbox.connect("button-release-event",
+                                self.__on_button_release)
+        self.__eventbox.show()
+        self.add(self.__eventbox)
+        # Items are reused between searches
+        self.__title_id = item.connect("notify::title",
+                                       self.__on_item_title_changed)
+        self.connect("destroy", self.__on_destroy)
+        if item_type == Type.BOOKMARK:
+            self.drag_source_set(Gdk.ModifierType.BUTTON1_MASK, [],
+                                 Gdk.DragAction.MOVE)
+            self.drag_source_add_text_targets()
+            self.connect('drag-begin', self.__on_drag_begin)
+            self.connect('drag-data-get', self.__on_drag_data_get)
+        # We add bookmark, not useful, only for visual feedback on drag
+        if item_type in [Type.TAG, Type.BOOKMARK]:
+            self.drag_dest_set(Gtk.DestDefaults.DROP | Gtk.DestDefaults.MOTION,
+                               [], Gdk.DragAction.MOVE)
+            self.drag_dest_add_text_targets()
+            self.connect('drag-data-received', self.__on_drag_data_received)
+            self.connect('drag-motion', self.__on_drag_motion)
+            self.connect('drag-leave', self.__on_drag_leave)
+
+    def populate(self):
+        """
+            Build row content, favicon is loaded here
+        """
+        if self.__grid is not None:
+            return
+        item = self.__item
+        favicon = None
         item_id = item.get_property("id")
         item_type = item.get_property("type")
-        uri = item.get_property("uri")
         title = item.get_property("title")
         grid = Gtk.Grid()
         grid.set_column_spacing(10)
@@ -138,26 +174,17 @@ class Row(Gtk.ListBoxRow):
             edit_button.show()
             grid.add(edit_button)
         grid.show()
-        eventbox = Gtk.EventBox()
-        eventbox.add(grid)
-        eventbox.set_size_request(-1, 30)
-        eventbox.connect("button-release-event", self.__on_button_release)
-        eventbox.show()
-        self.add(eventbox)
-        if item_type == Type.BOOKMARK:
-            self.drag_source_set(Gdk.ModifierType.BUTTON1_MASK, [],
-                                 Gdk.DragAction.MOVE)
-            self.drag_source_add_text_targets()
-            self.connect('drag-begin', self.__on_drag_begin)
-            self.connect('drag-data-get', self.__on_drag_data_get)
-        # We add bookmark, not useful, only for visual feedback on drag
-        if item_type in [Type.TAG, Type.BOOKMARK]:
-            self.drag_dest_set(Gtk.DestDefaults.DROP | Gtk.DestDefaults.MOTION,
-                               [], Gdk.DragAction.MOVE)
-            self.drag_dest_add_text_targets()
-            self.connect('drag-data-received', self.__on_drag_data_received)
-            self.connect('drag-motion', self.__on_drag_motion)
-            self.connect('drag-leave', self.__on_drag_leave)
+        self.__eventbox.add(grid)
+        self.__grid = grid
+
+    def clear(self):
+        """
+            Destroy row content, row keeps its height
+        """
+        if self.__grid is not None:
+            self.__grid.destroy()
+            self.__grid = None
+            self.__title = None
 
     def set_title(self, title):
         """
@@ -165,7 +192,6 @@ class Row(Gtk.ListBoxRow):
             @param title as str
         """
         self.__item.set_property("title", title)
-        self.__title.set_text(title)
 
     @property
     def item(self):
@@ -184,23 +210,30 @@ class Row(Gtk.ListBoxRow):
             @param favicon as Gtk.Image
             @param uri as str
         """
-        favicon_uri = get_favicon_best_uri(self.__item.get_property("uri"))
+        uri = self.__item.get_property("uri")
+        surface = El().art.get_favicon(uri)
+        if surface is not None:
+            favicon.set_from_surface(surface)
+            favicon.show()
+            return
+        favicon_uri = El().favicons.get(uri)
         if favicon_uri is not None:
             context = WebKit2.WebContext.get_default()
             favicon_db = context.get_favicon_database()
             favicon_db.get_favicon(favicon_uri, None,
-                                   self.__set_favicon_result, favicon)
+                                   self.__set_favicon_result, favicon, uri)
         else:
             favicon.set_from_icon_name("applications-internet",
                                        Gtk.IconSize.LARGE_TOOLBAR)
             favicon.show()
 
-    def __set_favicon_result(self, db, result, favicon):
+    def __set_favicon_result(self, db, result, favicon, uri):
         """
             Set favicon db result
             @param db as WebKit2.FaviconDatabase
             @param result as Gio.AsyncResult
             @param favicon as Gtk.Image
+            @param uri as str
         """
         try:
             surface = db.get_favicon_finish(result)
@@ -210,10 +243,26 @@ class Row(Gtk.ListBoxRow):
             favicon.set_from_icon_name("applications-internet",
                                        Gtk.IconSize.LARGE_TOOLBAR)
         else:
-            favicon.set_from_surface(resize_favicon(surface))
+            favicon.set_from_surface(El().art.add_favicon(uri, surface))
             del surface
         favicon.show()
 
+    def __on_item_title_changed(self, item, param):
+        """
+            Update title label
+            @param item as Item
+            @param param as GParamSpec
+        """
+        if self.__title is not None:
+            self.__title.set_text(item.get_property("title"))
+
+    def __on_destroy(self, widget):
+        """
+            Stop following item
+            @param widget as Gtk.Widget
+        """
+        self.__item.disconnect(self.__title_id)
+
     def __on_query_tooltip(self, widget, x, y, keyboard, tooltip):
         """
             Show tooltip if needed
@@ -361,7 +410,16 @@ class Input:
 class UriPopover(Gtk.Popover):
     """
         Show user bookmarks or search
+        History and bookmarks are added to models by pages while scrolling,
+        so rows only exist for items scrolled to
+        Only rows near viewport get content
     """
+    # Rows populated above and below viewport
+    __OVERSCAN = 10
+    # Items added to a model at once
+    __PAGE_SIZE = 50
+    # Search with typos tolerance under this results count
+    __FUZZY_THRESHOLD = 5
 
     def __init__(self, window):
         """
@@ -380,8 +438,20 @@ class UriPopover(Gtk.Popover):
         self.__history_box = builder.get_object("history_box")
         self.__history_box.bind_model(self.__history_model,
                                       self.__on_item_create)
+        # Items for current search results and keywords
+        self.__results = []
+        self.__keywords = []
+        self.__search_model = Gio.ListStore()
         self.__search_box = builder.get_object("search_box")
-        self.__search_box.set_sort_func(self.__sort_search)
+        self.__search_box.bind_model(self.__search_model,
+                                     self.__on_item_create)
+        self.__query_engine = QueryEngine(self.__on_query_results)
+        self.__query_engine.add_source("bookmarks", self.__query_bookmarks,
+                                       El().bookmarks)
+        self.__query_engine.add_source("history", self.__query_history,
+                                       El().history)
+        self.__query_engine.add_source("fuzzy", self.__query_fuzzy,
+                                       El().history)
         self.__stack = builder.get_object("stack")
         self.__bookmarks_model = Gio.ListStore()
         self.__tags = builder.get_object("tags")
@@ -393,6 +463,20 @@ class UriPopover(Gtk.Popover):
         self.__bookmarks_box.bind_model(self.__bookmarks_model,
                                         self.__on_item_create)
         self.__calendar = builder.get_object("calendar")
+        # box: model, items not yet in model
+        self.__models = {self.__history_box: self.__history_model,
+                         self.__bookmarks_box: self.__bookmarks_model}
+        self.__pages = {}
+        # box: populated rows
+        self.__populated = {}
+        self.__populate_pending = set()
+        for box in [self.__history_box, self.__search_box,
+                    self.__bookmarks_box, self.__tags_box]:
+            self.__populated[box] = set()
+            scrolled = box.get_ancestor(Gtk.ScrolledWindow)
+            adj = scrolled.get_vadjustment()
+            adj.connect("value-changed", self.__on_adjustment_changed, box)
+            box.connect("size-allocate", self.__on_box_size_allocate)
         if El().sync_worker is not None:
             self.__sync_stack = builder.get_object("sync_stack")
             self.__sync_stack.show()
@@ -428,11 +512,8 @@ class UriPopover(Gtk.Popover):
         item.set_property("title", words)
         item.set_property("uri", El().search.get_search_uri(words))
         item.set_property("search", self.__search)
-        item.set_property("position", -1)
-        child = Row(item, self.__window)
-        child.connect("edited", self.__on_row_edited)
-        child.show()
-        self.__search_box.add(child)
+        self.__keywords.append(item)
+        self.__update_search_model()
 
     def forward_event(self, event):
         """
@@ -607,7 +688,7 @@ class UriPopover(Gtk.Popover):
             @param widget as Gtk.Widget
         """
         self.__input = Input.NONE
-        if not self.__search_box.get_children():
+        if self.__search_model.get_n_items() == 0:
             self.set_search_text("")
 
     def _on_history_map(self, widget):
@@ -656,7 +737,6 @@ class UriPopover(Gtk.Popover):
         date = "%s/%s/%s" % (day, month + 1, year)
         mtime = mktime(datetime.strptime(date, "%d/%m/%Y").timetuple())
         result = El().history.get(mtime)
-        self.__history_model.remove_all()
         self.__add_history_items(result)
 
 #######################
@@ -676,16 +756,6 @@ class UriPopover(Gtk.Popover):
             self.__sync_stack.set_visible_child_name("sync")
             self._on_bookmarks_map(None)
 
-    def __sort_search(self, row1, row2):
-        """
-            Sort search
-            @param row1 as Row
-            @param row2 as Row
-        """
-        pos1 = row1.item.get_property("position")
-        pos2 = row2.item.get_property("position")
-        return pos2 > 0 and pos2 < pos1
-
     def __sort_tags(self, row1, row2):
         """
             Sort tags
@@ -697,93 +767,145 @@ class UriPopover(Gtk.Popover):
         return strcoll(row1.item.get_property("title"),
                        row2.item.get_property("title"))
 
-    def __add_searches(self, searches, position=0):
-        """
-            Add searches to model
-            @param [(title, uri)] as [(str, str)]
-        """
-        if searches:
-            (title, uri) = searches.pop(0)
-            for child in self.__search_box.get_children():
-                if child.item.get_property("uri") == uri:
-                    child.item.set_property("search", self.__search)
-                    child.item.set_property("position", position)
-                    GLib.idle_add(self.__add_searches, searches)
-                    return
-            item = Item()
-            item.set_property("type", Type.SEARCH)
-            item.set_property("title", title)
-            item.set_property("uri", uri)
-            item.set_property("search", self.__search)
-            item.set_property("position", position)
-            child = Row(item, self.__window)
-            child.connect("edited", self.__on_row_edited)
-            child.show()
-            self.__search_box.add(child)
-            GLib.idle_add(self.__add_searches, searches, position + 1)
-        else:
-            for child in self.__search_box.get_children():
-                if child.item.get_property("search") != self.__search:
-                    child.destroy()
+    def __update_search_model(self):
+        """
+            Update search model with results and keywords for current search
+            Only changed range is replaced, in one splice
+        """
+        self.__keywords = [item for item in self.__keywords
+                           if item.get_property("search") == self.__search]
+        items = []
+        uris = set()
+        for item in self.__results + self.__keywords:
+            uri = item.get_property("uri")
+            if uri not in uris:
+                uris.add(uri)
+                items.append(item)
+        current = [self.__search_model.get_item(i)
+                   for i in range(0, self.__search_model.get_n_items())]
+        # Keep common head and tail
+        start = 0
+        while start < len(current) and start < len(items) and\
+                current[start] == items[start]:
+            start += 1
+        end = 0
+        while end < len(current) - start and end < len(items) - start and\
+                current[-1 - end] == items[-1 - end]:
+            end += 1
+        self.__search_model.splice(start,
+                                   len(current) - start - end,
+                                   items[start:len(items) - end])
+        # User is likely to load top suggestion
+        if items and not self.__window.container.current.webview.private:
+            El().prefetcher.prefetch(items[0].get_property("uri"))
 
     def __add_bookmarks(self, bookmarks):
         """
-            Add bookmarks to model
+            Set bookmarks model
             @param [(bookmark_id, title, uri)] as [(int, str, str)]
         """
-        if bookmarks:
-            (bookmark_id, title, uri) = bookmarks.pop(0)
+        items = []
+        for (bookmark_id, title, uri) in bookmarks:
             item = Item()
             item.set_property("id", bookmark_id)
             item.set_property("type", Type.BOOKMARK)
             item.set_property("title", title)
             item.set_property("uri", uri)
-            self.__bookmarks_model.append(item)
-            GLib.idle_add(self.__add_bookmarks, bookmarks)
+            items.append(item)
+        self.__set_pages(self.__bookmarks_box, items)
 
-    def __add_tags(self, tags, select, position=0):
+    def __add_tags(self, tags, select):
         """
-            Add tags to model
+            Add tags to box
             @param [(tag_id, title)] as [(int, str)]
             @param select as int
         """
-        if tags:
-            (tag_id, title) = tags.pop(0)
+        if select is None:
+            select = Type.POPULARS
+        for (tag_id, title) in tags:
             item = Item()
             item.set_property("id", tag_id)
             item.set_property("type", Type.TAG)
             item.set_property("title", title)
             child = Row(item, self.__window)
+            child.connect("destroy", self.__on_row_destroy)
             child.connect("activate", self.__on_row_activated)
             child.connect("moved", self.__on_row_moved)
             child.show()
             self.__tags_box.add(child)
-            GLib.idle_add(self.__add_tags, tags, select)
-        else:
-            if select is None:
-                select = Type.POPULARS
-            # Search for previous current row
-            for row in self.__tags_box.get_children():
-                if row.item.get_property("id") == select:
-                    self.__tags_box.select_row(row)
-                    break
-            self.__set_bookmarks(select)
+            # Select previous current row
+            if tag_id == select:
+                self.__tags_box.select_row(child)
+        self.__set_bookmarks(select)
 
     def __add_history_items(self, items):
         """
-            Add history items to model
+            Set history model
             @param [(history_id, title, uri, mtime)]  as [(int, str, str, int)]
         """
-        if items:
-            (history_id, title, uri, atime) = items.pop(0)
+        history_items = []
+        for (history_id, title, uri, atime) in items:
             item = Item()
             item.set_property("id", history_id)
             item.set_property("type", Type.HISTORY)
             item.set_property("title", title)
             item.set_property("uri", uri)
             item.set_property("atime", atime)
-            self.__history_model.append(item)
-            GLib.idle_add(self.__add_history_items, items)
+            history_items.append(item)
+        self.__set_pages(self.__history_box, history_items)
+
+    def __set_pages(self, box, items):
+        """
+            Replace box model content, only first page is added
+            @param box as Gtk.ListBox
+            @param items as [Item]
+        """
+        self.__models[box].remove_all()
+        self.__pages[box] = items
+        self.__add_page(box)
+
+    def __add_page(self, box):
+        """
+            Add next page of items to box model
+            @param box as Gtk.ListBox
+        """
+        items = self.__pages.get(box)
+        if not items:
+            return
+        model = self.__models[box]
+        model.splice(model.get_n_items(), 0, items[:self.__PAGE_SIZE])
+        del items[:self.__PAGE_SIZE]
+
+    def __populate_rows(self, box):
+        """
+            Build content for rows near viewport, clear others
+            @param box as Gtk.ListBox
+        """
+        self.__populate_pending.discard(box)
+        adj = box.get_ancestor(Gtk.ScrolledWindow).get_vadjustment()
+        value = adj.get_value()
+        page_size = adj.get_page_size()
+        first = box.get_row_at_y(value)
+        start = first.get_index() if first is not None else 0
+        last = box.get_row_at_y(value + page_size)
+        if last is not None:
+            end = last.get_index()
+        else:
+            end = start + int(page_size / Row.HEIGHT)
+        rows = set()
+        for index in range(max(0, start - self.__OVERSCAN),
+                           end + self.__OVERSCAN + 1):
+            row = box.get_row_at_index(index)
+            if row is None:
+                # Viewport reaches end of model
+                if box in self.__models:
+                    self.__add_page(box)
+                break
+            row.populate()
+            rows.add(row)
+        for row in self.__populated[box] - rows:
+            row.clear()
+        self.__populated[box] = rows
 
     def __get_current_box(self):
         """
@@ -805,19 +927,71 @@ class UriPopover(Gtk.Popover):
             @param search as str
         """
         self.__search = search
+        self.__query_engine.query(search)
+
+    def __query_bookmarks(self, search, results):
+        """
+            Search bookmarks
+            @param search as str
+            @param results as {str: [(str, str)]}
+            @return [(str, str)]
+            @thread safe
+        """
         if search == '':
-            result = El().history.search(search, 50)
-        else:
-            result = El().bookmarks.search(search, 10)
-            result += El().history.search(search, 10)
-        self.__add_searches(result)
+            return []
+        return El().bookmarks.search(search, 10)
+
+    def __query_history(self, search, results):
+        """
+            Search history
+            @param search as str
+            @param results as {str: [(str, str)]}
+            @return [(str, str)]
+            @thread safe
+        """
+        return El().history.search(search, 50 if search == '' else 10)
+
+    def __query_fuzzy(self, search, results):
+        """
+            Search history tolerating typos if few results found
+            @param search as str
+            @param results as {str: [(str, str)]}
+            @return [(str, str)]
+            @thread safe
+        """
+        count = len(results["bookmarks"]) + len(results["history"])
+        if search == '' or count >= self.__FUZZY_THRESHOLD:
+            return []
+        return El().history.search_fuzzy(search, 10)
+
+    def __on_query_results(self, search, results):
+        """
+            Show query results
+            @param search as str
+            @param results as {str: [(str, str)]}
+        """
+        # Reuse items already shown
+        known = {}
+        for item in self.__results:
+            known[item.get_property("uri")] = item
+        self.__results = []
+        for (title, uri) in results["bookmarks"] + results["history"] +\
+                results["fuzzy"]:
+            item = known.get(uri)
+            if item is None:
+                item = Item()
+                item.set_property("type", Type.SEARCH)
+                item.set_property("uri", uri)
+            item.set_property("title", title)
+            item.set_property("search", search)
+            self.__results.append(item)
+        self.__update_search_model()
 
     def __set_bookmarks(self, tag_id):
         """
             Set bookmarks for tag id
             @param tag id as int
         """
-        self.__bookmarks_model.remove_all()
         self.__remove_button.hide()
         if tag_id == Type.POPULARS:
             items = El().bookmarks.get_populars(50)
@@ -861,12 +1035,41 @@ class UriPopover(Gtk.Popover):
             Switch to bookmarks
             @param widget as Gtk.Widget
         """
+        self.__query_engine.cancel()
+        debug("Query latency: %s" % self.__query_engine.histograms)
         self.__stack.set_visible_child_name("bookmarks")
-        self.__bookmarks_model.remove_all()
+        self.__set_pages(self.__bookmarks_box, [])
         for child in self.__tags_box.get_children():
             child.destroy()
-        for child in self.__search_box.get_children():
-            child.destroy()
+        self.__results = []
+        self.__keywords = []
+        self.__search_model.remove_all()
+
+    def __on_adjustment_changed(self, adj, box):
+        """
+            Viewport or content changed
+            @param adj as Gtk.Adjustment
+            @param box as Gtk.ListBox
+        """
+        self.__populate_rows(box)
+
+    def __on_box_size_allocate(self, box, allocation):
+        """
+            Rows moved, populate them once layout is done
+            @param box as Gtk.ListBox
+            @param allocation as Gdk.Rectangle
+        """
+        if box not in self.__populate_pending:
+            self.__populate_pending.add(box)
+            GLib.idle_add(self.__populate_rows, box)
+
+    def __on_row_destroy(self, row):
+        """
+            Forget row
+            @param row as Row
+        """
+        for rows in self.__populated.values():
+            rows.discard(row)
 
     def __on_row_activated(self, row):
         """
@@ -911,5 +1114,6 @@ class UriPopover(Gtk.Popover):
             @param item as Item
         """
         child = Row(item, self.__window)
+        child.connect("destroy", self.__on_row_destroy)
         child.connect("edited", self.__on_row_edited)
         return child
@@ -0,0 +1,105 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib
+
+from gettext import gettext as _
+from urllib.parse import quote
+
+from eolie.define import El
+
+
+class PopularsPage:
+    """
+        populars:// page, kept in memory
+        Rebuilt only if ranking or thumbnails changed
+    """
+    __LIMIT = 20
+
+    def __init__(self):
+        """
+            Init page
+        """
+        self.__start = None
+        self.__end = None
+        self.__version = None
+        self.__items = None
+        self.__html = None
+
+    def get_html(self):
+        """
+            Get page content
+            @return GLib.Bytes
+        """
+        version = (El().bookmarks.version,
+                   El().history.version,
+                   El().art.version)
+        if version == self.__version:
+            return self.__html
+        self.__version = version
+        items = self.__get_items()
+        if items != self.__items:
+            self.__items = items
+            self.__html = GLib.Bytes.new(self.__build(items))
+        return self.__html
+
+    def get_thumbnail_uri(self, uri):
+        """
+            Get uri serving thumbnail through internal scheme
+            @param uri as str
+            @return str
+        """
+        return "internal:///thumbnail?%s" % quote(uri, safe="")
+
+#######################
+# PRIVATE             #
+#######################
+    def __get_items(self):
+        """
+            Get populars items with a thumbnail
+            @return [(str, str)]
+        """
+        items = []
+        # First from bookmarks
+        for (bookmark_id, title, uri) in El().bookmarks.get_populars(
+                                                                self.__LIMIT):
+            items.append((title, uri))
+        # Then from history
+        more = self.__LIMIT - len(items)
+        if more > 0:
+            for (title, uri) in El().history.search("", more):
+                if (title, uri) not in items:
+                    items.append((title, uri))
+        return [(title, uri) for (title, uri) in items
+                if El().art.access(uri, "master")]
+
+    def __build(self, items):
+        """
+            Build page html
+            @param items as [(str, str)]
+            @return bytes
+        """
+        if self.__start is None:
+            start = Gio.File.new_for_uri(
+                                 "resource:///org/gnome/Eolie/start.html")
+            end = Gio.File.new_for_uri("resource:///org/gnome/Eolie/end.html")
+            (status, start_content, tag) = start.load_contents(None)
+            (status, self.__end, tag) = end.load_contents(None)
+            self.__start = start_content.decode("utf-8")
+        html_start = self.__start.replace("@TITLE@", _("Popular pages"))
+        for (title, uri) in items:
+            html_start += '<a class="child" title="%s" href="%s">' % (title,
+                                                                      uri)
+            html_start += '<img src="%s"></img>' %\
+                self.get_thumbnail_uri(uri)
+            html_start += '<div class="caption">%s</div></a>' % title
+        return html_start.encode("utf-8") + self.__end
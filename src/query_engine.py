@@ -0,0 +1,155 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+import sqlite3
+from time import time
+from threading import Thread, Condition
+
+from eolie.sqlcursor import SqlCursor
+
+
+class QueryEngine:
+    """
+        Run URL bar queries in a worker thread
+        Each query gets a generation, a new query cancels older ones
+        All sources results are delivered at once in main loop
+    """
+    # Latency histogram buckets upper bounds in ms
+    __BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self, callback):
+        """
+            Init engine
+            @param callback as function(search, {source: results})
+        """
+        self.__callback = callback
+        self.__sources = []
+        self.__databases = []
+        self.__connections = []
+        self.__histograms = {}
+        self.__generation = 0
+        self.__search = None
+        self.__condition = Condition()
+        self.__thread = None
+
+    def add_source(self, name, query, database=None):
+        """
+            Add a query source, run in sources order
+            @param name as str
+            @param query as function(search, results) run in worker thread,
+                   results are previous sources ones as {name: list}
+            @param database as object with get_cursor(), queries on it
+                   are interrupted when stale
+        """
+        self.__sources.append((name, query))
+        self.__histograms[name] = [0] * (len(self.__BUCKETS) + 1)
+        if database is not None and database not in self.__databases:
+            self.__databases.append(database)
+
+    def query(self, search):
+        """
+            Query sources for search, cancel running query
+            @param search as str
+        """
+        with self.__condition:
+            self.__generation += 1
+            self.__search = search
+            for connection in self.__connections:
+                connection.interrupt()
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__worker)
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify()
+
+    def cancel(self):
+        """
+            Cancel running query, results will not be delivered
+        """
+        with self.__condition:
+            self.__generation += 1
+            self.__search = None
+            for connection in self.__connections:
+                connection.interrupt()
+
+    @property
+    def histograms(self):
+        """
+            Get latency histograms per source
+            @return {str: [(bucket upper bound in ms/None, count)]}
+        """
+        bounds = self.__BUCKETS + [None]
+        return {name: list(zip(bounds, counts))
+                for (name, counts) in self.__histograms.items()}
+
+#######################
+# PRIVATE             #
+#######################
+    def __worker(self):
+        """
+            Run queries
+            @thread safe
+        """
+        for database in self.__databases:
+            SqlCursor.add(database)
+            with SqlCursor(database) as sql:
+                with self.__condition:
+                    self.__connections.append(sql)
+        while True:
+            with self.__condition:
+                while self.__search is None:
+                    self.__condition.wait()
+                generation = self.__generation
+                search = self.__search
+                self.__search = None
+            results = {}
+            for (name, query) in self.__sources:
+                if generation != self.__generation:
+                    break
+                start = time()
+                try:
+                    results[name] = query(search, results)
+                except sqlite3.OperationalError:
+                    # Interrupted by a newer query
+                    break
+                except Exception as e:
+                    print("QueryEngine::__worker():", e)
+                    results[name] = []
+                self.__add_latency(name, time() - start)
+            else:
+                GLib.idle_add(self.__deliver, generation, search, results)
+
+    def __add_latency(self, name, latency):
+        """
+            Add latency to source histogram
+            @param name as str
+            @param latency as float (seconds)
+        """
+        ms = latency * 1000
+        counts = self.__histograms[name]
+        for i, bound in enumerate(self.__BUCKETS):
+            if ms <= bound:
+                counts[i] += 1
+                return
+        counts[-1] += 1
+
+    def __deliver(self, generation, search, results):
+        """
+            Pass results to callback if still current
+            @param generation as int
+            @param search as str
+            @param results as {str: list}
+        """
+        if generation == self.__generation:
+            self.__callback(search, results)
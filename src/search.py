@@ -10,30 +10,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Soup
+from gi.repository import GLib
 
 from gettext import gettext as _
 
+import json
+from time import time
+from bisect import bisect_left, insort
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+
 from eolie.define import El
 
 
 class Search:
     """
         Eolie search engines
+        Keywords are cached per engine and words, identical requests
+        running at the same time share one HTTP request
+        Searched words are kept in a prefix index for offline keywords
     """
+    # uri, search uri, keywords uri, keywords encoding, keywords format
     __ENGINES = {
         'Google': [
             # Translators: Google url for your country
             _("https://www.google.com"),
             'https://www.google.com/search?q=%s&ie=utf-8&oe=utf-8',
-            'https://www.google.com/complete/search?client=firefox&q=%s',
-            'unicode_escape'
+            'https://www.google.com/complete/search?client=firefox&q=%s'
+            '&ie=utf-8&oe=utf-8',
+            'utf-8',
+            'opensearch'
             ],
         'DuckDuckGo': [
             'https://duckduckgo.com',
             'https://duckduckgo.com/?q=%s',
             'https://ac.duckduckgo.com/ac/?q=%s&type=list',
-            'utf-8'
+            'utf-8',
+            'opensearch'
             ],
         'Yahoo': [
             # Translators: Yahoo url for your country
@@ -41,25 +54,46 @@ class Search:
             'https://search.yahoo.com/yhs/search?p=%s&ei=UTF-8',
             'https://ca.search.yahoo.com/sugg/ff?'
             'command=%s&output=fxjson&appid=fd',
-            'utf-8'
+            'utf-8',
+            'opensearch'
             ],
         'Bing': [
             'https://www.bing.com',
             'https://www.bing.com/search?q=%s',
             'https://www.bing.com/osjson.aspx?query=%s&form=OSDJAS',
-            'utf-8'
+            'utf-8',
+            'opensearch'
             ]
         }
+    __CACHE_SIZE = 200
+    # Seconds
+    __CACHE_TTL = 600
+    # Searched words score is halved every 30 days
+    __HISTORY_HALF_LIFE = 2592000
 
     def __init__(self):
         """
             Init search
         """
+        self.__engine = ""
         self.__uri = ""
         self.__search = ""
         self.__keywords = ""
         self.__encoding = ""
+        self.__format = ""
+        self.__parsers = {"opensearch": self.__parse_opensearch}
+        self.__lock = Lock()
+        # (engine, words): (time, [str])
+        self.__cache = OrderedDict()
+        # (engine, words): threading.Event
+        self.__running = {}
+        # Sorted [(lower words, words)] and words: (count, atime)
+        self.__history_words = []
+        self.__history_stats = {}
         self.update_default_engine()
+        thread = Thread(target=self.__load_history)
+        thread.daemon = True
+        thread.start()
 
     def update_default_engine(self):
         """
@@ -68,10 +102,12 @@ class Search:
         wanted = El().settings.get_value('search-engine').get_string()
         for engine in self.__ENGINES:
             if engine == wanted:
+                self.__engine = engine
                 self.__uri = self.__ENGINES[engine][0]
                 self.__search = self.__ENGINES[engine][1]
                 self.__keywords = self.__ENGINES[engine][2]
                 self.__encoding = self.__ENGINES[engine][3]
+                self.__format = self.__ENGINES[engine][4]
                 break
 
     def get_search_uri(self, words):
@@ -88,25 +124,90 @@ class Search:
             @param words as str
             @param cancellable as Gio.Cancellable
             @return [str]
+            @thread safe
         """
+        key = (self.__engine, words)
+        with self.__lock:
+            keywords = self.__get_cached(key)
+            if keywords is not None:
+                return keywords
+            event = self.__running.get(key)
+            if event is None:
+                event = Event()
+                self.__running[key] = event
+                running = False
+            else:
+                running = True
+        # Same request already running, use its result
+        if running:
+            event.wait()
+            with self.__lock:
+                keywords = self.__get_cached(key)
+            return [] if keywords is None else keywords
+        keywords = None
         try:
             uri = self.__keywords % words
-            session = Soup.Session.new()
-            session.set_property('accept-language-auto', True)
-            request = session.request(uri)
-            stream = request.send(cancellable)
-            bytes = bytearray(0)
-            buf = stream.read_bytes(1024, cancellable).get_data()
-            while buf:
-                bytes += buf
-                buf = stream.read_bytes(1024, cancellable).get_data()
+            bytes = El().http.read(uri, cancellable)
             string = bytes.decode(self.__encoding)
-            # format: '["{"words"}",["result1","result2"]]'
-            keywords = string.replace('[', '').replace(']', '').split(',')[1:]
-            return keywords
+            keywords = self.__parsers[self.__format](string)
         except Exception as e:
             print("Search::get_keywords():", e)
+        with self.__lock:
+            if keywords is not None:
+                self.__cache[key] = (time(), keywords)
+                while len(self.__cache) > self.__CACHE_SIZE:
+                    self.__cache.popitem(last=False)
+            del self.__running[key]
+        event.set()
+        return [] if keywords is None else keywords
+
+    def add_history(self, words):
+        """
+            Remember searched words
+            @param words as str
+        """
+        words = words.strip()
+        if not words:
+            return
+        atime = int(time())
+        El().history.add_search(words, atime)
+        if words in self.__history_stats:
+            count = self.__history_stats[words][0] + 1
+        else:
+            count = 1
+            insort(self.__history_words, (words.lower(), words))
+        self.__history_stats[words] = (count, atime)
+
+    def get_history_keywords(self, words, limit=3):
+        """
+            Get searched words starting with words, best first
+            @param words as str
+            @param limit as int
+            @return [str]
+        """
+        prefix = words.strip().lower()
+        if not prefix:
             return []
+        now = time()
+        matches = []
+        index = bisect_left(self.__history_words, (prefix, ""))
+        while index < len(self.__history_words):
+            (lower, history_words) = self.__history_words[index]
+            if not lower.startswith(prefix):
+                break
+            (count, atime) = self.__history_stats[history_words]
+            score = count * 0.5 ** ((now - atime) / self.__HISTORY_HALF_LIFE)
+            matches.append((score, history_words))
+            index += 1
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return [match[1] for match in matches[:limit]]
+
+    def clear_history(self):
+        """
+            Forget searched words, database is cleared with history
+        """
+        self.__history_words = []
+        self.__history_stats = {}
 
     def is_search(self, string):
         """
@@ -132,3 +233,72 @@ class Search:
 #######################
 # PRIVATE             #
 #######################
+    def __load_history(self):
+        """
+            Read searched words from database
+            @thread safe
+        """
+        try:
+            searches = El().history.get_searches()
+            GLib.idle_add(self.__set_history, searches)
+        except Exception as e:
+            print("Search::__load_history():", e)
+
+    def __set_history(self, searches):
+        """
+            Build prefix index, words searched meanwhile are kept
+            @param searches as [(str, int, int)]
+        """
+        stats = {}
+        for (words, count, atime) in searches:
+            stats[words] = (count, atime)
+        stats.update(self.__history_stats)
+        self.__history_stats = stats
+        self.__history_words = sorted((words.lower(), words)
+                                      for words in stats.keys())
+
+    def __get_cached(self, key):
+        """
+            Get cached keywords, lock must be held
+            Keywords for a longer words are filtered if needed
+            @param key as (str, str)
+            @return [str]/None
+        """
+        now = time()
+        (engine, words) = key
+        value = self.__cache.get(key)
+        if value is not None:
+            if now - value[0] < self.__CACHE_TTL:
+                self.__cache.move_to_end(key)
+                return value[1]
+            del self.__cache[key]
+        # User removed chars, reuse closest longer words
+        closest = None
+        lower = words.lower()
+        for ((cached_engine, cached_words),
+             (cached_time, keywords)) in self.__cache.items():
+            if cached_engine != engine or\
+                    now - cached_time >= self.__CACHE_TTL or\
+                    not cached_words.startswith(words):
+                continue
+            if closest is None or len(cached_words) < len(closest[0]):
+                closest = (cached_words, keywords)
+        if closest is not None:
+            keywords = [keyword for keyword in closest[1]
+                        if keyword.lower().startswith(lower)]
+            if keywords:
+                return keywords
+        return None
+
+    def __parse_opensearch(self, string):
+        """
+            Parse OpenSearch suggestions
+            @param string as str: '["words", ["result1", "result2"]]'
+            @return [str]
+            @raise ValueError
+        """
+        data = json.loads(string)
+        if not isinstance(data, list) or len(data) < 2 or\
+                not isinstance(data[1], list):
+            raise ValueError("Invalid suggestions: %s" % string[:100])
+        return [keyword for keyword in data[1] if isinstance(keyword, str)]
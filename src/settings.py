@@ -105,6 +105,13 @@ class SettingsDialog:
         enable_plugins.set_active(
                                 El().settings.get_value("enable-plugins"))
 
+        stats = El().discarder.stats
+        discarded_label = builder.get_object("discarded_label")
+        discarded_label.set_text(
+                       _("Background pages unloaded this session: %s,"
+                         " memory freed: %s") %
+                       (stats["discarded"], GLib.format_size(stats["freed"])))
+
         self.__fonts_grid = builder.get_object("fonts_grid")
         use_system_fonts = builder.get_object("system_fonts_check")
         use_system_fonts.set_active(
@@ -247,7 +254,8 @@ class SettingsDialog:
         El().settings.set_enum("cookie-storage", int(combo.get_active_id()))
         for window in El().windows:
             for view in window.container.views:
-                El().set_cookie_manager(view.webview.get_context())
+                if not view.discarded:
+                    El().set_cookie_manager(view.webview.get_context())
 
     def _on_default_zoom_changed(self, button):
         """
@@ -504,6 +512,9 @@ class SettingsDialog:
             context.clear_cache()
         if history_button.get_active():
             El().history.clear()
+            El().search.clear_history()
+            El().hosts.clear()
+            El().https.clear_learned()
         if passwords_button.get_active():
             Secret.Service.get(Secret.ServiceFlags.NONE, None,
                                self.__on_get_secret)
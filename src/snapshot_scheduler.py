@@ -0,0 +1,240 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, GLib, WebKit2
+
+from time import time
+from collections import OrderedDict
+
+
+class SnapshotScheduler:
+    """
+        Throttle WebView snapshots
+        - One snapshot per webview every __MIN_INTERVAL seconds
+        - At most __MAX_RUNNING snapshots at once
+        - Requests for rows not shown are deferred until rows are shown
+        - Requests with same uri and load state as last snapshot are dropped
+    """
+    __MIN_INTERVAL = 2
+    __MAX_RUNNING = 2
+
+    def __init__(self):
+        """
+            Init scheduler
+        """
+        # webview: (row, callback, save, force)
+        self.__requests = OrderedDict()
+        self.__hidden = {}
+        # row: [signal ids], rows with deferred requests
+        self.__watched = {}
+        # webview: (time, (uri, loading))
+        self.__last = {}
+        self.__timeouts = {}
+        self.__running = 0
+        self.__requested = 0
+        self.__coalesced = 0
+        self.__skipped = 0
+        self.__taken = 0
+
+    def add(self, row, webview, callback, save, force=False):
+        """
+            Request a snapshot of webview visible region
+            @param row as Gtk.Widget showing snapshot
+            @param webview as WebKit2.WebView
+            @param callback as function(webview, result, save)
+            @param save as bool
+            @param force as bool: page changed without uri/load change
+        """
+        self.__requested += 1
+        self.__unhide(webview)
+        if webview in self.__requests:
+            (pending_row, pending_callback,
+             pending_save, pending_force) = self.__requests[webview]
+            save = save or pending_save
+            force = force or pending_force
+            self.__coalesced += 1
+        self.__requests[webview] = (row, callback, save, force)
+        self.__run()
+
+    def remove(self, webview):
+        """
+            Forget webview
+            @param webview as WebKit2.WebView
+        """
+        self.__requests.pop(webview, None)
+        self.__unhide(webview)
+        self.__last.pop(webview, None)
+        timeout_id = self.__timeouts.pop(webview, None)
+        if timeout_id is not None:
+            GLib.source_remove(timeout_id)
+
+    def retry(self):
+        """
+            Retry deferred requests, rows may be shown now
+        """
+        if not self.__hidden:
+            return
+        for (webview, request) in self.__hidden.items():
+            self.__requests.setdefault(webview, request)
+            self.__unwatch(request[0])
+        self.__hidden = {}
+        self.__run()
+
+    @property
+    def stats(self):
+        """
+            Get snapshots statistics
+            @return {"requested": int, "coalesced": int,
+                     "skipped": int, "taken": int}
+        """
+        return {"requested": self.__requested,
+                "coalesced": self.__coalesced,
+                "skipped": self.__skipped,
+                "taken": self.__taken}
+
+#######################
+# PRIVATE             #
+#######################
+    def __run(self):
+        """
+            Start snapshots allowed by interval and concurrency limits
+        """
+        now = time()
+        for webview in list(self.__requests.keys()):
+            if self.__running >= self.__MAX_RUNNING:
+                return
+            # Waiting for interval
+            if webview in self.__timeouts:
+                continue
+            (row, callback, save, force) = self.__requests[webview]
+            (last_time, last_key) = self.__last.get(webview, (0, None))
+            delay = last_time + self.__MIN_INTERVAL - now
+            if delay > 0:
+                self.__timeouts[webview] = GLib.timeout_add(
+                                                       int(delay * 1000),
+                                                       self.__on_timeout,
+                                                       webview)
+                continue
+            del self.__requests[webview]
+            key = (webview.get_uri(), webview.is_loading())
+            if not force and key == last_key:
+                self.__coalesced += 1
+                continue
+            if not self.__is_shown(row):
+                self.__skipped += 1
+                self.__hidden[webview] = (row, callback, save, force)
+                self.__watch(row)
+                continue
+            self.__running += 1
+            self.__taken += 1
+            self.__last[webview] = (now, key)
+            webview.get_snapshot(WebKit2.SnapshotRegion.VISIBLE,
+                                 WebKit2.SnapshotOptions.NONE,
+                                 None,
+                                 self.__on_snapshot,
+                                 callback,
+                                 save)
+
+    def __is_shown(self, row):
+        """
+            True if row is mapped, not filtered and inside scrolled viewport
+            @param row as Gtk.Widget
+            @return bool
+        """
+        if not row.get_mapped() or row.get_allocated_width() == 1:
+            return False
+        scrolled = row.get_ancestor(Gtk.ScrolledWindow)
+        if scrolled is None:
+            return True
+        coords = row.translate_coordinates(scrolled, 0, 0)
+        if coords is None:
+            return False
+        return coords[1] + row.get_allocated_height() > 0 and\
+            coords[1] < scrolled.get_allocated_height()
+
+    def __watch(self, row):
+        """
+            Retry row deferred requests when row is shown
+            @param row as Gtk.Widget
+        """
+        if row in self.__watched:
+            return
+        self.__watched[row] = [
+            row.connect("map", self.__on_row_map),
+            row.connect("size-allocate", self.__on_row_size_allocate)]
+
+    def __unwatch(self, row):
+        """
+            Stop watching row
+            @param row as Gtk.Widget
+        """
+        for signal_id in self.__watched.pop(row, []):
+            row.disconnect(signal_id)
+
+    def __unhide(self, webview):
+        """
+            Forget webview deferred request
+            @param webview as WebKit2.WebView
+        """
+        request = self.__hidden.pop(webview, None)
+        if request is not None:
+            self.__unwatch(request[0])
+
+    def __retry_row(self, row):
+        """
+            Retry row deferred requests if row is shown now
+            @param row as Gtk.Widget
+        """
+        if not self.__is_shown(row):
+            return
+        self.__unwatch(row)
+        for (webview, request) in list(self.__hidden.items()):
+            if request[0] == row:
+                del self.__hidden[webview]
+                self.__requests.setdefault(webview, request)
+        # Not while allocating
+        GLib.idle_add(self.__run)
+
+    def __on_row_map(self, row):
+        """
+            Retry row deferred requests
+            @param row as Gtk.Widget
+        """
+        self.__retry_row(row)
+
+    def __on_row_size_allocate(self, row, allocation):
+        """
+            Retry row deferred requests, row may be unfiltered
+            @param row as Gtk.Widget
+            @param allocation as Gdk.Rectangle
+        """
+        self.__retry_row(row)
+
+    def __on_timeout(self, webview):
+        """
+            Interval elapsed for webview
+            @param webview as WebKit2.WebView
+        """
+        del self.__timeouts[webview]
+        self.__run()
+
+    def __on_snapshot(self, webview, result, callback, save):
+        """
+            Pass result to requester, start next snapshots
+            @param webview as WebKit2.WebView
+            @param result as Gio.AsyncResult
+            @param callback as function(webview, result, save)
+            @param save as bool
+        """
+        self.__running -= 1
+        callback(webview, result, save)
+        self.__run()
@@ -14,7 +14,6 @@ from gi.repository import Gtk, Gdk, GLib, GObject, WebKit2
 import cairo
 
 from eolie.define import El, ArtSize
-from eolie.utils import resize_favicon, get_favicon_best_uri
 
 
 class SidebarChild(Gtk.ListBoxRow):
@@ -47,11 +46,7 @@ class SidebarChild(Gtk.ListBoxRow):
         self.__spinner = builder.get_object("spinner")
         self.__title.set_label("Empty page")
         self.add(builder.get_object("widget"))
-        view.webview.connect("notify::favicon", self.__on_notify_favicon)
-        view.webview.connect("scroll-event", self.__on_scroll_event)
-        view.webview.connect("notify::uri", self.__on_uri_changed)
-        view.webview.connect("title-changed", self.__on_title_changed)
-        view.webview.connect("load-changed", self.__on_load_changed)
+        self.connect_webview()
         self.get_style_context().add_class("sidebar-item")
 
         self.drag_source_set(Gdk.ModifierType.BUTTON1_MASK, [],
@@ -65,6 +60,7 @@ class SidebarChild(Gtk.ListBoxRow):
         self.connect("drag-data-received", self.__on_drag_data_received)
         self.connect("drag-motion", self.__on_drag_motion)
         self.connect("drag-leave", self.__on_drag_leave)
+        self.connect("destroy", self.__on_destroy)
 
     @property
     def view(self):
@@ -74,21 +70,31 @@ class SidebarChild(Gtk.ListBoxRow):
         """
         return self.__view
 
-    def set_snapshot(self, save):
+    def connect_webview(self):
         """
-            Set webpage preview
+            Follow view webview, needed again when webview is restored
+        """
+        webview = self.__view.webview
+        webview.connect("notify::favicon", self.__on_notify_favicon)
+        webview.connect("scroll-event", self.__on_scroll_event)
+        webview.connect("notify::uri", self.__on_uri_changed)
+        webview.connect("title-changed", self.__on_title_changed)
+        webview.connect("load-changed", self.__on_load_changed)
+
+    def set_snapshot(self, save, force=False):
+        """
+            Set webpage preview, snapshot is throttled by scheduler
+            Discarded views keep their last snapshot
             @param save as bool
+            @param force as bool: page changed without uri/load change
         """
-        if self.__view.webview.private:
+        if self.__view.private:
             self.__image.set_from_icon_name(
                                          "user-not-tracked-symbolic",
                                          Gtk.IconSize.DIALOG)
-        else:
-            self.__view.webview.get_snapshot(WebKit2.SnapshotRegion.VISIBLE,
-                                             WebKit2.SnapshotOptions.NONE,
-                                             None,
-                                             self.__on_snapshot,
-                                             save)
+        elif not self.__view.discarded:
+            El().snapshots.add(self, self.__view.webview,
+                               self.__on_snapshot, save, force)
 
     def clear_snapshot(self):
         """
@@ -147,9 +153,14 @@ class SidebarChild(Gtk.ListBoxRow):
         """
             Set favicon
         """
-        uri = self.__view.webview.get_uri()
-        favicon_db = self.__view.webview.get_context().get_favicon_database()
-        favicon_uri = get_favicon_best_uri(uri)
+        uri = self.__view.uri
+        surface = El().art.get_favicon(uri)
+        if surface is not None:
+            self.__set_favicon_surface(surface)
+            return
+        context = WebKit2.WebContext.get_default()
+        favicon_db = context.get_favicon_database()
+        favicon_uri = El().favicons.get(uri)
         if favicon_uri is None:
             if uri == "populars://":
                 self.__image_close.set_from_icon_name("emote-love-symbolic",
@@ -159,31 +170,38 @@ class SidebarChild(Gtk.ListBoxRow):
                                                       Gtk.IconSize.MENU)
         else:
             favicon_db.get_favicon(favicon_uri, None,
-                                   self.__set_favicon_result)
+                                   self.__set_favicon_result, uri)
 
-    def __set_favicon_result(self, db, result):
+    def __set_favicon_result(self, db, result, uri):
         """
             Set favicon db result
             @param db as WebKit2.FaviconDatabase
             @param result as Gio.AsyncResult
+            @param uri as str
         """
         try:
             surface = db.get_favicon_finish(result)
         except:
             surface = None
         if surface is not None:
-            self.__image_close.set_from_surface(resize_favicon(surface))
+            self.__set_favicon_surface(El().art.add_favicon(uri, surface))
             del surface
-            self.__image_close.get_style_context().remove_class(
-                                                               "sidebar-close")
-            self.__image_close.show()
+
+    def __set_favicon_surface(self, surface):
+        """
+            Show favicon
+            @param surface as cairo.surface
+        """
+        self.__image_close.set_from_surface(surface)
+        self.__image_close.get_style_context().remove_class("sidebar-close")
+        self.__image_close.show()
 
     def __set_snapshot_timeout(self):
         """
             Get snapshot timeout
         """
         self.__scroll_timeout_id = None
-        self.set_snapshot(False)
+        self.set_snapshot(False, True)
 
     def __on_uri_changed(self, view, uri):
         """
@@ -193,7 +211,7 @@ class SidebarChild(Gtk.ListBoxRow):
         """
         uri = view.get_uri()
         # We are not filtered and not in private mode
-        if not self.__view.webview.private and self.get_allocated_width() != 1:
+        if not self.__view.private and self.get_allocated_width() != 1:
             preview = El().art.get_artwork(uri,
                                            "preview",
                                            view.get_scale_factor(),
@@ -269,11 +287,8 @@ class SidebarChild(Gtk.ListBoxRow):
             context.set_source_surface(snapshot, 0, 0)
             context.paint()
             self.__image.set_from_surface(surface)
-            if save:
-                El().art.save_artwork(view.get_uri(),
-                                      surface, "preview")
-            # Manage start page cache
-            if not El().art.exists(view.get_uri(), "start"):
+            # Save master thumbnail, other sizes are derived from it
+            if save or not El().art.exists(view.get_uri(), "master"):
                 width = snapshot.get_width()
                 factor = ArtSize.START_WIDTH / width
                 surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
@@ -283,8 +298,7 @@ class SidebarChild(Gtk.ListBoxRow):
                 context.scale(factor, factor)
                 context.set_source_surface(snapshot, 0, 0)
                 context.paint()
-                El().art.save_artwork(view.get_uri(),
-                                      surface, "start")
+                El().art.save_artwork(view.get_uri(), surface)
             del surface
             del snapshot
         except Exception as e:
@@ -297,8 +311,19 @@ class SidebarChild(Gtk.ListBoxRow):
             @param view as WebView
             @param pointer as GParamPointer
         """
+        uri = view.get_uri()
+        if uri:
+            El().art.uncache(uri, "favicon")
         self.__set_favicon()
 
+    def __on_destroy(self, widget):
+        """
+            Cancel pending snapshots
+            @param widget as Gtk.Widget
+        """
+        if self.__view.webview is not None:
+            El().snapshots.remove(self.__view.webview)
+
     def __on_drag_begin(self, widget, context):
         """
             Set icon
@@ -408,6 +433,8 @@ class StackSidebar(Gtk.Grid):
         self.__listbox.show()
         self.__listbox.connect("row_activated", self.__on_row_activated)
         self.__scrolled.add(self.__listbox)
+        self.__scrolled.get_vadjustment().connect("value-changed",
+                                                  self.__on_scroll_changed)
         self.add(self.__scrolled)
 
     def add_child(self, view):
@@ -420,13 +447,22 @@ class StackSidebar(Gtk.Grid):
         child.show()
         self.__listbox.add(child)
 
+    def connect_view(self, view):
+        """
+            Connect child to view restored webview
+            @param view as View
+        """
+        for child in self.__listbox.get_children():
+            if child.view == view:
+                child.connect_webview()
+                break
+
     def update_children_snapshot(self):
         """
             Update child snapshot
         """
         for row in self.__listbox.get_children():
-            row.clear_snapshot()
-            row.set_snapshot(True)
+            row.set_snapshot(True, True)
 
     def update_visible_child(self):
         """
@@ -455,6 +491,7 @@ class StackSidebar(Gtk.Grid):
         else:
             self.__search_entry.disconnect_by_func(self.__on_key_press)
             self.__listbox.set_filter_func(None)
+            El().snapshots.retry()
         self.__search_bar.set_search_mode(b)
 
     def next(self):
@@ -499,10 +536,10 @@ class StackSidebar(Gtk.Grid):
         child = self.__listbox.get_row_at_index(child_index)
         if child is None:
             return
-        El().pages_menu.add_action(view.webview.get_title(),
-                                   view.webview.get_uri(),
-                                   view.webview.private,
-                                   view.webview.get_session_state())
+        El().pages_menu.add_action(view.title,
+                                   view.uri,
+                                   view.private,
+                                   view.session_state)
         GLib.timeout_add(1000, view.destroy)
         child.destroy()
         # Nothing to do if was not current page
@@ -593,8 +630,8 @@ class StackSidebar(Gtk.Grid):
         filter = self.__search_entry.get_text()
         if not filter:
             return True
-        uri = row.view.webview.get_uri()
-        title = row.view.webview.get_title()
+        uri = row.view.uri
+        title = row.view.title
         if (uri is not None and uri.find(filter) != -1) or\
                 (title is not None and title.find(filter) != -1):
             return True
@@ -615,6 +652,13 @@ class StackSidebar(Gtk.Grid):
             child_index += 1
         self.__listbox.insert(row, child_index)
 
+    def __on_scroll_changed(self, adjustment):
+        """
+            Take snapshots deferred while rows were not shown
+            @param adjustment as Gtk.Adjustment
+        """
+        El().snapshots.retry()
+
     def __on_key_press(self, widget, event):
         """
             If Esc, hide widget, why GTK doesn't do that?
@@ -0,0 +1,99 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+
+class SurfaceCache:
+    """
+        LRU of decoded cairo surfaces, bounded by pixel bytes
+        Keys are (encoded uri, suffix, width, height, scale factor)
+        Main thread only
+    """
+
+    def __init__(self, max_bytes):
+        """
+            Init cache
+            @param max_bytes as int
+        """
+        self.__max_bytes = max_bytes
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__surfaces = OrderedDict()
+
+    def get(self, key):
+        """
+            Get surface for key
+            @param key as (str, str, int, int, int)
+            @return cairo.surface/None
+        """
+        surface = self.__surfaces.get(key)
+        if surface is None:
+            self.__misses += 1
+        else:
+            self.__hits += 1
+            self.__surfaces.move_to_end(key)
+        return surface
+
+    def add(self, key, surface):
+        """
+            Add surface, drop least recently used ones if needed
+            @param key as (str, str, int, int, int)
+            @param surface as cairo.ImageSurface
+        """
+        self.__pop(key)
+        self.__surfaces[key] = surface
+        self.__bytes += self.__get_bytes(surface)
+        while self.__bytes > self.__max_bytes and len(self.__surfaces) > 1:
+            self.__pop(next(iter(self.__surfaces)))
+
+    def remove(self, encoded, suffix):
+        """
+            Remove surfaces for encoded uri and suffix, at any size
+            @param encoded as str
+            @param suffix as str
+        """
+        for key in [key for key in self.__surfaces.keys()
+                    if key[0] == encoded and key[1] == suffix]:
+            self.__pop(key)
+
+    @property
+    def stats(self):
+        """
+            Get cache statistics
+            @return {"bytes": int, "entries": int, "hit_rate": float}
+        """
+        requests = self.__hits + self.__misses
+        return {"bytes": self.__bytes,
+                "entries": len(self.__surfaces),
+                "hit_rate": self.__hits / requests if requests else 0.0}
+
+#######################
+# PRIVATE             #
+#######################
+    def __pop(self, key):
+        """
+            Remove key from cache
+            @param key as (str, str, int, int, int)
+        """
+        surface = self.__surfaces.pop(key, None)
+        if surface is not None:
+            self.__bytes -= self.__get_bytes(surface)
+
+    def __get_bytes(self, surface):
+        """
+            Get surface pixel bytes
+            @param surface as cairo.ImageSurface
+            @return int
+        """
+        return surface.get_stride() * surface.get_height()
@@ -0,0 +1,228 @@
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib
+
+from os import sysconf
+from time import time
+
+from eolie.define import El, PAGES_PATH
+from eolie.utils import debug
+
+
+class TabDiscarder:
+    """
+        Discard background views webviews to free memory
+        - Views not shown for __IDLE_TIMEOUT seconds
+        - Least recently shown views above __MAX_LIVE per window
+        - Least recently shown view, one per interval, while system memory
+          is low
+        Current, private, loading and playing views are kept
+        Discarded views are restored when shown again
+    """
+    __INTERVAL = 60
+    __IDLE_TIMEOUT = 1800
+    __MAX_LIVE = 10
+    # Memory is low when available memory is below this ratio
+    __LOW_MEMORY = 0.1
+
+    def __init__(self):
+        """
+            Init discarder
+        """
+        self.__discarded = 0
+        self.__freed = 0
+        d = Gio.File.new_for_path(PAGES_PATH)
+        try:
+            if d.query_exists():
+                # Page ids from previous session
+                self.__remove_pages(set())
+            else:
+                d.make_directory_with_parents()
+        except Exception as e:
+            print("TabDiscarder::__init__():", e)
+        GLib.timeout_add_seconds(self.__INTERVAL, self.__on_timeout)
+
+    def discard(self, view):
+        """
+            Discard view webview
+            @param view as View
+        """
+        if view.discarded:
+            return
+        page_id = view.webview.get_page_id()
+        pid = self.__get_pid(page_id)
+        memory = self.get_memory(view)
+        view.discard()
+        self.__discarded += 1
+        # Web process is only freed if no other view uses it
+        if pid is not None and pid not in self.__get_pids():
+            self.__freed += memory
+        try:
+            f = Gio.File.new_for_path("%s/%s" % (PAGES_PATH, page_id))
+            f.delete(None)
+        except:
+            pass
+        debug("TabDiscarder: %s, %s" % (view.uri, self.stats))
+
+    def get_memory(self, view):
+        """
+            Get resident memory of view web process
+            Related views share their web process
+            @param view as View
+            @return int (bytes)
+        """
+        if view.discarded:
+            return 0
+        pid = self.__get_pid(view.webview.get_page_id())
+        if pid is None:
+            return 0
+        try:
+            f = Gio.File.new_for_path("/proc/%s/statm" % pid)
+            (status, content, tag) = f.load_contents(None)
+            return int(content.split()[1]) * sysconf("SC_PAGE_SIZE")
+        except:
+            return 0
+
+    @property
+    def stats(self):
+        """
+            Get session statistics
+            freed only counts web processes not used by other views
+            @return {"discarded": int, "freed": int (bytes)}
+        """
+        return {"discarded": self.__discarded,
+                "freed": self.__freed}
+
+#######################
+# PRIVATE             #
+#######################
+    def __get_pid(self, page_id):
+        """
+            Get web process pid for page
+            @param page_id as int
+            @return int/None
+        """
+        try:
+            f = Gio.File.new_for_path("%s/%s" % (PAGES_PATH, page_id))
+            (status, content, tag) = f.load_contents(None)
+            pid = int(content.decode("utf-8"))
+            # Web process may be gone and its pid reused
+            f = Gio.File.new_for_path("/proc/%s/cmdline" % pid)
+            (status, content, tag) = f.load_contents(None)
+            if content.find(b"WebKitWebProcess") == -1:
+                return None
+            return pid
+        except:
+            return None
+
+    def __get_page_ids(self):
+        """
+            Get page ids of views not discarded
+            @return set(int)
+        """
+        page_ids = set()
+        for window in El().windows:
+            for view in window.container.views:
+                if not view.discarded:
+                    page_ids.add(view.webview.get_page_id())
+        return page_ids
+
+    def __get_pids(self):
+        """
+            Get web processes pids of views not discarded
+            @return set(int)
+        """
+        pids = set()
+        for page_id in self.__get_page_ids():
+            pid = self.__get_pid(page_id)
+            if pid is not None:
+                pids.add(pid)
+        return pids
+
+    def __remove_pages(self, page_ids):
+        """
+            Remove pid files for pages not in page_ids
+            Closed views and crashed web processes leave them behind
+            @param page_ids as set(int)
+        """
+        d = Gio.File.new_for_path(PAGES_PATH)
+        infos = d.enumerate_children("standard::name",
+                                     Gio.FileQueryInfoFlags.NONE,
+                                     None)
+        for info in infos:
+            name = info.get_name()
+            if name.isdigit() and int(name) in page_ids:
+                continue
+            try:
+                d.get_child(name).delete(None)
+            except Exception as e:
+                print("TabDiscarder::__remove_pages():", e)
+
+    def __get_candidates(self, window):
+        """
+            Get window views that can be discarded, least recently shown first
+            @param window as Window
+            @return [View]
+        """
+        current = window.container.current
+        candidates = []
+        for view in window.container.views:
+            if view == current or view.discarded or view.private:
+                continue
+            if view.webview.is_loading() or\
+                    view.webview.is_playing_audio():
+                continue
+            candidates.append(view)
+        return sorted(candidates, key=lambda view: view.atime)
+
+    def __is_memory_low(self):
+        """
+            True if available system memory is low
+            @return bool
+        """
+        try:
+            meminfo = {}
+            with open("/proc/meminfo", "r") as f:
+                for line in f:
+                    (key, value) = line.split(":", 1)
+                    meminfo[key] = int(value.split()[0])
+            return meminfo["MemAvailable"] <\
+                meminfo["MemTotal"] * self.__LOW_MEMORY
+        except Exception as e:
+            print("TabDiscarder::__is_memory_low():", e)
+            return False
+
+    def __on_timeout(self):
+        """
+            Apply discard policies
+        """
+        try:
+            self.__remove_pages(self.__get_page_ids())
+        except Exception as e:
+            print("TabDiscarder::__on_timeout():", e)
+        now = time()
+        oldest = None
+        for window in El().windows:
+            candidates = self.__get_candidates(window)
+            live = len([view for view in window.container.views
+                        if not view.discarded])
+            count = max(0, live - self.__MAX_LIVE)
+            for (i, view) in enumerate(candidates):
+                if i < count or now - view.atime > self.__IDLE_TIMEOUT:
+                    self.discard(view)
+                elif oldest is None or view.atime < oldest.atime:
+                    oldest = view
+        # Memory is checked again on next interval
+        if oldest is not None and self.__is_memory_low():
+            self.discard(oldest)
+        return True
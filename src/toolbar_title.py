@@ -36,6 +36,7 @@ class ToolbarTitle(Gtk.Bin):
         self.__signal_id = None
         self.__secure_content = True
         self.__keywords_timeout = None
+        self.__completion_value = ""
         self.__icon_grid_width = None
         self.__keywords_cancellable = Gio.Cancellable.new()
         builder = Gtk.Builder()
@@ -416,6 +417,8 @@ class ToolbarTitle(Gtk.Bin):
         parsed = urlparse(uri)
         if parsed.scheme not in ["http", "https", "file", "populars"] and\
                 El().search.is_search(uri):
+            if not self.__window.container.current.webview.private:
+                El().search.add_history(uri)
             uri = El().search.get_search_uri(uri)
         self.__window.container.load_uri(uri)
         self.__window.container.current.webview.grab_focus()
@@ -491,8 +494,26 @@ class ToolbarTitle(Gtk.Bin):
         keywords = El().search.get_keywords(value, self.__keywords_cancellable)
         for words in keywords:
             if words:
-                GLib.idle_add(self.__popover.add_keywords,
-                              words.replace('"', ''))
+                GLib.idle_add(self.__popover.add_keywords, words)
+
+    def __complete_host(self, value):
+        """
+            Complete entry with best host, completion is selected
+            @param value as str
+        """
+        if self.__entry.get_text() != value or\
+                self.__entry.get_position() != len(value):
+            return
+        host = El().hosts.get(value)
+        if host is None:
+            return
+        self.__entry.disconnect(self.__signal_id)
+        self.__entry.set_text(value + host[len(value):])
+        self.__entry.select_region(len(value), -1)
+        self.__signal_id = self.__entry.connect("changed",
+                                                self.__on_entry_changed)
+        if not self.__window.container.current.webview.private:
+            El().prefetcher.prefetch_host(host)
 
     def __on_popover_closed(self, popover):
         """
@@ -517,6 +538,14 @@ class ToolbarTitle(Gtk.Bin):
             self.__popover.set_search_text(parsed.netloc + parsed.path)
         else:
             self.__popover.set_search_text(value)
+            # Offline keywords first, network ones come later
+            for words in El().search.get_history_keywords(value):
+                self.__popover.add_keywords(words)
+            # Do not complete again when user removes chars
+            if value and not self.__completion_value.startswith(value) and\
+                    value.find(" ") == -1 and entry.has_focus():
+                GLib.idle_add(self.__complete_host, value)
+        self.__completion_value = value
         if value:
             self.__placeholder.set_opacity(0)
             # We are doing a search, show popover
@@ -15,33 +15,14 @@ from gi.repository import Gdk, GLib
 import unicodedata
 from urllib.parse import urlparse
 import string
-import sqlite3
 import cairo
 from random import choice
 from base64 import b64encode
+from threading import local
 
 from eolie.define import El, ArtSize
 
-
-def get_favicon_best_uri(uri):
-    """
-        Search in WebKit DB for best uri
-        @param uri as str
-    """
-    favicon_uri = None
-    parsed = urlparse(uri)
-    for uri in [parsed.netloc + parsed.path, parsed.netloc]:
-        if parsed.scheme not in ["http", "https"]:
-            continue
-        sql = sqlite3.connect(El().favicons_path, 600.0)
-        result = sql.execute("SELECT url\
-                              FROM PageURL\
-                              WHERE url LIKE ?", ("%{}%".format(uri),))
-        v = result.fetchone()
-        if v is not None:
-            favicon_uri = v[0]
-            break
-    return favicon_uri
+_tracking = local()
 
 
 def resize_favicon(favicon):
@@ -134,3 +115,21 @@ def strip_uri(uri, prefix=True, suffix=True):
     else:
         new_uri = parsed.netloc
     return new_uri.rstrip('/')
+
+
+def set_changes_tracking(enabled):
+    """
+        Enable/disable db change log for current thread
+        Sync disables it while applying remote changes
+        @param enabled as bool
+    """
+    _tracking.enabled = enabled
+
+
+def is_changes_tracking():
+    """
+        True if db writes from current thread go to change log
+        Registered as tracking() SQL function, used by triggers
+        @return bool
+    """
+    return getattr(_tracking, "enabled", True)
@@ -12,6 +12,9 @@
 
 from gi.repository import Gtk, GLib, Pango
 
+from time import time
+
+from eolie.define import El
 from eolie.widget_find import FindWidget
 from eolie.view_web import WebView
 
@@ -73,7 +76,10 @@ class UriLabel(Gtk.EventBox):
 class View(Gtk.Overlay):
     """
         A webview with a find widget
+        Webview can be discarded to free memory and restored later
     """
+    # Hovered link host is prefetched after this delay (ms)
+    __PREFETCH_DWELL = 200
 
     def __init__(self, private=False, parent=None, webview=None):
         """
@@ -83,25 +89,119 @@ class View(Gtk.Overlay):
         """
         Gtk.Overlay.__init__(self)
         self.__parent = parent
+        self.__prefetch_timeout = None
+        # Last time view was shown
+        self.__atime = time()
+        # (uri, title, session state) when webview is discarded
+        self.__discarded = None
         if parent is not None:
             parent.connect("destroy", self.__on_parent_destroy)
         if webview is None:
-            self.__webview = WebView(private)
-        else:
-            self.__webview = webview
-        self.__webview.show()
-        self.__find_widget = FindWidget(self.__webview)
-        self.__find_widget.show()
-        grid = Gtk.Grid()
-        grid.set_orientation(Gtk.Orientation.VERTICAL)
-        grid.add(self.__find_widget)
-        grid.add(self.__webview)
-        grid.show()
-        self.add(grid)
+            webview = WebView(private)
+        self.__private = webview.private
+        self.__grid = Gtk.Grid()
+        self.__grid.set_orientation(Gtk.Orientation.VERTICAL)
+        self.__grid.show()
+        self.add(self.__grid)
         self.__uri_label = UriLabel()
         self.add_overlay(self.__uri_label)
-        self.__webview.connect("mouse-target-changed",
-                               self.__on_mouse_target_changed)
+        self.__set_webview(webview)
+
+    def discard(self):
+        """
+            Save webview session and destroy it
+        """
+        if self.__discarded is not None:
+            return
+        if self.__prefetch_timeout is not None:
+            GLib.source_remove(self.__prefetch_timeout)
+            self.__prefetch_timeout = None
+        self.__uri_label.hide()
+        self.__discarded = (self.__webview.get_uri(),
+                            self.__webview.get_title(),
+                            self.__webview.get_session_state())
+        El().snapshots.remove(self.__webview)
+        self.__find_widget.destroy()
+        self.__webview.destroy()
+        self.__find_widget = None
+        self.__webview = None
+
+    def restore(self):
+        """
+            Create a new webview with saved session
+        """
+        if self.__discarded is None:
+            return
+        (uri, title, state) = self.__discarded
+        self.__discarded = None
+        webview = WebView(self.__private)
+        webview.restore_session_state(state)
+        self.__set_webview(webview)
+        item = webview.get_back_forward_list().get_current_item()
+        if item is not None:
+            webview.go_to_back_forward_list_item(item)
+        elif uri is not None:
+            webview.load_uri(uri)
+
+    def set_accessed(self):
+        """
+            View is shown to user
+        """
+        self.__atime = time()
+
+    @property
+    def discarded(self):
+        """
+            True if webview is discarded
+            @return bool
+        """
+        return self.__discarded is not None
+
+    @property
+    def atime(self):
+        """
+            Get last time view was shown
+            @return float
+        """
+        return self.__atime
+
+    @property
+    def uri(self):
+        """
+            Get uri, even if discarded
+            @return str
+        """
+        if self.__discarded is not None:
+            return self.__discarded[0]
+        return self.__webview.get_uri()
+
+    @property
+    def title(self):
+        """
+            Get title, even if discarded
+            @return str
+        """
+        if self.__discarded is not None:
+            return self.__discarded[1]
+        return self.__webview.get_title()
+
+    @property
+    def session_state(self):
+        """
+            Get session state, even if discarded
+            @return WebKit2.WebViewSessionState
+        """
+        if self.__discarded is not None:
+            return self.__discarded[2]
+        return self.__webview.get_session_state()
+
+    @property
+    def private(self):
+        """
+            True if view is private
+            @return bool
+        """
+        return self.__private
 
     @property
     def parent(self):
@@ -115,7 +215,7 @@ class View(Gtk.Overlay):
     def webview(self):
         """
             Get webview
-            @return WebView
+            @return WebView/None if discarded
         """
         return self.__webview
 
@@ -130,6 +230,20 @@ class View(Gtk.Overlay):
 #######################
 # PRIVATE             #
 #######################
+    def __set_webview(self, webview):
+        """
+            Show webview and its find widget
+            @param webview as WebView
+        """
+        self.__webview = webview
+        self.__webview.show()
+        self.__find_widget = FindWidget(self.__webview)
+        self.__find_widget.show()
+        self.__grid.add(self.__find_widget)
+        self.__grid.add(self.__webview)
+        self.__webview.connect("mouse-target-changed",
+                               self.__on_mouse_target_changed)
+
     def __on_mouse_target_changed(self, view, hit, modifiers):
         """
             Show uri in title bar
@@ -137,12 +251,30 @@ class View(Gtk.Overlay):
             @param hit as WebKit2.HitTestResult
             @param modifier as Gdk.ModifierType
         """
+        if self.__prefetch_timeout is not None:
+            GLib.source_remove(self.__prefetch_timeout)
+            self.__prefetch_timeout = None
         if hit.context_is_link():
             self.__uri_label.set_text(hit.get_link_uri())
             self.__uri_label.show()
+            # Private views do not leak hovered hosts to resolver
+            if self.__private:
+                return
+            self.__prefetch_timeout = GLib.timeout_add(
+                                                   self.__PREFETCH_DWELL,
+                                                   self.__on_prefetch_timeout,
+                                                   hit.get_link_uri())
         else:
             self.__uri_label.hide()
 
+    def __on_prefetch_timeout(self, uri):
+        """
+            Mouse still on link, prefetch its host
+            @param uri as str
+        """
+        self.__prefetch_timeout = None
+        El().prefetcher.prefetch(uri)
+
     def __on_parent_destroy(self, view):
         """
             Remove parent
@@ -14,7 +14,7 @@ from gi.repository import WebKit2, GObject, Gio, GLib, Gdk
 
 import ctypes
 from gettext import gettext as _
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
 
 from eolie.define import El, LOGINS, PASSWORDS
 from eolie.utils import get_ftp_cmd, debug
@@ -92,6 +92,8 @@ class WebView(WebKit2.WebView):
         elif parsed.scheme != "accept":
             self.__bad_tls = None
             self.__insecure_content_detected = False
+        # Do not wait for a redirect to https
+        uri = El().https.upgrade(uri)
         self.__loaded_uri = uri
         WebKit2.WebView.load_uri(self, uri)
 
@@ -198,6 +200,8 @@ class WebView(WebKit2.WebView):
         self.__cancellable = Gio.Cancellable()
         self.__input_source = Gdk.InputSource.MOUSE
         self.__loaded_uri = ""
+        # Last uri of current navigation redirect chain
+        self.__redirect_uri = ""
         self.__title = ""
         self.__document_font_size = "14pt"
         self.__bad_tls = None  # Keep bad TLS certificate
@@ -259,6 +263,8 @@ class WebView(WebKit2.WebView):
         # It sets title with content for one shot, so try to get it here
         self.connect("notify::title", self.__on_title_changed)
         self.connect("notify::uri", self.__on_uri_changed)
+        if not private:
+            self.connect("notify::favicon", self.__on_notify_favicon)
 
         context = self.get_context()
         if private:
@@ -371,34 +377,8 @@ class WebView(WebKit2.WebView):
             Show populars web pages
             @param request as WebKit2.URISchemeRequest
         """
-        items = []
-        # First from bookmarks
-        for (bookmark_id, title, uri) in El().bookmarks.get_populars(20):
-            items.append((title, uri))
-        # Then from history
-        more = 20 - len(items)
-        if more > 0:
-            for (title, uri) in El().history.search("", more):
-                if (title, uri) not in items:
-                    items.append((title, uri))
-        start = Gio.File.new_for_uri("resource:///org/gnome/Eolie/start.html")
-        end = Gio.File.new_for_uri("resource:///org/gnome/Eolie/end.html")
-        (status, start_content, tag) = start.load_contents(None)
-        (status, end_content, tag) = end.load_contents(None)
-        # Update start
-        html_start = start_content.decode("utf-8")
-        html_start = html_start.replace("@TITLE@", _("Popular pages"))
-        for (title, uri) in items:
-            f = Gio.File.new_for_path(El().art.get_path(uri, "preview"))
-            if not f.query_exists():
-                continue
-            path = El().art.get_path(uri, "start")
-            html_start += '<a class="child" title="%s" href="%s">' % (title,
-                                                                      uri)
-            html_start += '<img src="file://%s"></img>' % path
-            html_start += '<div class="caption">%s</div></a>' % title
-        html = html_start.encode("utf-8") + end_content
-        stream = Gio.MemoryInputStream.new_from_data(html)
+        html = El().populars.get_html()
+        stream = Gio.MemoryInputStream.new_from_bytes(html)
         request.finish(stream, -1, "text/html")
 
     def __on_internal_scheme(self, request):
@@ -406,6 +386,24 @@ class WebView(WebKit2.WebView):
             Load an internal resource
             @param request as WebKit2.URISchemeRequest
         """
+        parsed = urlparse(request.get_uri())
+        # Thumbnail from art cache, only for populars page: other pages
+        # could use it to probe history
+        if parsed.path == "/thumbnail":
+            uri = unquote(parsed.query)
+            webview = request.get_web_view()
+            if webview is None or webview.get_uri() != "populars://" or\
+                    not El().art.access(uri, "master"):
+                request.finish_error(GLib.Error(uri))
+                return
+            try:
+                f = Gio.File.new_for_path(El().art.get_path(uri, "master"))
+                request.finish(f.read(), -1, "image/png")
+            except Exception as e:
+                # Evicted since access()
+                print("WebView::__on_internal_scheme():", e)
+                request.finish_error(GLib.Error(uri))
+            return
         # We use internal:/ because resource:/ is already used by WebKit2
         uri = request.get_uri().replace("internal:/", "resource:/")
         f = Gio.File.new_for_uri(uri)
@@ -435,6 +433,16 @@ class WebView(WebKit2.WebView):
             self.__in_read_mode = False
             self.__js_timeout = None
 
+    def __on_notify_favicon(self, webview, param):
+        """
+            Tell favicon resolver about new favicon
+            @param webview as WebKit2.WebView
+            @param param as GParamSpec
+        """
+        uri = webview.get_uri()
+        if uri and webview.get_favicon() is not None:
+            El().favicons.add(uri)
+
     def __on_title_changed(self, webview, event):
         """
             We launch Readability.js at page loading finished.
@@ -503,6 +511,46 @@ class WebView(WebKit2.WebView):
         """
         El().download_manager.add(download)
 
+    def __learn_https(self, previous, uri):
+        """
+            Remember host if navigation was redirected from http to https
+            @param previous as str: uri before redirect
+            @param uri as str
+        """
+        if self.private or not previous or not uri:
+            return
+        loaded = urlparse(previous)
+        parsed = urlparse(uri)
+        if loaded.scheme != "http" or parsed.scheme != "https" or\
+                not loaded.hostname or not parsed.hostname:
+            return
+        # Redirects often add or remove www.
+        hosts = [loaded.hostname, parsed.hostname]
+        for (i, host) in enumerate(hosts):
+            if host.startswith("www."):
+                hosts[i] = host[4:]
+        if hosts[0] == hosts[1]:
+            El().https.add(loaded.hostname)
+
+    def __fallback_http(self, uri, error):
+        """
+            Forget learned host and load uri with http
+            @param uri as str
+            @param error as GLib.Error
+            @return True if http uri is loaded
+        """
+        # Stopped by user or by a new load, not a network failure
+        policy = WebKit2.PolicyError
+        if error.code in [WebKit2.NetworkError.CANCELLED,
+                          policy.FRAME_LOAD_INTERRUPTED_BY_POLICY_CHANGE]:
+            return False
+        parsed = urlparse(uri)
+        if parsed.scheme != "https" or not parsed.hostname or\
+                not El().https.remove_learned(parsed.hostname):
+            return False
+        self.load_uri(parsed._replace(scheme="http").geturl())
+        return True
+
     def __on_load_changed(self, view, event):
         """
             Update sidebar/urlbar
@@ -513,6 +561,12 @@ class WebView(WebKit2.WebView):
             self.set_setting("auto-load-images",
                              not El().settings.get_value("imgblock"))
             self.__title = ""
+            self.__redirect_uri = view.get_uri()
+            if not self.__private:
+                El().prefetcher.add_navigation(view.get_uri())
+        elif event == WebKit2.LoadEvent.REDIRECTED:
+            self.__learn_https(self.__redirect_uri, view.get_uri())
+            self.__redirect_uri = view.get_uri()
         if event == WebKit2.LoadEvent.COMMITTED:
             self.update_zoom_level()
         elif event == WebKit2.LoadEvent.FINISHED:
@@ -546,6 +600,9 @@ class WebView(WebKit2.WebView):
         """
         network_available = Gio.NetworkMonitor.get_default(
                                                       ).get_network_available()
+        # Learned host may not serve https, retry with http
+        if network_available and self.__fallback_http(uri, error):
+            return True
         # Ignore all others errors
         if error.code not in [2, 4]:
             return False
@@ -582,14 +639,8 @@ class WebView(WebKit2.WebView):
                        _("Retry"))
         self.load_html(html, None)
         if network_available:
-            # Remove preview and start as should be wrong
-            for suffix in ["preview", "start"]:
-                path = El().art.get_path(uri, suffix)
-                f = Gio.File.new_for_path(path)
-                try:
-                    f.delete()
-                except:
-                    pass
+            # Remove thumbnail as should be wrong
+            El().art.remove(uri)
         else:
             GLib.timeout_add(1000, self.__check_for_network, uri)
         return True
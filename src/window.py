@@ -66,7 +66,8 @@ class Window(Gtk.ApplicationWindow):
             self.__monitor_model = monitor_model
             # Update view zoom level
             for view in self.__container.views:
-                view.webview.update_zoom_level()
+                if not view.discarded:
+                    view.webview.update_zoom_level()
 
     @property
     def container(self):
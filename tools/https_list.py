@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Convert Chromium HSTS preload list to Eolie https upgrade list
+
+    Input is transport_security_state_static.json, output goes to
+    data/https-upgrade.txt for shipping or to
+    ~/.local/share/eolie/https-upgrade.txt for a local update.
+
+    Usage: tools/https_list.py INPUT OUTPUT
+"""
+
+import re
+import sys
+import json
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        # File has // comments
+        content = re.sub(r"^\s*//.*$", "", f.read(), flags=re.MULTILINE)
+    entries = json.loads(content)["entries"]
+    lines = set()
+    for entry in entries:
+        if entry.get("mode") != "force-https":
+            continue
+        if entry.get("include_subdomains", False):
+            lines.add("*." + entry["name"])
+        else:
+            lines.add(entry["name"])
+    with open(sys.argv[2], "w", encoding="utf-8") as f:
+        f.write("# Hosts served over https, http requests to them"
+                " are upgraded\n")
+        f.write("# One host per line, \"*.\" prefix to include subdomains\n")
+        for line in sorted(lines, key=lambda line: line.lstrip("*.")):
+            f.write(line + "\n")
+    print("%s hosts written" % len(lines))
+
+
+if __name__ == "__main__":
+    main()
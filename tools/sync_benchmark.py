@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 Cedric Bellegarde <cedric.bellegarde@adishatz.org>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Offline Mozilla Sync benchmark
+
+    Starts a local stand-in for the tokenserver and the Sync 1.5 storage
+    server, fills it with N encrypted bookmarks and history records, then
+    runs a first sync, a no-op sync and an incremental sync with
+    SyncWorker against it.
+
+    Usage: tools/sync_benchmark.py [-n RECORDS] [-c CHANGED_PERCENT]
+
+    Uses installed eolie modules, or the ones from src/ if not installed.
+    Local databases are created in a temporary XDG_DATA_HOME.
+"""
+
+import os
+import sys
+import json
+import hmac
+import base64
+import tempfile
+import argparse
+from hashlib import sha256
+from threading import Thread, Lock
+from time import time, process_time
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from Crypto.Cipher import AES
+from Crypto import Random
+
+
+class MockSyncServer(ThreadingMixIn, HTTPServer):
+    """
+        Tokenserver and Sync 1.5 storage server stand-in
+        Authentication is not checked
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        """
+            Init server on a random local port
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MockSyncHandler)
+        self.lock = Lock()
+        self.collections = {}
+        self.requests = 0
+        self.bytes = 0
+
+    def start(self):
+        """
+            Serve in a background thread
+        """
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def put(self, collection, record, modified=None):
+        """
+            Store a BSO
+            @param collection as str
+            @param record as {}
+            @param modified as float
+            @return modified as float
+        """
+        if modified is None:
+            modified = round(time(), 2)
+        bso = self.collections.setdefault(collection, {}).setdefault(
+                                                             record["id"], {})
+        bso.update(record)
+        bso["modified"] = modified
+        return modified
+
+    def reset_counters(self):
+        """
+            Reset requests and bytes counters
+        """
+        self.requests = 0
+        self.bytes = 0
+
+    @property
+    def uri(self):
+        """
+            Get server uri
+            @return str
+        """
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+
+class MockSyncHandler(BaseHTTPRequestHandler):
+    """
+        Handle one request for MockSyncServer
+    """
+    protocol_version = "HTTP/1.1"
+    __STORAGE_PREFIX = "/1.5/1"
+
+    def log_message(self, format, *args):
+        """
+            Be quiet
+        """
+        pass
+
+    def do_GET(self):
+        """
+            Tokenserver and storage reads
+        """
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        path = parsed.path
+        if path == "/1.0/sync/1.5":
+            endpoint = self.server.uri + self.__STORAGE_PREFIX
+            self.__reply({"id": "benchmark",
+                          "key": "benchmark",
+                          "uid": 1,
+                          "api_endpoint": endpoint,
+                          "duration": 3600,
+                          "hashalg": "sha256"})
+            return
+        path = path[len(self.__STORAGE_PREFIX):]
+        with self.server.lock:
+            if path == "/info/collections":
+                mtimes = {name: max([bso["modified"]
+                                     for bso in bsos.values()] + [0])
+                          for name, bsos in self.server.collections.items()}
+                since = self.headers.get("X-If-Modified-Since", None)
+                if since is not None and\
+                        max(mtimes.values()) <= float(since):
+                    self.__not_modified()
+                else:
+                    self.__reply(mtimes)
+                return
+            split = self.__split_path()
+            if len(split) == 3 and split[0] == "storage":
+                bso = self.server.collections.get(split[1], {}).get(split[2])
+                if bso is None:
+                    self.__reply({}, 404)
+                else:
+                    self.__reply(bso)
+            elif len(split) == 2 and split[0] == "storage":
+                bsos = self.server.collections.get(split[1], {}).values()
+                if "newer" in params:
+                    newer = float(params["newer"][0])
+                    bsos = [bso for bso in bsos if bso["modified"] > newer]
+                if "ids" in params:
+                    ids = set(params["ids"][0].split(","))
+                    bsos = [bso for bso in bsos if bso["id"] in ids]
+                if "full" in params:
+                    self.__reply(list(bsos))
+                else:
+                    self.__reply([bso["id"] for bso in bsos])
+            else:
+                self.__reply({}, 404)
+
+    def do_PUT(self):
+        """
+            Store one BSO
+        """
+        record = self.__read()
+        split = self.__split_path()
+        record["id"] = split[2]
+        record.pop("modified", None)
+        with self.server.lock:
+            self.__reply(self.server.put(split[1], record))
+
+    def do_POST(self):
+        """
+            Store a batch of BSOs
+        """
+        records = self.__read()
+        split = self.__split_path()
+        modified = round(time(), 2)
+        with self.server.lock:
+            for record in records:
+                record.pop("modified", None)
+                self.server.put(split[1], record, modified)
+            self.__reply({"modified": modified,
+                          "success": [record["id"] for record in records],
+                          "failed": {}})
+
+    def do_DELETE(self):
+        """
+            Delete one BSO or a list of BSOs
+        """
+        params = parse_qs(urlparse(self.path).query)
+        split = self.__split_path()
+        with self.server.lock:
+            bsos = self.server.collections.get(split[1], {})
+            if len(split) == 3:
+                bsos.pop(split[2], None)
+            elif "ids" in params:
+                for guid in params["ids"][0].split(","):
+                    bsos.pop(guid, None)
+            self.__reply({"modified": round(time(), 2)})
+
+    def __split_path(self):
+        """
+            Split storage path
+            @return [str]
+        """
+        path = urlparse(self.path).path[len(self.__STORAGE_PREFIX):]
+        return path.strip("/").split("/")
+
+    def __read(self):
+        """
+            Read JSON request body
+            @return object
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.server.bytes += length
+        return json.loads(body.decode("utf-8"))
+
+    def __not_modified(self):
+        """
+            Send 304 response
+        """
+        self.server.requests += 1
+        self.send_response(304)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def __reply(self, data, status=200):
+        """
+            Send JSON response
+            @param data as object
+            @param status as int
+        """
+        body = json.dumps(data).encode("utf-8")
+        self.server.requests += 1
+        self.server.bytes += len(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Weave-Timestamp", str(round(time(), 2)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FixtureGenerator:
+    """
+        Generate encrypted bookmarks and history records
+    """
+    __OLDSYNC_INFO = "identity.mozilla.com/picl/v1/oldsync"
+
+    def __init__(self, server, master_key):
+        """
+            Init generator and store crypto/keys record
+            @param server as MockSyncServer
+            @param master_key as bytes
+        """
+        from eolie.mozilla_sync import KeyBundle
+        self.__server = server
+        self.__bulk_keys = KeyBundle(Random.new().read(32),
+                                     Random.new().read(32))
+        sync_keys = KeyBundle.fromMasterKey(master_key, self.__OLDSYNC_INFO)
+        keys = {"id": "keys",
+                "default": [
+                    base64.b64encode(
+                        self.__bulk_keys.encryption_key).decode("utf-8"),
+                    base64.b64encode(
+                        self.__bulk_keys.hmac_key).decode("utf-8")],
+                "collections": {}}
+        server.put("crypto", {"id": "keys",
+                              "payload": self.__encrypt(keys, sync_keys)})
+
+    def populate(self, count):
+        """
+            Add count bookmarks (in folders) and count history items
+            @param count as int
+        """
+        folders = max(1, count // 100)
+        children = {}
+        now = time()
+        for i in range(count):
+            folder = "folder%06d" % (i % folders)
+            guid = "bmk%09d" % i
+            children.setdefault(folder, []).append(guid)
+            self.__put("bookmarks", {"id": guid,
+                                     "type": "bookmark",
+                                     "title": "Bookmark %s" % i,
+                                     "bmkUri": "https://b%s.example.com" % i,
+                                     "tags": ["tag%s" % (i % 20)],
+                                     "parentid": folder,
+                                     "parentName": "Folder %s" % (
+                                                                i % folders)})
+            self.__put("history", {"id": "hist%08d" % i,
+                                   "title": "Page %s" % i,
+                                   "histUri": "https://h%s.example.com/%s" % (
+                                                                 i % 5000, i),
+                                   "visits": [{"date": int(now * 1000000),
+                                               "type": 1}]})
+        for folder, guids in children.items():
+            self.__put("bookmarks", {"id": folder,
+                                     "type": "folder",
+                                     "title": folder,
+                                     "parentid": "unfiled",
+                                     "parentName": "",
+                                     "children": guids})
+
+    def change(self, count, percent):
+        """
+            Change titles of percent% of records
+            @param count as int
+            @param percent as float
+        """
+        step = max(1, int(100 / percent))
+        now = time()
+        for i in range(0, count, step):
+            folder = "folder%06d" % (i % max(1, count // 100))
+            self.__put("bookmarks", {"id": "bmk%09d" % i,
+                                     "type": "bookmark",
+                                     "title": "Changed bookmark %s" % i,
+                                     "bmkUri": "https://b%s.example.com" % i,
+                                     "tags": ["tag%s" % (i % 20)],
+                                     "parentid": folder,
+                                     "parentName": folder})
+            self.__put("history", {"id": "hist%08d" % i,
+                                   "title": "Changed page %s" % i,
+                                   "histUri": "https://h%s.example.com/%s" % (
+                                                                 i % 5000, i),
+                                   "visits": [{"date": int(now * 1000000),
+                                               "type": 1}]})
+
+    @property
+    def bulk_keys(self):
+        """
+            Get bulk keys
+            @return KeyBundle
+        """
+        return self.__bulk_keys
+
+    def __put(self, collection, item):
+        """
+            Encrypt and store item
+            @param collection as str
+            @param item as {}
+        """
+        self.__server.put(collection, {
+                            "id": item["id"],
+                            "payload": self.__encrypt(item, self.__bulk_keys)})
+
+    def __encrypt(self, item, key_bundle):
+        """
+            Encrypt item like a Firefox client
+            @param item as {}
+            @param key_bundle as KeyBundle
+            @return str
+        """
+        plaintext = json.dumps(item).encode("utf-8")
+        length = 16 - (len(plaintext) % 16)
+        plaintext += bytes([length]) * length
+        iv = Random.new().read(16)
+        aes = AES.new(key_bundle.encryption_key, AES.MODE_CBC, iv)
+        ciphertext = base64.b64encode(aes.encrypt(plaintext))
+        _hmac = hmac.new(key_bundle.hmac_key, ciphertext, sha256).hexdigest()
+        return json.dumps({"ciphertext": ciphertext.decode("utf-8"),
+                           "IV": base64.b64encode(iv).decode("utf-8"),
+                           "hmac": _hmac})
+
+
+def import_eolie():
+    """
+        Import eolie, from source tree if not installed
+    """
+    try:
+        import eolie
+        eolie  # Just make PEP8 happy
+    except ImportError:
+        src = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "src")
+        path = tempfile.mkdtemp()
+        os.symlink(os.path.abspath(src), os.path.join(path, "eolie"))
+        sys.path.insert(0, path)
+
+
+def setup_application():
+    """
+        Create a default Gio.Application providing what sync needs
+        @return Gio.Application
+    """
+    import gi
+    gi.require_version("Soup", "2.4")
+    gi.require_version("Secret", "1")
+    from gi.repository import Gio
+    from eolie.http_session import HttpSession
+    from eolie.database_bookmarks import DatabaseBookmarks
+    from eolie.database_history import DatabaseHistory
+    app = Gio.Application.new("org.gnome.Eolie.SyncBenchmark",
+                              Gio.ApplicationFlags.NON_UNIQUE)
+    Gio.Application.set_default(app)
+    app.cursors = {}
+    app.debug = False
+    app.http = HttpSession()
+    app.bookmarks = DatabaseBookmarks()
+    app.history = DatabaseHistory()
+    return app
+
+
+def get_benchmark_worker(credentials, bulk_keys):
+    """
+        Get a SyncWorker syncing in current thread with known credentials
+        @param credentials as {}
+        @param bulk_keys as KeyBundle
+        @return SyncWorker
+    """
+    from eolie.mozilla_sync import SyncWorker
+
+    class BenchmarkSyncWorker(SyncWorker):
+        """
+            FxA login and secret service are skipped
+        """
+        def sync_now(self, first_sync):
+            """
+                Sync in current thread
+                @param first_sync as bool
+            """
+            if self.syncing:
+                return
+            self._SyncWorker__username = "benchmark"
+            self._SyncWorker__credentials = credentials
+            self._SyncWorker__bulk_keys = bulk_keys
+            self._SyncWorker__token_loaded = True
+            self._SyncWorker__client.restore(credentials)
+            self._SyncWorker__stop = False
+            self._SyncWorker__sync(first_sync)
+
+    return BenchmarkSyncWorker()
+
+
+def run_phase(name, server, worker, first_sync):
+    """
+        Run one sync and print stats
+        @param name as str
+        @param server as MockSyncServer
+        @param worker as BenchmarkSyncWorker
+        @param first_sync as bool
+    """
+    server.reset_counters()
+    decrypt_time = worker.decrypt_time
+    apply_time = worker.apply_time
+    start = time()
+    start_cpu = process_time()
+    worker.sync_now(first_sync)
+    print("%-12s wall %8.2fs  cpu %8.2fs  requests %6d  bytes %12d"
+          "  decrypt %8.2fs  apply %8.2fs" % (
+              name, time() - start, process_time() - start_cpu,
+              server.requests, server.bytes,
+              worker.decrypt_time - decrypt_time,
+              worker.apply_time - apply_time))
+
+
+def main():
+    """
+        Run benchmark
+    """
+    parser = argparse.ArgumentParser(description="Offline sync benchmark")
+    parser.add_argument("-n", "--records", type=int, default=1000,
+                        help="bookmarks and history records count")
+    parser.add_argument("-c", "--changed", type=float, default=1.0,
+                        help="percent of records changed before "
+                             "incremental sync")
+    args = parser.parse_args()
+
+    os.environ["XDG_DATA_HOME"] = tempfile.mkdtemp()
+    import_eolie()
+    setup_application()
+    from eolie.mozilla_sync import MozillaSync
+
+    server = MockSyncServer()
+    server.start()
+    master_key = Random.new().read(32)
+    generator = FixtureGenerator(server, master_key)
+    print("Generating %s bookmarks and %s history records..." % (
+                                                   args.records, args.records))
+    generator.populate(args.records)
+
+    client = MozillaSync()
+    bulk_keys = client.connect("benchmark", master_key, server.uri)
+    credentials = client.credentials
+
+    worker = get_benchmark_worker(credentials, bulk_keys)
+    run_phase("first sync", server, worker, True)
+    run_phase("no-op sync", server, worker, False)
+    generator.change(args.records, args.changed)
+    run_phase("incremental", server, worker, False)
+
+
+if __name__ == "__main__":
+    main()